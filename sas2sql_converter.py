@@ -2,15 +2,342 @@ import pandas as pd
 import sqlparse
 import re
 import ast
+import math
 import json
-from typing import Dict, List, Tuple, Optional, Set
-from flask import Flask, request, jsonify, render_template_string, send_file
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, Tuple, Optional, Set
+from flask import Flask, Response, request, jsonify, render_template_string, send_file, stream_with_context
 import os
 from datetime import datetime
 from collections import defaultdict, OrderedDict
 import io
+import csv
+import codecs
+import hashlib
+import uuid
+import argparse
+import multiprocessing
+import sys
+import threading
+import time
+
+class SASBlockScanner:
+    """Single-pass lexer that splits SAS source into statements and groups them into step blocks.
+    
+    Source can be given all at once with scan() or incrementally with feed()/close(), in which
+    case each block is returned as soon as its RUN/QUIT (or the next step) has been seen.
+    """
+
+    # Comments, quoted strings and semicolons are the only tokens that matter for statement
+    # boundaries; everything else is consumed as one run so each byte is looked at once
+    _token_re = re.compile(r"""[^;'"/]+|'[^']*'?|"[^"]*"?|/\*.*?(?:\*/|\Z)|/|;""", re.DOTALL)
+    _keyword_re = re.compile(r'\s*([%&]?\w+)\s*(.*)', re.DOTALL)
+    _datalines_keywords = {'datalines': ';', 'cards': ';', 'lines': ';',
+                           'datalines4': ';;;;', 'cards4': ';;;;', 'lines4': ';;;;'}
+
+    def __init__(self, proc_types: Set[str] = None):
+        self.proc_types = proc_types
+        self.reset()
+
+    def reset(self):
+        self._buffer = ''
+        self._offset = 0
+        self._scanned = 0
+        self._current = None
+        self._macro_stack = []
+
+    def scan(self, sas_code: str) -> List[Dict]:
+        self.reset()
+        blocks = self.feed(sas_code)
+        blocks.extend(self.close())
+        return blocks
+
+    def feed(self, chunk: str) -> List[Dict]:
+        """Add source text and return the blocks completed by it"""
+        self._buffer += chunk
+        # Nothing new can complete until another semicolon arrives
+        if ';' not in self._buffer[self._scanned:]:
+            self._scanned = len(self._buffer)
+            return []
+        return self._consume(final=False)
+
+    def close(self) -> List[Dict]:
+        """Flush the remaining source, including a final step without RUN/QUIT"""
+        blocks = self._consume(final=True)
+        if self._current:
+            blocks.append(self._current)
+            self._current = None
+        self.reset()
+        return self._filter(blocks)
+
+    def _consume(self, final: bool) -> List[Dict]:
+        blocks = []
+        for statement in self._iter_statements(final):
+            self._group(statement, blocks)
+        return self._filter(blocks)
+
+    def _filter(self, blocks: List[Dict]) -> List[Dict]:
+        if self.proc_types is None:
+            return blocks
+        return [block for block in blocks
+                if block['kind'] != 'PROC' or block['type'] in self.proc_types]
+
+    def _group(self, statement: Tuple, blocks: List[Dict]):
+        keyword, text, start, end, datalines = statement
+        current = self._current
+        for macro in self._macro_stack:
+            macro['statements'].append(text)
+
+        if keyword == '%macro':
+            name_match = re.match(r'%macro\s+(\w+)', text, re.IGNORECASE)
+            if name_match:
+                self._macro_stack.append({'kind': 'MACRO', 'name': name_match.group(1), 'header': text,
+                                          'statements': [], 'start': start})
+            return
+        if keyword == '%mend':
+            if self._macro_stack:
+                macro = self._macro_stack.pop()
+                macro['statements'].pop()
+                macro['end'] = end
+                blocks.append(macro)
+            return
+
+        if keyword == 'data' and not text[4:].lstrip().startswith('='):
+            if current:
+                blocks.append(current)
+            self._current = {'kind': 'DATA', 'type': 'DATA', 'header': text, 'statements': [],
+                             'datalines': None, 'start': start, 'end': end}
+        elif keyword == 'proc':
+            if current:
+                blocks.append(current)
+            proc_match = re.match(r'proc\s+(\w+)', text, re.IGNORECASE)
+            proc_type = proc_match.group(1).upper() if proc_match else ''
+            self._current = {'kind': 'PROC', 'type': proc_type, 'header': text, 'statements': [],
+                             'datalines': None, 'start': start, 'end': end}
+        elif keyword in ('run', 'quit'):
+            # PROC SQL executes statement by statement and only ends on QUIT
+            if current and (keyword == 'quit' or current['type'] != 'SQL'):
+                current['end'] = end
+                blocks.append(current)
+                self._current = None
+        elif keyword == 'libname':
+            blocks.append({'kind': 'LIBNAME', 'type': 'LIBNAME', 'header': text, 'statements': [],
+                           'datalines': None, 'start': start, 'end': end})
+        elif current:
+            current['statements'].append(text)
+            current['end'] = end
+            if datalines is not None:
+                current['datalines'] = datalines
+
+    def _iter_statements(self, final: bool):
+        """Yield (keyword, text, start, end, datalines) for every complete statement in the buffer.
+        
+        Unless final, a trailing partial statement (possibly an unterminated string, comment or
+        DATALINES block) stays in the buffer until more source arrives.
+        """
+        sas_code = self._buffer
+        offset = self._offset
+        token_re = self._token_re
+        length = len(sas_code)
+        pos = stmt_start = 0
+        parts = []
+
+        while pos < length:
+            match = token_re.match(sas_code, pos)
+            token = match.group(0)
+            pos = match.end()
+
+            if token == ';':
+                text = self._normalize(''.join(parts))
+                parts = []
+                # Statements starting with '*' are comments
+                if text and not text.startswith('*'):
+                    keyword_match = self._keyword_re.match(text)
+                    keyword = keyword_match.group(1).lower() if keyword_match else ''
+                    datalines = None
+                    terminator = self._datalines_keywords.get(keyword)
+                    if terminator:
+                        data_end = sas_code.find(terminator, pos)
+                        if data_end == -1:
+                            if not final:
+                                break
+                            data_end = length
+                        datalines = sas_code[pos:data_end]
+                        pos = min(data_end + len(terminator), length)
+                    yield keyword, text, offset + stmt_start, offset + pos, datalines
+                stmt_start = pos
+            elif token.startswith('/*'):
+                parts.append(' ')
+            else:
+                parts.append(token)
+
+        if final:
+            # Trailing statement without a terminating semicolon
+            text = self._normalize(''.join(parts))
+            if text and not text.startswith('*'):
+                keyword_match = self._keyword_re.match(text)
+                yield (keyword_match.group(1).lower() if keyword_match else '', text,
+                       offset + stmt_start, offset + length, None)
+            stmt_start = length
+
+        self._buffer = sas_code[stmt_start:]
+        self._offset = offset + stmt_start
+        self._scanned = len(self._buffer)
+
+    def _normalize(self, text: str) -> str:
+        # Same layout the old cleaner produced: runs of blanks collapsed, line breaks kept
+        if '\n' not in text:
+            return ' '.join(text.split())
+        lines = (' '.join(line.split()) for line in text.split('\n'))
+        return '\n'.join(line for line in lines if line)
+
+    @classmethod
+    def split_keyword(cls, statement: str) -> Tuple[str, str]:
+        keyword_match = cls._keyword_re.match(statement)
+        if not keyword_match:
+            return '', statement
+        return keyword_match.group(1).lower(), keyword_match.group(2)
+
+    @staticmethod
+    def render(statements: List[str], datalines: Optional[str] = None) -> str:
+        content = ''.join(f"{statement};\n" for statement in statements)
+        if datalines is not None:
+            content += datalines.strip('\n') + "\n;\n"
+        return content
+
+class IRNode:
+    """Slotted intermediate representation record with the read access of the dicts it replaces"""
+    __slots__ = ()
+
+    def __getitem__(self, key: str):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key: str, default=None):
+        return getattr(self, key, default)
+
+class SourceSpan(IRNode, ABC):
+    """IR node for one step, pointing at its (start, end) span of the shared source buffer.
+
+    Step text is rebuilt from the span only when something asks for it. Nodes built without
+    a buffer (streaming) or sent to another process carry their rendered text instead.
+    """
+    __slots__ = ('source', 'start', 'end', '_text')
+
+    def __init__(self, source: Optional[str], block: Dict):
+        self.source = source
+        self.start = block['start']
+        self.end = block['end']
+        self._text = None if source is not None else self._render(block)
+
+    @property
+    def span(self) -> Tuple[int, int]:
+        return self.start, self.end
+
+    @property
+    def content(self) -> str:
+        return self._rendered()[0]
+
+    @property
+    def original_content(self) -> str:
+        return self._rendered()[1]
+
+    def _rendered(self) -> Tuple[str, str]:
+        if self._text is not None:
+            return self._text
+        return self._render(SASBlockScanner().scan(self.source[self.start:self.end])[0])
+
+    @abstractmethod
+    def _render(self, block: Dict) -> Tuple[str, str]:
+        """(content, original_content) of the step from its scanned block"""
+
+    def __getstate__(self) -> Dict:
+        # Ship the rendered text rather than the whole program the span points into
+        state = {slot: getattr(self, slot) for cls in type(self).__mro__
+                 for slot in getattr(cls, '__slots__', ())}
+        state['source'] = None
+        state['_text'] = self._rendered()
+        return state
+
+    def __setstate__(self, state: Dict):
+        for slot, value in state.items():
+            setattr(self, slot, value)
+
+class DataStepIR(SourceSpan):
+    __slots__ = ('table_name', 'source_tables', 'operations', 'datalines')
+    step_type = 'DATA_STEP'
+
+    def __init__(self, source: Optional[str], block: Dict, table_name: str, source_tables: List[str],
+                 operations: Dict, datalines: Optional[pd.DataFrame] = None):
+        self.table_name = table_name
+        self.source_tables = source_tables
+        self.operations = operations
+        # Parsed DATALINES rows, one string column per INPUT variable
+        self.datalines = datalines
+        super().__init__(source, block)
+
+    @property
+    def has_datalines(self) -> bool:
+        return self.datalines is not None
+
+    def _render(self, block: Dict) -> Tuple[str, str]:
+        content = SASBlockScanner.render(block['statements'], block['datalines'])
+        return content, content
+
+class ProcedureIR(SourceSpan):
+    __slots__ = ('type', 'data_sources', 'creates_table')
+
+    def __init__(self, source: Optional[str], block: Dict, data_sources: List[str],
+                 creates_table: Optional[str]):
+        self.type = block['type']
+        self.data_sources = data_sources
+        self.creates_table = creates_table
+        super().__init__(source, block)
+
+    def _render(self, block: Dict) -> Tuple[str, str]:
+        # TITLE statements are kept in the original text only
+        statements = [block['header']] + block['statements']
+        original = SASBlockScanner.render(statements, block['datalines']).strip()
+        content = SASBlockScanner.render(
+            [stmt for stmt in statements if SASBlockScanner.split_keyword(stmt)[0] != 'title'],
+            block['datalines']).strip()
+        return content, original
+
+class TableUsage(IRNode):
+    """One step reading a table; the text is the reading step's own"""
+    __slots__ = ('type', 'target', 'step')
+
+    def __init__(self, usage_type: str, target: str, step: SourceSpan):
+        self.type = usage_type
+        self.target = target
+        self.step = step
+
+    @property
+    def content(self) -> str:
+        return self.step.original_content
 
 class SASAnalyzer:
+    # The table a procedure writes, by procedure type
+    _procedure_output_patterns = {
+        'SQL': re.compile(r'create\s+table\s+(\w+(?:\.\w+)?)', re.IGNORECASE),
+        'MEANS': re.compile(r'\boutput\b[^;]*?\bout\s*=\s*(\w+(?:\.\w+)?)', re.IGNORECASE),
+        'SUMMARY': re.compile(r'\boutput\b[^;]*?\bout\s*=\s*(\w+(?:\.\w+)?)', re.IGNORECASE),
+        'FREQ': re.compile(r'\btables?\b[^;]*?/[^;]*?\bout\s*=\s*(\w+(?:\.\w+)?)', re.IGNORECASE),
+        'SORT': re.compile(r'^[^;]*?\bout\s*=\s*(\w+(?:\.\w+)?)', re.IGNORECASE),
+        'TRANSPOSE': re.compile(r'^[^;]*?\bout\s*=\s*(\w+(?:\.\w+)?)', re.IGNORECASE),
+    }
+    _dataset_option_re = re.compile(r'(\w+)\s*=\s*(\((?:[^()]|\([^()]*\))*\)|[^\s=()]+(?:\s+[^\s=()]+(?![^\s=()]|\s*=))*)')
+    _assignment_re = re.compile(r'([A-Za-z_]\w*)\s*=(?!=)\s*(.+)', re.DOTALL)
+    # DATA step logic that reads earlier rows or the BY group position
+    _row_order_re = re.compile(r'\b(?:first|last)\.\w+|\b(?:lag|dif)\d*\s*\(', re.IGNORECASE)
+    _lag_re = re.compile(r'\b(?:lag|dif)\d*\s*\(', re.IGNORECASE)
+    _sum_statement_re = re.compile(r'([A-Za-z_]\w*)\s*\+\s*(.+)', re.DOTALL)
+    _conditional_re = re.compile(r'if\b\s*(.+?)\s*\bthen\b\s*(.*)', re.DOTALL | re.IGNORECASE)
+    _do_group_re = re.compile(r'(?:(?:else\s+)?if\b.*\bthen\s+|else\s+)?(?:do|select)\b', re.DOTALL | re.IGNORECASE)
+    _retain_value_re = re.compile(r'''[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|\.[A-Za-z_]?|'[^']*'|"[^"]*"''')
+    
     def __init__(self):
         self.sas_patterns = {
             'libname': r'libname\s+(\w+)\s+[\'"]?([^\'";]+)[\'"]?\s*;',
@@ -22,6 +349,7 @@ class SASAnalyzer:
             'proc_sort': r'proc\s+sort[^;]*(?:;\s*title[^;]*;)?(.*?)run\s*;',
             'proc_freq': r'proc\s+freq[^;]*(?:;\s*title[^;]*;)?(.*?)run\s*;',
             'proc_contents': r'proc\s+contents[^;]*(?:;\s*title[^;]*;)?(.*?)run\s*;',
+            'proc_transpose': r'proc\s+transpose[^;]*(?:;\s*title[^;]*;)?(.*?)run\s*;',
             'where_clause': r'where\s+([^;]+);',
             'keep_drop': r'(keep|drop)\s*=\s*([^;]+);',
             'merge_join': r'merge\s+([^;]+);',
@@ -45,57 +373,22 @@ class SASAnalyzer:
             'sum': 'SUM', 'mean': 'AVG', 'min': 'MIN', 'max': 'MAX', 'count': 'COUNT',
             'n': 'COUNT', 'nmiss': 'COUNT_CASE_WHEN_NULL', 'std': 'STDDEV', 'var': 'VARIANCE'
         }
+        
+        proc_types = {name[len('proc_'):].upper() for name in self.sas_patterns if name.startswith('proc_')}
+        self.scanner = SASBlockScanner(proc_types)
+        self._function_call_re = re.compile(r'\b(\w+)\s*\(')
+        self._dataset_re = re.compile(r'([A-Za-z_&][\w.&]*)\s*(\((?:[^()]|\([^()]*\))*\))?')
+        self._column_range_re = re.compile(r'\d+-\d+')
+        # DATALINES blocks with fewer lines are split without pandas' CSV parser
+        self._datalines_parser_min_lines = 1000
     
     def parse_sas_code(self, sas_code: str) -> Dict:
         try:
-            sas_code = self._remove_comments(sas_code)
-            sas_code = self._clean_sas_code(sas_code)
-            
-            components = {
-                'data_steps': [], 'procedures': [], 'variables': set(), 'filters': [],
-                'tables': set(), 'functions_used': set(), 'table_dependencies': {},
-                'table_usage': defaultdict(list), 'datalines_tables': {}, 
-                'libraries': {}, 'macros': {}
-            }
+            components = self._empty_components()
             
-            libname_matches = re.findall(self.sas_patterns['libname'], sas_code, re.IGNORECASE)
-            for libname, path in libname_matches:
-                components['libraries'][libname] = path
-            
-            macro_matches = re.findall(self.sas_patterns['macro_definition'], sas_code, re.DOTALL | re.IGNORECASE)
-            for macro_name, macro_content in macro_matches:
-                components['macros'][macro_name] = macro_content.strip()
-            
-            data_steps = re.findall(self.sas_patterns['data_step'], sas_code, re.DOTALL | re.IGNORECASE)
-            for table_name, step_content in data_steps:
-                table_name = table_name.strip()
-                datalines_data = self._extract_datalines(step_content)
-                if datalines_data:
-                    components['datalines_tables'][table_name] = datalines_data
-                    source_tables = []
-                else:
-                    source_tables = self._extract_source_tables(step_content)
-                
-                step_info = {
-                    'table_name': table_name, 'content': step_content, 'source_tables': source_tables,
-                    'operations': self._extract_operations(step_content), 'step_type': 'DATA_STEP',
-                    'has_datalines': bool(datalines_data)
-                }
-                components['data_steps'].append(step_info)
-                components['tables'].add(table_name)
-                components['table_dependencies'][table_name] = source_tables
-                
-                for source_table in source_tables:
-                    components['table_usage'][source_table].append({
-                        'type': 'DATA_STEP', 'target': table_name, 'content': step_content
-                    })
-                
-                variables = self._extract_variables(step_content)
-                components['variables'].update(variables)
-                functions = self._extract_functions(step_content)
-                components['functions_used'].update(functions)
+            for block in self.scanner.scan(sas_code):
+                self._add_block(block, components, sas_code)
             
-            self._extract_procedures(sas_code, components)
             components['variables'] = list(components['variables'])
             components['tables'] = list(components['tables'])
             components['functions_used'] = list(components['functions_used'])
@@ -104,187 +397,901 @@ class SASAnalyzer:
             
         except Exception as e:
             print(f"Error in parse_sas_code: {str(e)}")
-            return {'data_steps': [], 'procedures': [], 'variables': [], 'filters': [],
-                    'tables': [], 'functions_used': [], 'table_dependencies': {},
-                    'table_usage': defaultdict(list), 'datalines_tables': {},
-                    'libraries': {}, 'macros': {}}
+            components = self._empty_components()
+            for key in ('variables', 'tables', 'functions_used'):
+                components[key] = []
+            return components
     
-    def _extract_datalines(self, content: str) -> Optional[List[Dict]]:
+    def iter_blocks(self, fileobj, chunk_size: int = 1 << 16):
+        """Yield parsed components one DATA/PROC block at a time from a text or binary file object"""
+        scanner = SASBlockScanner(self.scanner.proc_types)
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        while True:
+            chunk = fileobj.read(chunk_size)
+            if not chunk:
+                break
+            if isinstance(chunk, bytes):
+                chunk = decoder.decode(chunk)
+            for block in scanner.feed(chunk):
+                yield self._parse_block(block)
+        tail = decoder.decode(b'', final=True)
+        for block in scanner.feed(tail) + scanner.close():
+            yield self._parse_block(block)
+    
+    def _parse_block(self, block: Dict) -> Dict:
+        components = self._empty_components()
+        # No shared buffer while streaming, so the step nodes keep their own text
+        self._add_block(block, components, None)
+        components['span'] = (block['start'], block['end'])
+        return components
+    
+    def _empty_components(self) -> Dict:
+        return {
+            'data_steps': [], 'procedures': [], 'variables': set(), 'filters': [],
+            'tables': set(), 'functions_used': set(), 'table_dependencies': {},
+            'table_usage': defaultdict(list), 'datalines_tables': {}, 
+            'libraries': {}, 'macros': {}
+        }
+    
+    def _add_block(self, block: Dict, components: Dict, source: Optional[str]):
+        kind = block['kind']
+        if kind == 'DATA':
+            self._add_data_step(block, components, source)
+        elif kind == 'PROC':
+            self._add_procedure(block, components, source)
+        elif kind == 'LIBNAME':
+            libname_match = re.match(self.sas_patterns['libname'], block['header'] + ';', re.IGNORECASE)
+            if libname_match:
+                components['libraries'][libname_match.group(1)] = libname_match.group(2)
+        elif kind == 'MACRO':
+            components['macros'][block['name']] = SASBlockScanner.render(block['statements'])
+    
+    def _add_data_step(self, block: Dict, components: Dict, source: Optional[str]):
+        _, targets = SASBlockScanner.split_keyword(block['header'])
+        output_tables = self._parse_dataset_list(targets)
+        table_name = output_tables[0][0] if output_tables else targets.strip()
+        statements = block['statements']
+        
+        operations = self._extract_operations(statements)
+        for _, options in output_tables[:1]:
+            self._apply_dataset_options(self._parse_dataset_options(options), operations)
+        
+        datalines_data = None
+        if block['datalines'] is not None and operations['input']:
+            datalines_data = self._extract_datalines(block['datalines'], operations['input'])
+            if datalines_data is not None and datalines_data.empty:
+                datalines_data = None
+        if datalines_data is not None:
+            components['datalines_tables'][table_name] = datalines_data
+            source_tables = []
+        else:
+            source_tables = self._extract_source_tables(operations)
+        
+        # Only the operations a step actually uses are kept
+        operations = {key: value for key, value in operations.items() if value}
+        step_info = DataStepIR(source, block, table_name, source_tables, operations, datalines_data)
+        components['data_steps'].append(step_info)
+        components['tables'].add(table_name)
+        components['table_dependencies'][table_name] = source_tables
+        
+        for source_table in source_tables:
+            components['table_usage'][source_table].append(TableUsage('DATA_STEP', table_name, step_info))
+        
+        components['variables'].update(self._extract_variables(operations))
+        components['functions_used'].update(self._extract_functions(statements))
+    
+    def _add_procedure(self, block: Dict, components: Dict, source: Optional[str]):
+        proc_type = block['type']
+        statements = [block['header']] + block['statements']
+        # Rendered once for the scans below; the procedure node only keeps its span
+        proc_content = SASBlockScanner.render(statements, block['datalines'])
+        
+        data_sources = self._extract_procedure_data_sources(proc_content, proc_type)
+        creates_table = None
+        if proc_type in self._procedure_output_patterns:
+            creates_table_match = self._procedure_output_patterns[proc_type].search(proc_content)
+            creates_table = creates_table_match.group(1) if creates_table_match else None
+        if proc_type == 'SORT' and not creates_table and data_sources:
+            # Without OUT= the input is sorted in place
+            creates_table = data_sources[0]
+        
+        procedure = ProcedureIR(source, block, data_sources, creates_table)
+        for data_source in data_sources:
+            components['table_usage'][data_source].append(
+                TableUsage(f'PROC_{proc_type}', f'proc_{proc_type.lower()}', procedure))
+        components['procedures'].append(procedure)
+    
+    def _extract_datalines(self, datalines: str, input_vars: List[str]) -> Optional[pd.DataFrame]:
+        """Parse list-input DATALINES into one string column per INPUT variable.
+        
+        Large blocks go through pandas' C parser, which splits on whitespace; a block of a few
+        lines is split in Python, where the parser's setup would cost far more than the data.
+        Lines with fewer fields than variables are dropped and extra fields are ignored.
+        """
         try:
-            datalines_match = re.search(self.sas_patterns['datalines_statement'], content, re.DOTALL | re.IGNORECASE)
-            if not datalines_match:
+            if not input_vars:
                 return None
-            datalines_content = datalines_match.group(1).strip()
-            input_match = re.search(r'input\s+([^;]+);', content, re.IGNORECASE)
-            if not input_match:
-                return None
-            input_vars = [var.strip().rstrip('$') for var in input_match.group(1).split()]
-            rows = []
-            for line in datalines_content.split('\n'):
-                line = line.strip()
-                if line and not line.startswith(';'):
-                    values = line.split()
-                    if len(values) >= len(input_vars):
-                        row = {}
-                        for i, var in enumerate(input_vars):
-                            if i < len(values):
-                                row[var] = values[i]
-                        rows.append(row)
-            return rows
-        except:
+            width = len(input_vars)
+            if datalines.count('\n') < self._datalines_parser_min_lines:
+                rows = [line.split()[:width] for line in datalines.split('\n')]
+                rows = [row for row in rows if len(row) == width and not row[0].startswith(';')]
+                return pd.DataFrame(rows, columns=input_vars, dtype=str)
+            frame = pd.read_csv(io.StringIO(datalines), sep=r'\s+', header=None, names=range(width),
+                                usecols=range(width), dtype=str, engine='c', quoting=csv.QUOTE_NONE,
+                                keep_default_na=False, skip_blank_lines=True)
+            # Short lines come back padded with empty strings
+            frame = frame[(frame[width - 1] != '') & ~frame[0].str.startswith(';')]
+            frame.columns = input_vars
+            return frame.reset_index(drop=True)
+        except Exception:
             return None
     
-    def _remove_comments(self, sas_code: str) -> str:
-        sas_code = re.sub(r'/\*.*?\*/', '', sas_code, flags=re.DOTALL)
-        sas_code = re.sub(r'^\s*\*.*$', '', sas_code, flags=re.MULTILINE)
-        return sas_code
+    def _parse_dataset_list(self, text: str) -> List[Tuple[str, str]]:
+        """Split 'a(in=x keep=b c) lib.b' into [(name, options), ...]"""
+        datasets = []
+        for match in self._dataset_re.finditer(text):
+            options = match.group(2) or ''
+            datasets.append((match.group(1), options[1:-1].strip()))
+        return datasets
     
-    def _clean_sas_code(self, sas_code: str) -> str:
-        sas_code = re.sub(r'[ \t]+', ' ', sas_code)
-        sas_code = re.sub(r'\s*;\s*', ';\n', sas_code)
-        return sas_code
+    @classmethod
+    def _parse_dataset_options(cls, options: str) -> Dict[str, str]:
+        parsed = {}
+        for match in cls._dataset_option_re.finditer(options):
+            value = match.group(2).strip()
+            if value.startswith('(') and value.endswith(')'):
+                value = value[1:-1].strip()
+            parsed[match.group(1).lower()] = value
+        return parsed
     
-    def _extract_source_tables(self, content: str) -> List[str]:
+    def _apply_dataset_options(self, options: Dict[str, str], operations: Dict, output: bool = True):
+        # KEEP/DROP/RENAME on an input dataset stay in operations['dataset_options'], they act before
+        # the step's own statements
+        if output and 'keep' in options:
+            operations['keep'].extend(options['keep'].split())
+        if output and 'drop' in options:
+            operations['drop'].extend(options['drop'].split())
+        if output and 'rename' in options:
+            operations['rename'].extend(options['rename'].split())
+        if 'where' in options:
+            operations['where'].append(options['where'])
+    
+    def _extract_source_tables(self, operations: Dict) -> List[str]:
         tables = []
-        set_matches = re.findall(r'set\s+([^;]+);', content, re.IGNORECASE)
-        for match in set_matches:
-            tables.extend([tbl.strip() for tbl in match.split()])
-        merge_matches = re.findall(r'merge\s+([^;]+);', content, re.IGNORECASE)
-        for match in merge_matches:
-            tables.extend([tbl.strip() for tbl in match.split()])
+        tables.extend(operations.get('set', []))
+        tables.extend(operations.get('merge', []))
         return tables
     
-    def _extract_operations(self, content: str) -> Dict:
+    def _parse_input_statement(self, args: str) -> Tuple[List[str], Dict[str, str]]:
+        """Variables of an INPUT statement and the informat each one is read with.
+        
+        '$' alone marks a character variable without a width; column ranges (name $ 1-10)
+        become the equivalent $w. or w. informat. Pointers (@1 +2) are skipped.
+        """
+        input_vars = []
+        informats = {}
+        current = None
+        for token in args.split():
+            token = token.lstrip(':&')
+            if re.fullmatch(r'[A-Za-z_]\w*\$?', token):
+                current = token.rstrip('$')
+                input_vars.append(current)
+                if token.endswith('$'):
+                    informats[current] = '$'
+            elif current is None:
+                continue
+            elif token == '$':
+                informats[current] = '$'
+            elif self._column_range_re.fullmatch(token):
+                first, last = token.split('-')
+                width = int(last) - int(first) + 1
+                informats[current] = f"${width}." if informats.get(current) == '$' else f"{width}."
+            elif '.' in token and re.fullmatch(r'\$?[A-Za-z_]*\d*[A-Za-z_]*\d*\.\d*', token):
+                informats[current] = token.lower()
+        return input_vars, informats
+    
+    def _extract_operations(self, statements: List[str]) -> Dict:
         operations = {
             'where': [], 'keep': [], 'drop': [], 'if': [], 'by': [], 'var': [], 'class': [],
             'rename': [], 'length': [], 'format': [], 'informat': [], 'input': [],
-            'merge': [], 'set': [], 'calculated_fields': []
+            'merge': [], 'set': [], 'calculated_fields': [], 'dataset_options': {}, 'input_informats': {},
+            'retain': [], 'sum_statements': [], 'conditional': [], 'output': [], 'late_if': []
         }
         try:
-            where_matches = re.findall(r'where\s+([^;]+);', content, re.IGNORECASE)
-            operations['where'] = [w.strip().rstrip(';') for w in where_matches]
-            
-            keep_matches = re.findall(r'keep\s*=\s*([^;]+);', content, re.IGNORECASE)
-            if keep_matches:
-                operations['keep'] = [col.strip() for col in keep_matches[0].split()]
-            
-            drop_matches = re.findall(r'drop\s*=\s*([^;]+);', content, re.IGNORECASE)
-            if drop_matches:
-                operations['drop'] = [col.strip() for col in drop_matches[0].split()]
-            
-            if_matches = re.findall(r'if\s+([^;]+);', content, re.IGNORECASE)
-            operations['if'] = [i.strip().rstrip(';') for i in if_matches]
-            
-            by_matches = re.findall(r'by\s+([^;]+);', content, re.IGNORECASE)
-            if by_matches:
-                operations['by'] = [col.strip() for col in by_matches[0].split()]
-            
-            var_matches = re.findall(r'var\s+([^;]+);', content, re.IGNORECASE)
-            if var_matches:
-                operations['var'] = [col.strip() for col in var_matches[0].split()]
-            
-            input_matches = re.findall(r'input\s+([^;]+);', content, re.IGNORECASE)
-            if input_matches:
-                input_vars = []
-                for var in input_matches[0].split():
-                    var = var.strip().rstrip('$')
-                    input_vars.append(var)
-                operations['input'] = input_vars
-            
-            merge_matches = re.findall(r'merge\s+([^;]+);', content, re.IGNORECASE)
-            if merge_matches:
-                operations['merge'] = [tbl.strip() for tbl in merge_matches[0].split()]
-            
-            set_matches = re.findall(r'set\s+([^;]+);', content, re.IGNORECASE)
-            if set_matches:
-                operations['set'] = [tbl.strip() for tbl in set_matches[0].split()]
-            
-            # Extract calculated fields
-            calc_matches = re.findall(r'(\w+)\s*=\s*([^;]+);', content)
-            for var_name, expression in calc_matches:
-                if var_name not in ['keep', 'drop', 'where', 'if', 'by']:
-                    operations['calculated_fields'].append({
-                        'name': var_name.strip(),
-                        'expression': expression.strip()
-                    })
+            block, depth = None, 0
+            # Set once a statement depends on earlier rows; subsetting IFs after it are 'late'
+            row_logic = False
+            for statement in statements:
+                statement = statement.strip()
+                if block is not None:
+                    # Statements of an IF-THEN DO group, nested groups included, up to its END
+                    if self._do_group_re.match(statement):
+                        depth += 1
+                    elif statement.lower() == 'end':
+                        depth -= 1
+                        if not depth:
+                            row_logic = row_logic or self._conditional_row_logic(block, operations)
+                            block = None
+                            continue
+                    block['statements'].append(statement)
+                    continue
+                
+                conditional = self._parse_conditional(statement)
+                if conditional is not None:
+                    block = dict(conditional, position=len(operations['calculated_fields']))
+                    operations['conditional'].append(block)
+                    if block['statements'] and block['statements'][-1].lower() == 'do':
+                        block['statements'].pop()
+                        depth = 1
+                    else:
+                        row_logic = row_logic or self._conditional_row_logic(block, operations)
+                        block = None
+                    continue
+                
+                assignment_match = self._assignment_re.fullmatch(statement)
+                if assignment_match and assignment_match.group(1).lower() not in ['keep', 'drop', 'where', 'if', 'by']:
+                    name, expression = assignment_match.group(1), assignment_match.group(2).strip()
+                    operations['calculated_fields'].append({'name': name, 'expression': expression})
+                    retained = {entry['name'].lower() for entry in operations['retain']}
+                    if self._row_order_re.search(expression) or (
+                            name.lower() in retained and re.search(rf'\b{name}\b', expression, re.IGNORECASE)):
+                        row_logic = True
+                    continue
+                
+                sum_match = self._sum_statement_re.fullmatch(statement)
+                if sum_match:
+                    # var + expr; accumulates into an implicitly retained variable
+                    operations['sum_statements'].append({'name': sum_match.group(1),
+                                                         'expression': sum_match.group(2).strip()})
+                    row_logic = True
+                    continue
+                
+                keyword, args = SASBlockScanner.split_keyword(statement)
+                if keyword == 'where':
+                    operations['where'].append(args.strip())
+                elif keyword == 'if':
+                    operations['if'].append(args.strip())
+                    if row_logic:
+                        operations['late_if'].append(args.strip())
+                elif keyword == 'retain':
+                    operations['retain'].extend(self._parse_retain_statement(args))
+                elif keyword == 'output':
+                    operations['output'].append(args.strip())
+                elif keyword in ('keep', 'drop', 'rename', 'length', 'format', 'informat', 'class'):
+                    operations[keyword].extend(args.split())
+                elif keyword in ('by', 'var') and not operations[keyword]:
+                    operations[keyword] = args.split()
+                elif keyword == 'input' and not operations['input']:
+                    operations['input'], operations['input_informats'] = self._parse_input_statement(args)
+                elif keyword in ('merge', 'set') and not operations[keyword]:
+                    for table, options in self._parse_dataset_list(args):
+                        operations[keyword].append(table)
+                        if options:
+                            parsed_options = self._parse_dataset_options(options)
+                            operations['dataset_options'][table] = parsed_options
+                            self._apply_dataset_options(parsed_options, operations, output=False)
         except Exception as e:
             print(f"Error extracting operations: {str(e)}")
         return operations
     
-    def _extract_variables(self, content: str) -> List[str]:
+    def _parse_conditional(self, statement: str) -> Optional[Dict]:
+        """IF-THEN / ELSE [IF-THEN] as {'condition', 'else', 'statements'}; condition None for a plain ELSE"""
+        else_match = re.match(r'else\b\s*(.*)', statement, re.DOTALL | re.IGNORECASE)
+        rest = else_match.group(1) if else_match else statement
+        if_match = self._conditional_re.fullmatch(rest)
+        if if_match:
+            condition, body = if_match.group(1).strip(), if_match.group(2).strip()
+        elif else_match:
+            condition, body = None, rest.strip()
+        else:
+            return None
+        return {'condition': condition, 'else': bool(else_match), 'statements': [body] if body else []}
+    
+    def _conditional_row_logic(self, block: Dict, operations: Dict) -> bool:
+        retained = {entry['name'].lower() for entry in operations['retain']}
+        if self._row_order_re.search(block['condition'] or ''):
+            return True
+        for statement in block['statements']:
+            if self._row_order_re.search(statement) or self._sum_statement_re.fullmatch(statement):
+                return True
+            assignment_match = self._assignment_re.fullmatch(statement)
+            if assignment_match and assignment_match.group(1).lower() in retained:
+                return True
+        return False
+    
+    def _parse_retain_statement(self, args: str) -> List[Dict]:
+        """RETAIN variables as {'name', 'initial'}; a value sets every variable listed since the previous one"""
+        retained, pending = [], []
+        for token in re.findall(r"""'[^']*'|"[^"]*"|[^\s()]+""", args):
+            if self._retain_value_re.fullmatch(token):
+                for entry in pending:
+                    entry['initial'] = token
+                pending = []
+            elif re.fullmatch(r'[A-Za-z_]\w*', token) and token.lower() not in ('_all_', '_char_', '_numeric_'):
+                entry = {'name': token, 'initial': None}
+                retained.append(entry)
+                pending.append(entry)
+        return retained
+    
+    def _extract_variables(self, operations: Dict) -> List[str]:
         variables = []
         try:
-            keep_drop_matches = re.findall(r'(keep|drop)\s*=\s*([^;]+);', content, re.IGNORECASE)
-            for _, cols in keep_drop_matches:
-                variables.extend([col.strip() for col in cols.split()])
-            
-            assignment_matches = re.findall(r'(\w+)\s*=', content)
-            variables.extend(assignment_matches)
-            
-            select_matches = re.findall(r'select\s+([^;]+)(?:from|$)', content, re.IGNORECASE)
-            for match in select_matches:
-                columns = re.findall(r'(\w+)(?:\s+as\s+\w+)?(?:\s*,\s*|$)', match)
-                variables.extend(columns)
-            
-            input_matches = re.findall(r'input\s+([^;]+);', content, re.IGNORECASE)
-            for match in input_matches:
-                for var in match.split():
-                    var = var.strip().rstrip('$')
-                    variables.append(var)
+            variables.extend(operations.get('keep', []))
+            variables.extend(operations.get('drop', []))
+            for options in operations.get('dataset_options', {}).values():
+                variables.extend(options.get('keep', '').split())
+                variables.extend(options.get('drop', '').split())
+            variables.extend(field['name'] for field in operations.get('calculated_fields', []))
+            variables.extend(operations.get('input', []))
         except Exception as e:
             print(f"Error extracting variables: {str(e)}")
         return list(set(variables))
     
-    def _extract_functions(self, content: str) -> List[str]:
-        functions = []
+    def _extract_functions(self, statements: List[str]) -> List[str]:
+        functions = set()
         try:
-            for sas_func in self.sas_functions.keys():
-                if re.search(r'\b' + sas_func + r'\s*\(', content, re.IGNORECASE):
-                    functions.append(sas_func)
+            for statement in statements:
+                for name in self._function_call_re.findall(statement):
+                    name = name.lower()
+                    if name in self.sas_functions:
+                        functions.add(name)
         except Exception as e:
             print(f"Error extracting functions: {str(e)}")
-        return functions
-    
-    def _extract_procedures(self, sas_code: str, components: Dict):
-        procedure_patterns = {
-            'SQL': self.sas_patterns['proc_sql'], 'SUMMARY': self.sas_patterns['proc_summary'],
-            'MEANS': self.sas_patterns['proc_means'], 'SORT': self.sas_patterns['proc_sort'],
-            'PRINT': self.sas_patterns['proc_print'], 'FREQ': self.sas_patterns['proc_freq'],
-            'CONTENTS': self.sas_patterns['proc_contents']
-        }
-        
-        for proc_type, pattern in procedure_patterns.items():
-            try:
-                procs = re.findall(pattern, sas_code, re.DOTALL | re.IGNORECASE)
-                for proc_content in procs:
-                    data_sources = self._extract_procedure_data_sources(proc_content, proc_type)
-                    for data_source in data_sources:
-                        components['table_usage'][data_source].append({
-                            'type': f'PROC_{proc_type}', 'target': f'proc_{proc_type.lower()}', 'content': proc_content
-                        })
-                    clean_content = re.sub(r'title\s+[^;]*;', '', proc_content, flags=re.IGNORECASE)
-                    components['procedures'].append({
-                        'type': proc_type, 'content': clean_content.strip(),
-                        'original_content': proc_content.strip(), 'data_sources': data_sources
-                    })
-            except Exception as e:
-                print(f"Error extracting procedure {proc_type}: {str(e)}")
+        return list(functions)
     
     def _extract_procedure_data_sources(self, proc_content: str, proc_type: str) -> List[str]:
         data_sources = []
         try:
-            data_match = re.search(r'data\s*=\s*(\w+)', proc_content, re.IGNORECASE)
+            data_match = re.search(r'data\s*=\s*(\w+(?:\.\w+)?)', proc_content, re.IGNORECASE)
             if data_match:
                 data_sources.append(data_match.group(1))
             if proc_type == 'SQL':
-                from_matches = re.findall(r'from\s+(\w+)', proc_content, re.IGNORECASE)
+                from_matches = re.findall(r'\b(?:from|join)\s+(\w+(?:\.\w+)?)', proc_content, re.IGNORECASE)
                 data_sources.extend(from_matches)
         except Exception as e:
             print(f"Error extracting procedure data sources: {str(e)}")
         return list(set(data_sources))
 
+class TranslationCache:
+    """Bounded LRU memo for expression translations, with hit/miss counters for sizing"""
+    
+    def __init__(self, max_size: int = 4096):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key):
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    
+    def clear(self):
+        self._entries.clear()
+        self.hits = self.misses = self.evictions = 0
+    
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries), 'max_size': self.max_size, 'hits': self.hits,
+            'misses': self.misses, 'evictions': self.evictions,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+class MacroExpansionError(Exception):
+    pass
+
+class _GuardedArithmetic(ast.NodeTransformer):
+    """Routes ** and * in %EVAL expressions through SASMacroProcessor's bounded versions"""
+    
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        function = {ast.Pow: '_power', ast.Mult: '_multiply'}.get(type(node.op))
+        if function is None:
+            return node
+        return ast.Call(func=ast.Name(id=function, ctx=ast.Load()), args=[node.left, node.right], keywords=[])
+
+class SASMacroProcessor:
+    """Expands %LET, &var references, %MACRO invocations, %DO loops and %IF logic before parsing.
+    
+    Invocations are memoized by (macro, arguments); a memo entry records the outer macro
+    variables the expansion read and is only reused while they still hold the same values.
+    Nesting depth and total expanded size are bounded so runaway recursion fails fast.
+    """
+    
+    _trigger_re = re.compile(r"""'[^']*'|"[^"]*"|/\*.*?\*/|%\*[^;]*;|%[A-Za-z_]\w*""", re.DOTALL)
+    _ref_re = re.compile(r'&&|&([A-Za-z_]\w*)\.?')
+    _block_re = re.compile(r"""'[^']*'|/\*.*?\*/|%(do|end)\b""", re.DOTALL | re.IGNORECASE)
+    _definition_re = re.compile(r"""'[^']*'|/\*.*?\*/|%(macro|mend)\b""", re.DOTALL | re.IGNORECASE)
+    _then_re = re.compile(r'%then\b', re.IGNORECASE)
+    _else_re = re.compile(r'\s*%else\b', re.IGNORECASE)
+    _do_block_re = re.compile(r'\s*%do\s*;', re.IGNORECASE)
+    _eval_token_re = re.compile(
+        r"""\s*(?:(\d+(?:\.\d*)?(?:[eE][+-]?\d+)?)|([A-Za-z_]\w*)|('[^']*'|"[^"]*")|(<=|>=|\^=|~=|!=|\*\*|[=<>+\-*/()&|^~]))""")
+    _eval_operators = {
+        'eq': '==', 'ne': '!=', 'lt': '<', 'gt': '>', 'le': '<=', 'ge': '>=',
+        'and': 'and', 'or': 'or', 'not': 'not', '=': '==', '^=': '!=', '~=': '!=',
+        '&': 'and', '|': 'or', '^': 'not', '~': 'not'
+    }
+    _eval_nodes = (ast.Expression, ast.BoolOp, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Constant,
+                   ast.And, ast.Or, ast.Not, ast.USub, ast.UAdd, ast.Add, ast.Sub, ast.Mult, ast.Div,
+                   ast.FloorDiv, ast.Pow, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE)
+    _quoting_functions = {'str', 'nrstr', 'quote', 'nrquote', 'bquote', 'nrbquote', 'superq', 'unquote'}
+    _text_functions = {'eval', 'sysevalf', 'upcase', 'lowcase', 'length', 'substr', 'scan'}
+    _max_loop_iterations = 1000000
+    # %EVAL works on doubles, so no result needs more digits than this
+    _max_result_digits = 308
+    
+    def __init__(self, max_depth: int = 50, max_size: int = 50000000, cache_size: int = 1024):
+        self.max_depth = max_depth
+        self.max_size = max_size
+        self.expansion_cache = TranslationCache(cache_size)
+        self.reset()
+    
+    def reset(self):
+        self.macros = {}
+        self._scopes = [{}]
+        self._frames = []
+        self._expanded_size = 0
+        self.expansion_cache.clear()
+    
+    def expand(self, sas_code: str) -> str:
+        self.reset()
+        if '%' not in sas_code and '&' not in sas_code:
+            return sas_code
+        return self._expand(sas_code)
+    
+    def definitions(self) -> Dict[str, str]:
+        return {name: macro['body'].strip() for name, macro in self.macros.items()}
+    
+    def _expand(self, text: str) -> str:
+        output = []
+        pos = 0
+        length = len(text)
+        while pos < length:
+            match = self._trigger_re.search(text, pos)
+            if not match:
+                output.append(self._resolve_refs(text[pos:]))
+                break
+            output.append(self._resolve_refs(text[pos:match.start()]))
+            token = match.group(0)
+            pos = match.end()
+            
+            if token[0] == "'" or token.startswith('/*'):
+                output.append(token)
+            elif token[0] == '"':
+                output.append(self._resolve_refs(token))
+            elif not token.startswith('%*'):
+                expanded, pos = self._expand_keyword(token, text, pos)
+                output.append(expanded)
+        return ''.join(output)
+    
+    def _expand_keyword(self, token: str, text: str, pos: int) -> Tuple[str, int]:
+        name = token[1:].lower()
+        if name == 'let':
+            statement, pos = self._read_statement(text, pos)
+            variable, _, value = statement.partition('=')
+            self._assign(self._resolve_refs(variable).strip(), self._expand(value).strip())
+            return '', pos
+        if name in ('global', 'local'):
+            statement, pos = self._read_statement(text, pos)
+            scope = self._scopes[0] if name == 'global' else self._scopes[-1]
+            for variable in self._expand(statement).split():
+                scope.setdefault(variable.lower(), '')
+            return '', pos
+        if name == 'put':
+            _, pos = self._read_statement(text, pos)
+            return '', pos
+        if name == 'macro':
+            return '', self._define_macro(text, pos)
+        if name == 'do':
+            return self._expand_do(text, pos)
+        if name == 'if':
+            return self._expand_if(text, pos)
+        if name in self._text_functions or name in self._quoting_functions:
+            args, end = self._read_parenthesized(text, pos)
+            if args is None:
+                return token, pos
+            if name not in ('nrstr', 'superq'):
+                args = self._expand(args)
+            return self._macro_function(name, args), end
+        if name in self.macros:
+            return self._invoke(name, text, pos)
+        # Unknown macro or statement (%include, %sysfunc, ...) is left for the SQL translator
+        return token, pos
+    
+    def _define_macro(self, text: str, pos: int) -> int:
+        header, body_start = self._read_statement(text, pos)
+        header_match = re.match(r'\s*(\w+)\s*(?:\((.*)\))?', header, re.DOTALL)
+        if not header_match:
+            raise MacroExpansionError(f"Invalid %MACRO statement: %macro{header}")
+        
+        depth = 1
+        for match in self._definition_re.finditer(text, body_start):
+            keyword = (match.group(1) or '').lower()
+            if keyword == 'macro':
+                depth += 1
+            elif keyword == 'mend':
+                depth -= 1
+                if depth == 0:
+                    body = text[body_start:match.start()]
+                    _, end = self._read_statement(text, match.end())
+                    break
+        else:
+            raise MacroExpansionError(f"%MACRO {header_match.group(1)} has no matching %MEND")
+        
+        positional, defaults = [], {}
+        for param in self._split_args(header_match.group(2) or ''):
+            param_name, has_default, default = param.partition('=')
+            param_name = param_name.strip().lower()
+            if not param_name:
+                continue
+            if has_default:
+                defaults[param_name] = default.strip()
+            else:
+                positional.append(param_name)
+        self.macros[header_match.group(1).lower()] = {'positional': positional, 'defaults': defaults, 'body': body}
+        return end
+    
+    def _invoke(self, name: str, text: str, pos: int) -> Tuple[str, int]:
+        macro = self.macros[name]
+        args, end = self._read_parenthesized(text, pos)
+        if args is None:
+            args, end = '', pos
+        
+        values = {param: '' for param in macro['positional']}
+        values.update(macro['defaults'])
+        position = 0
+        for arg in self._split_args(args):
+            keyword_match = re.match(r'\s*(\w+)\s*=(.*)', arg, re.DOTALL)
+            if keyword_match and keyword_match.group(1).lower() in values:
+                values[keyword_match.group(1).lower()] = self._expand(keyword_match.group(2)).strip()
+            elif position < len(macro['positional']):
+                values[macro['positional'][position]] = self._expand(arg).strip()
+                position += 1
+        
+        key = (name, tuple(sorted(values.items())))
+        cached = self.expansion_cache.get(key)
+        if cached is not None and all(self._lookup(variable) == value for variable, value in cached[1]):
+            self._account(len(cached[0]))
+            return cached[0], end
+        
+        if len(self._frames) >= self.max_depth:
+            raise MacroExpansionError(f"Macro nesting exceeded {self.max_depth} levels in %{name}")
+        self._scopes.append(values)
+        frame = {'scope': len(self._scopes) - 1, 'reads': {}, 'writes_outer': False}
+        self._frames.append(frame)
+        try:
+            expanded = self._expand(macro['body'])
+        finally:
+            self._frames.pop()
+            self._scopes.pop()
+        
+        # Expansions that change outer variables have side effects and must run every time
+        if not frame['writes_outer']:
+            self.expansion_cache.put(key, (expanded, tuple(frame['reads'].items())))
+        self._account(len(expanded))
+        return expanded, end
+    
+    def _expand_do(self, text: str, pos: int) -> Tuple[str, int]:
+        header, body_start = self._read_statement(text, pos)
+        body, end = self._find_block_end(text, body_start)
+        header = header.strip()
+        if not header:
+            return self._expand(body), end
+        
+        output = []
+        condition_match = re.match(r'%(while|until)\s*\((.*)\)$', header, re.DOTALL | re.IGNORECASE)
+        if condition_match:
+            is_while = condition_match.group(1).lower() == 'while'
+            condition = condition_match.group(2)
+            for _ in range(self._max_loop_iterations):
+                if is_while and not self._evaluate(self._expand(condition)):
+                    break
+                output.append(self._account_text(self._expand(body)))
+                if not is_while and self._evaluate(self._expand(condition)):
+                    break
+            else:
+                raise MacroExpansionError(f"%DO %{condition_match.group(1).upper()} loop did not terminate")
+            return ''.join(output), end
+        
+        loop_match = re.match(r'(\w+)\s*=\s*(.+?)\s*%to\b\s*(.+?)(?:\s*%by\b\s*(.+))?$', header,
+                              re.DOTALL | re.IGNORECASE)
+        if not loop_match:
+            raise MacroExpansionError(f"Unsupported %DO statement: %do {header}")
+        variable = loop_match.group(1)
+        value = self._evaluate(self._expand(loop_match.group(2)))
+        stop = self._evaluate(self._expand(loop_match.group(3)))
+        step = self._evaluate(self._expand(loop_match.group(4))) if loop_match.group(4) else 1
+        if step == 0:
+            raise MacroExpansionError(f"%DO loop over {variable} has a zero %BY step")
+        for _ in range(self._max_loop_iterations):
+            if (step > 0 and value > stop) or (step < 0 and value < stop):
+                break
+            self._assign(variable, str(value))
+            output.append(self._account_text(self._expand(body)))
+            value = self._evaluate(self._lookup(variable) or '0') + step
+        else:
+            raise MacroExpansionError(f"%DO loop over {variable} exceeded {self._max_loop_iterations} iterations")
+        self._assign(variable, str(value))
+        return ''.join(output), end
+    
+    def _expand_if(self, text: str, pos: int) -> Tuple[str, int]:
+        then_match = self._then_re.search(text, pos)
+        if not then_match:
+            raise MacroExpansionError("%IF without %THEN")
+        is_true = self._evaluate(self._expand(text[pos:then_match.start()]))
+        action, pos = self._read_action(text, then_match.end())
+        else_action = ''
+        else_match = self._else_re.match(text, pos)
+        if else_match:
+            else_action, pos = self._read_action(text, else_match.end())
+        return self._expand(action if is_true else else_action), pos
+    
+    def _read_action(self, text: str, pos: int) -> Tuple[str, int]:
+        block_match = self._do_block_re.match(text, pos)
+        if block_match:
+            return self._find_block_end(text, block_match.end())
+        end = self._find_top_level(text, pos)
+        return text[pos:end + 1], end + 1
+    
+    def _find_block_end(self, text: str, pos: int) -> Tuple[str, int]:
+        depth = 1
+        for match in self._block_re.finditer(text, pos):
+            keyword = (match.group(1) or '').lower()
+            if keyword == 'do':
+                depth += 1
+            elif keyword == 'end':
+                depth -= 1
+                if depth == 0:
+                    _, end = self._read_statement(text, match.end())
+                    return text[pos:match.start()], end
+        raise MacroExpansionError("%DO block has no matching %END")
+    
+    def _lookup(self, name: str) -> Optional[str]:
+        name = name.lower()
+        index, value = -1, None
+        for scope_index in range(len(self._scopes) - 1, -1, -1):
+            if name in self._scopes[scope_index]:
+                index, value = scope_index, self._scopes[scope_index][name]
+                break
+        # Record reads that escape an invocation's own scope so its memo entry can be validated
+        for frame in self._frames:
+            if frame['scope'] > index:
+                frame['reads'].setdefault(name, value)
+        return value
+    
+    def _assign(self, name: str, value: str):
+        name = name.lower()
+        index = len(self._scopes) - 1
+        for scope_index in range(len(self._scopes) - 1, -1, -1):
+            if name in self._scopes[scope_index]:
+                index = scope_index
+                break
+        self._scopes[index][name] = value
+        for frame in self._frames:
+            if frame['scope'] > index:
+                frame['writes_outer'] = True
+    
+    def _resolve_refs(self, text: str) -> str:
+        # && resolves to & and is rescanned, so &&var&i takes two passes
+        for _ in range(self.max_depth):
+            if '&' not in text:
+                break
+            resolved = self._ref_re.sub(self._replace_ref, text)
+            if resolved == text:
+                break
+            text = resolved
+        return text
+    
+    def _replace_ref(self, match) -> str:
+        if match.group(1) is None:
+            return '&'
+        value = self._lookup(match.group(1))
+        return match.group(0) if value is None else value
+    
+    def _macro_function(self, name: str, args: str) -> str:
+        if name in self._quoting_functions:
+            return args
+        if name in ('eval', 'sysevalf'):
+            return str(self._evaluate(args, floating=(name == 'sysevalf')))
+        if name == 'upcase':
+            return args.upper()
+        if name == 'lowcase':
+            return args.lower()
+        if name == 'length':
+            return str(len(args))
+        parts = self._split_args(args)
+        if name == 'substr':
+            start = int(self._evaluate(parts[1])) - 1
+            if len(parts) > 2:
+                return parts[0][start:start + int(self._evaluate(parts[2]))]
+            return parts[0][start:]
+        # %scan(text, n <, delimiters>)
+        delimiters = parts[2] if len(parts) > 2 else ' .<(+&!$*);^-/,%|'
+        words = [word for word in re.split('[' + re.escape(delimiters) + ']+', parts[0]) if word]
+        index = int(self._evaluate(parts[1]))
+        index = index - 1 if index > 0 else len(words) + index
+        return words[index] if 0 <= index < len(words) else ''
+    
+    def _evaluate(self, expression: str, floating: bool = False):
+        pieces = []
+        pos = 0
+        expression = expression.strip()
+        while pos < len(expression):
+            match = self._eval_token_re.match(expression, pos)
+            if not match:
+                if not expression[pos:].strip():
+                    break
+                raise MacroExpansionError(f"Cannot evaluate macro expression: {expression}")
+            pos = match.end()
+            number, word, string, operator = match.groups()
+            if number:
+                pieces.append(number)
+            elif word:
+                pieces.append(self._eval_operators.get(word.lower(), repr(word)))
+            elif string:
+                pieces.append(repr(string))
+            elif operator == '/' and not floating:
+                pieces.append('//')
+            else:
+                pieces.append(self._eval_operators.get(operator, operator))
+        try:
+            tree = ast.parse(' '.join(pieces) or '0', mode='eval')
+            for node in ast.walk(tree):
+                if not isinstance(node, self._eval_nodes):
+                    raise ValueError(type(node).__name__)
+            tree = ast.fix_missing_locations(_GuardedArithmetic().visit(tree))
+            result = eval(compile(tree, '<macro>', 'eval'),
+                          {'__builtins__': {}, '_power': self._power, '_multiply': self._multiply}, {})
+        except Exception as e:
+            raise MacroExpansionError(f"Cannot evaluate macro expression: {expression} ({e})")
+        if isinstance(result, (bool, str)):
+            return int(bool(result))
+        return result if floating else int(result)
+    
+    @classmethod
+    def _power(cls, base, exponent):
+        # Python raises ints to any power; checked on magnitude first so 9**9**9 fails instead of hanging
+        if isinstance(base, str) or isinstance(exponent, str):
+            raise TypeError("character operand in **")
+        if abs(base) > 1 and exponent > 0 and exponent * math.log10(abs(base)) > cls._max_result_digits:
+            raise OverflowError(f"{base} ** {exponent} is out of range")
+        return base ** exponent
+    
+    @staticmethod
+    def _multiply(left, right):
+        # Strings would repeat rather than fail, building arbitrarily large values
+        if isinstance(left, str) or isinstance(right, str):
+            raise TypeError("character operand in *")
+        return left * right
+    
+    def _account(self, size: int):
+        self._expanded_size += size
+        if self._expanded_size > self.max_size:
+            raise MacroExpansionError(f"Macro expansion exceeded {self.max_size} characters")
+    
+    def _account_text(self, text: str) -> str:
+        self._account(len(text))
+        return text
+    
+    def _read_statement(self, text: str, pos: int) -> Tuple[str, int]:
+        end = self._find_top_level(text, pos)
+        return text[pos:end], min(end + 1, len(text))
+    
+    def _find_top_level(self, text: str, pos: int) -> int:
+        """Index of the next semicolon outside quotes and parentheses"""
+        depth = 0
+        length = len(text)
+        while pos < length:
+            char = text[pos]
+            if char in '\'"':
+                close = text.find(char, pos + 1)
+                pos = length if close == -1 else close + 1
+                continue
+            if char == '(':
+                depth += 1
+            elif char == ')':
+                depth = max(depth - 1, 0)
+            elif char == ';' and depth == 0:
+                return pos
+            pos += 1
+        return length
+    
+    def _read_parenthesized(self, text: str, pos: int) -> Tuple[Optional[str], int]:
+        start = pos
+        while start < len(text) and text[start] in ' \t':
+            start += 1
+        if start >= len(text) or text[start] != '(':
+            return None, pos
+        depth = 0
+        index = start
+        while index < len(text):
+            char = text[index]
+            if char in '\'"':
+                close = text.find(char, index + 1)
+                index = len(text) if close == -1 else close + 1
+                continue
+            if char == '(':
+                depth += 1
+            elif char == ')':
+                depth -= 1
+                if depth == 0:
+                    return text[start + 1:index], index + 1
+            index += 1
+        return None, pos
+    
+    def _split_args(self, args: str) -> List[str]:
+        if not args.strip():
+            return []
+        parts, current, depth = [], [], 0
+        quote = None
+        for char in args:
+            if quote:
+                if char == quote:
+                    quote = None
+            elif char in '\'"':
+                quote = char
+            elif char == '(':
+                depth += 1
+            elif char == ')':
+                depth -= 1
+            elif char == ',' and depth == 0:
+                parts.append(''.join(current))
+                current = []
+                continue
+            current.append(char)
+        parts.append(''.join(current))
+        return parts
+
 class SASFunctionTranslator:
-    def __init__(self):
+    # Quoted strings (with an optional SAS date suffix), identifiers, numbers, blanks, single characters
+    _token_re = re.compile(
+        r"""'(?:[^']|'')*'(?:[dD](?!\w))?|"(?:[^"]|"")*"(?:[dD](?!\w))?|[A-Za-z_]\w*(?:\.\w+)*|\d+\.?\d*(?:[eE][+-]?\d+)?|\s+|.""",
+        re.DOTALL)
+    _date_literal_re = re.compile(r"""['"](\d{1,2})([A-Za-z]{3})(\d{4})['"][dD]""")
+    _month_map = {
+        'JAN': '01', 'FEB': '02', 'MAR': '03', 'APR': '04',
+        'MAY': '05', 'JUN': '06', 'JUL': '07', 'AUG': '08',
+        'SEP': '09', 'OCT': '10', 'NOV': '11', 'DEC': '12'
+    }
+    
+    # Whole PROC SQL bodies are rarely repeated, only memoize expression-sized text
+    _max_cached_length = 2048
+    # Cache keys fold case and blank runs outside quoted strings, which SAS ignores there
+    _quoted_re = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+    _blank_re = re.compile(r'\s+')
+    
+    dialects = ('default', 'spark')
+    # Names may embed digits (e8601da10.), the trailing digits are the width
+    _format_re = re.compile(r'(\$?)([a-z_]+\d+[a-z_]+|[a-z_]*?)(\d*)\.(\d*)$')
+    # SAS date formats/informats and the equivalent Spark datetime patterns
+    _spark_date_patterns = {
+        'date7': 'ddMMMyy', 'date9': 'ddMMMyyyy', 'date': 'ddMMMyyyy', 'monyy7': 'MMMyyyy',
+        'yymmdd10': 'yyyy-MM-dd', 'yymmdd': 'yyyy-MM-dd', 'yymmddn8': 'yyyyMMdd', 'e8601da10': 'yyyy-MM-dd',
+        'mmddyy10': 'MM/dd/yyyy', 'mmddyy': 'MM/dd/yyyy', 'ddmmyy10': 'dd/MM/yyyy', 'ddmmyy': 'dd/MM/yyyy'
+    }
+    
+    def __init__(self, cache: TranslationCache = None, dialect: str = 'default'):
+        if dialect not in self.dialects:
+            raise ValueError(f"Unsupported SQL dialect: {dialect}")
+        self.cache = cache
+        self.dialect = dialect
+        self.type_inferrer = SASTypeInferrer(dialect)
         self.function_map = {
             'put': self._translate_put, 'input': self._translate_input, 'substr': self._translate_substr,
             'strip': self._translate_strip, 'compress': self._translate_compress, 'intck': self._translate_intck,
@@ -292,121 +1299,544 @@ class SASFunctionTranslator:
             'month': self._translate_month, 'day': self._translate_day, 'nmiss': self._translate_nmiss,
             'std': self._translate_std, 'var': self._translate_var
         }
+        if dialect == 'spark':
+            # Spark built-ins only, so generated jobs need no Python UDFs and keep whole-stage codegen
+            self.function_map.update({
+                'put': self._translate_put_spark, 'input': self._translate_input_spark,
+                'compress': self._translate_compress_spark, 'intck': self._translate_intck_spark,
+                'intnx': self._translate_intnx_spark, 'today': self._translate_today_spark,
+                'day': self._translate_day_spark, 'std': self._translate_std_spark
+            })
+    
+    def translate(self, expression: str, operators: Dict[str, str] = None) -> str:
+        """Rewrite date literals, SAS functions and (optionally) SAS operators in one pass"""
+        if self.cache is None or len(expression) > self._max_cached_length:
+            return self._rewrite(expression, operators)
+        # The cache may be shared by translators for different dialects
+        key = (self.dialect, self._cache_text(expression), operators is not None)
+        translated = self.cache.get(key)
+        if translated is None:
+            translated = self._rewrite(expression, operators)
+            self.cache.put(key, translated)
+        return translated
     
-    def translate(self, expression: str) -> str:
-        # Convert SAS date literals first
-        expression = self._convert_sas_date_literals(expression)
+    def _cache_text(self, expression: str) -> str:
+        pieces = self._quoted_re.split(expression)
+        # Odd pieces are the quoted strings, kept as written
+        pieces[::2] = [self._blank_re.sub(' ', piece).lower() for piece in pieces[::2]]
+        return ''.join(pieces)
+    
+    def _rewrite(self, expression: str, operators: Dict[str, str] = None) -> str:
+        tokens = self._token_re.findall(expression)
+        operators = operators or {}
+        function_map = self.function_map
         
-        for sas_func, translator in self.function_map.items():
-            pattern = r'\b' + sas_func + r'\s*\('
-            if re.search(pattern, expression, re.IGNORECASE):
-                expression = self._translate_function(expression, sas_func, translator)
-        return expression
+        # Each frame is [translator, name, finished_args, current_pieces]; the bottom frame
+        # collects the output and plain parentheses get a frame without a translator
+        stack = [[None, None, [], []]]
+        count = len(tokens)
+        i = 0
+        while i < count:
+            token = tokens[i]
+            frame = stack[-1]
+            first = token[0]
+            
+            if first.isalpha() or first == '_':
+                lower = token.lower()
+                translator = function_map.get(lower)
+                if translator is not None:
+                    j = i + 1
+                    while j < count and tokens[j].isspace():
+                        j += 1
+                    if j < count and tokens[j] == '(':
+                        stack.append([translator, token, [], []])
+                        i = j + 1
+                        continue
+                frame[3].append(operators.get(lower, token))
+            elif first in ('\'', '"'):
+                if token[-1] in 'dD' and len(token) > 2:
+                    token = self._convert_sas_date_literals(token)
+                frame[3].append(token)
+            elif token == '(':
+                stack.append([None, None, [], ['(']])
+            elif token == ',' and frame[0] is not None:
+                frame[2].append(''.join(frame[3]))
+                frame[3] = []
+            elif token == ')' and len(stack) > 1:
+                stack.pop()
+                if frame[0] is None:
+                    frame[3].append(')')
+                    stack[-1][3].append(''.join(frame[3]))
+                else:
+                    stack[-1][3].append(self._apply_translator(frame))
+            else:
+                frame[3].append(token)
+            i += 1
+        
+        # Unbalanced input: emit whatever is still open unchanged
+        while len(stack) > 1:
+            frame = stack.pop()
+            text = ''.join(frame[3])
+            if frame[0] is not None:
+                text = f"{frame[1]}(" + ','.join(frame[2] + [text])
+            stack[-1][3].append(text)
+        return ''.join(stack[0][3])
+    
+    def _apply_translator(self, frame: List) -> str:
+        translator, name, args, current = frame
+        args = args + [''.join(current)]
+        try:
+            return translator([arg.strip() for arg in args if arg.strip()])
+        except ValueError as e:
+            # The call can't be expressed in this dialect: keep it, and say why next to it
+            note = str(e).replace('*/', '* /')
+            return f"{name}({','.join(args)}) /* Note: {note} */"
+        except:
+            return f"{name}({','.join(args)})"
     
     def _convert_sas_date_literals(self, expression: str) -> str:
         """Convert SAS date literals like '01JAN2024'd to SQL date format"""
-        # Pattern for SAS date literals: 'ddmmmyyyy'd
-        pattern = r"'(\d{2}[A-Z]{3}\d{4})'d"
-        
         def convert_date(match):
-            sas_date = match.group(1)
             # Convert to SQL date format: 'yyyy-mm-dd'
-            day = sas_date[:2]
-            month = sas_date[2:5].upper()
-            year = sas_date[5:]
-            
-            month_map = {
-                'JAN': '01', 'FEB': '02', 'MAR': '03', 'APR': '04',
-                'MAY': '05', 'JUN': '06', 'JUL': '07', 'AUG': '08',
-                'SEP': '09', 'OCT': '10', 'NOV': '11', 'DEC': '12'
-            }
-            
-            sql_month = month_map.get(month, '01')
-            sql_date = f"'{year}-{sql_month}-{day}'"
-            return sql_date
+            day = match.group(1).zfill(2)
+            month = match.group(2).upper()
+            year = match.group(3)
+            sql_month = self._month_map.get(month, '01')
+            if self.dialect == 'spark':
+                # A typed literal keeps the comparison on the date column, so Parquet can push it down
+                return f"DATE'{year}-{sql_month}-{day}'"
+            return f"'{year}-{sql_month}-{day}'"
         
-        return re.sub(pattern, convert_date, expression, flags=re.IGNORECASE)
+        return self._date_literal_re.sub(convert_date, expression)
     
-    def _translate_function(self, expression: str, sas_func: str, translator) -> str:
-        pattern = r'(\b' + sas_func + r'\s*\()(.*?)(\))'
-        def replace_func(match):
-            full_match = match.group(0)
-            inner_args = match.group(2)
-            try:
-                return translator(inner_args)
-            except:
-                return full_match
-        return re.sub(pattern, replace_func, expression, flags=re.IGNORECASE)
-    
-    def _translate_put(self, args: str) -> str:
-        parts = [part.strip() for part in args.split(',')]
-        if len(parts) >= 2:
-            return f"CAST({parts[0]} AS VARCHAR)"
-        return f"CAST({args} AS VARCHAR)"
-    
-    def _translate_input(self, args: str) -> str:
-        parts = [part.strip() for part in args.split(',')]
-        if len(parts) >= 2:
-            return f"CAST({parts[0]} AS NUMERIC)"
-        return f"CAST({args} AS NUMERIC)"
-    
-    def _translate_substr(self, args: str) -> str:
-        parts = [part.strip() for part in args.split(',')]
-        if len(parts) >= 3:
-            return f"SUBSTRING({parts[0]}, {parts[1]}, {parts[2]})"
-        elif len(parts) == 2:
-            return f"SUBSTRING({parts[0]}, {parts[1]})"
-        return f"SUBSTRING({args})"
-    
-    def _translate_strip(self, args: str) -> str:
-        return f"TRIM({args})"
-    
-    def _translate_compress(self, args: str) -> str:
-        parts = [part.strip() for part in args.split(',')]
-        if len(parts) >= 2:
-            return f"REPLACE({parts[0]}, {parts[1]}, '')"
-        return f"REPLACE({args}, ' ', '')"
-    
-    def _translate_intck(self, args: str) -> str:
-        parts = [part.strip() for part in args.split(',')]
-        if len(parts) >= 3:
-            return f"DATEDIFF({parts[0]}, {parts[1]}, {parts[2]})"
-        return f"DATEDIFF(day, {args})"
-    
-    def _translate_intnx(self, args: str) -> str:
-        parts = [part.strip() for part in args.split(',')]
-        if len(parts) >= 3:
-            return f"DATEADD({parts[0]}, {parts[1]}, {parts[2]})"
-        return f"DATEADD(day, {args})"
-    
-    def _translate_today(self, args: str) -> str:
+    def _translate_put(self, args: List[str]) -> str:
+        parsed = self._parse_format(args[1]) if len(args) >= 2 else None
+        if parsed and parsed[2] and (parsed[0] or parsed[1] in SASTypeInferrer._numeric_informats):
+            # The format width is the width of the text PUT returns; date and time values cast
+            # to ISO text, which is wider than their SAS format, so those keep every character
+            return f"CAST({args[0]} AS VARCHAR({parsed[2]}))"
+        return f"CAST({args[0]} AS VARCHAR)"
+    
+    def _translate_input(self, args: List[str]) -> str:
+        kind = self.type_inferrer.format_kind(args[1]) if len(args) >= 2 else None
+        if kind and (kind[0] != 'char' or kind[1]):
+            return f"CAST({args[0]} AS {self.type_inferrer.cast_type(kind)})"
+        return f"CAST({args[0]} AS NUMERIC)"
+    
+    def _translate_substr(self, args: List[str]) -> str:
+        return f"SUBSTRING({', '.join(args[:3])})"
+    
+    def _translate_strip(self, args: List[str]) -> str:
+        return f"TRIM({args[0]})"
+    
+    def _translate_compress(self, args: List[str]) -> str:
+        if len(args) >= 2:
+            return f"REPLACE({args[0]}, {args[1]}, '')"
+        return f"REPLACE({args[0]}, ' ', '')"
+    
+    def _translate_intck(self, args: List[str]) -> str:
+        if len(args) >= 3:
+            return f"DATEDIFF({args[0]}, {args[1]}, {args[2]})"
+        return f"DATEDIFF(day, {', '.join(args)})"
+    
+    def _translate_intnx(self, args: List[str]) -> str:
+        if len(args) >= 3:
+            return f"DATEADD({args[0]}, {args[1]}, {args[2]})"
+        return f"DATEADD(day, {', '.join(args)})"
+    
+    def _translate_today(self, args: List[str]) -> str:
         return "CURRENT_DATE"
     
-    def _translate_year(self, args: str) -> str:
-        return f"YEAR({args})"
+    def _translate_year(self, args: List[str]) -> str:
+        return f"YEAR({args[0]})"
+    
+    def _translate_month(self, args: List[str]) -> str:
+        return f"MONTH({args[0]})"
+    
+    def _translate_day(self, args: List[str]) -> str:
+        return f"DAY({args[0]})"
+    
+    def _translate_nmiss(self, args: List[str]) -> str:
+        return f"COUNT(CASE WHEN {args[0]} IS NULL THEN 1 END)"
+    
+    def _translate_std(self, args: List[str]) -> str:
+        return f"STDDEV({', '.join(args)})"
+    
+    def _translate_var(self, args: List[str]) -> str:
+        return f"VARIANCE({', '.join(args)})"
+    
+    def _literal(self, arg: str) -> Optional[str]:
+        """Lower-cased value of a quoted string argument, None for anything else"""
+        if len(arg) >= 2 and arg[0] == arg[-1] and arg[0] in ('\'', '"'):
+            return arg[1:-1].replace(arg[0] * 2, arg[0]).strip().lower()
+        return None
+    
+    def _parse_format(self, fmt: str) -> Optional[Tuple[str, str, str, str]]:
+        """(char_flag, name, width, decimals) of a SAS format such as $10., date9. or 8.2"""
+        format_match = self._format_re.match(fmt.replace(' ', '').lower())
+        return format_match.groups() if format_match else None
+    
+    def _spark_date_pattern(self, name: str, width: str) -> Optional[str]:
+        return self._spark_date_patterns.get(name + width) or self._spark_date_patterns.get(name)
     
-    def _translate_month(self, args: str) -> str:
-        return f"MONTH({args})"
+    def _translate_put_spark(self, args: List[str]) -> str:
+        parsed = self._parse_format(args[1]) if len(args) >= 2 else None
+        if parsed and not parsed[0]:
+            _, name, width, decimals = parsed
+            pattern = self._spark_date_pattern(name, width)
+            if pattern:
+                formatted = f"date_format({args[0]}, '{pattern}')"
+                # SAS prints month abbreviations in upper case
+                return f"upper({formatted})" if 'MMM' in pattern else formatted
+            if name == 'z' and width:
+                return f"lpad(CAST(CAST(round({args[0]}) AS BIGINT) AS STRING), {width}, '0')"
+            if not name and decimals:
+                return f"format_string('%.{decimals}f', {args[0]})"
+            if not name and width:
+                return f"CAST(CAST(round({args[0]}) AS BIGINT) AS STRING)"
+        return f"CAST({args[0]} AS STRING)"
     
-    def _translate_day(self, args: str) -> str:
-        return f"DAY({args})"
+    def _translate_input_spark(self, args: List[str]) -> str:
+        parsed = self._parse_format(args[1]) if len(args) >= 2 else None
+        if parsed:
+            char_flag, name, width, decimals = parsed
+            if char_flag:
+                return f"CAST({args[0]} AS STRING)"
+            pattern = self._spark_date_pattern(name, width)
+            if pattern:
+                return f"to_date({args[0]}, '{pattern}')"
+            kind = self.type_inferrer.format_kind(args[1])
+            if kind and kind[0] == 'decimal':
+                return f"CAST({args[0]} AS {self.type_inferrer.cast_type(kind)})"
+        return f"CAST({args[0]} AS DOUBLE)"
     
-    def _translate_nmiss(self, args: str) -> str:
-        return f"COUNT(CASE WHEN {args} IS NULL THEN 1 END)"
+    def _translate_compress_spark(self, args: List[str]) -> str:
+        if len(args) >= 2:
+            # translate() drops characters that have no replacement
+            return f"translate({args[0]}, {args[1]}, '')"
+        return f"regexp_replace({args[0]}, ' ', '')"
     
-    def _translate_std(self, args: str) -> str:
-        return f"STDDEV({args})"
+    def _translate_intck_spark(self, args: List[str]) -> str:
+        # INTCK counts interval boundaries crossed between the two dates
+        interval = self._literal(args[0]) if len(args) >= 3 else None
+        if interval is None:
+            start, end = args[-2], args[-1]
+            return f"datediff({end}, {start})"
+        start, end = args[1], args[2]
+        if interval == 'day':
+            return f"datediff({end}, {start})"
+        if interval == 'week':
+            return f"((datediff({end}, {start}) + dayofweek({start}) - dayofweek({end})) div 7)"
+        if interval == 'month':
+            return f"((year({end}) - year({start})) * 12 + month({end}) - month({start}))"
+        if interval == 'qtr':
+            return f"((year({end}) - year({start})) * 4 + quarter({end}) - quarter({start}))"
+        if interval == 'year':
+            return f"(year({end}) - year({start}))"
+        raise ValueError(f"Unsupported INTCK interval: {interval}")
     
-    def _translate_var(self, args: str) -> str:
-        return f"VARIANCE({args})"
+    def _translate_intnx_spark(self, args: List[str]) -> str:
+        # INTNX moves by whole intervals and aligns to the interval's beginning unless told otherwise
+        interval = self._literal(args[0]) if len(args) >= 3 else None
+        if interval is None:
+            return f"date_add({args[-2]}, {args[-1]})"
+        start, increment = args[1], args[2]
+        alignment = (self._literal(args[3]) or 'b')[:1] if len(args) >= 4 else 'b'
+        if interval == 'day':
+            return f"date_add({start}, {increment})"
+        if interval == 'week':
+            if alignment == 's':
+                return f"date_add({start}, 7 * ({increment}))"
+            beginning = f"date_add(date_sub({start}, dayofweek({start}) - 1), 7 * ({increment}))"
+            return f"date_add({beginning}, 6)" if alignment == 'e' else beginning
+        months_per_interval = {'month': 1, 'qtr': 3, 'year': 12}.get(interval)
+        if months_per_interval is None:
+            raise ValueError(f"Unsupported INTNX interval: {interval}")
+        months = increment if months_per_interval == 1 else f"{months_per_interval} * ({increment})"
+        if alignment == 's':
+            return f"add_months({start}, {months})"
+        unit = {'month': 'MM', 'qtr': 'QUARTER', 'year': 'YEAR'}[interval]
+        beginning = f"add_months(trunc({start}, '{unit}'), {months})"
+        if alignment == 'e':
+            if months_per_interval == 1:
+                return f"last_day({beginning})"
+            return f"date_sub(add_months({beginning}, {months_per_interval}), 1)"
+        return beginning
+    
+    def _translate_today_spark(self, args: List[str]) -> str:
+        return "current_date()"
+    
+    def _translate_day_spark(self, args: List[str]) -> str:
+        return f"dayofmonth({args[0]})"
+    
+    def _translate_std_spark(self, args: List[str]) -> str:
+        return f"stddev_samp({', '.join(args)})"
+
+class SASTypeInferrer:
+    """Narrowest SQL column types for SAS variables.
+    
+    INPUT/INFORMAT informats and LENGTH statements say how values are read and stored,
+    DATALINES rows refine numeric precision and character widths (a number is only an integer
+    type once every row shows it is one), and FORMAT statements are only used when nothing
+    else is known. Types are kept as small tuples ('char', width), ('int', digits),
+    ('decimal', precision, scale), ('double',), ('date', informat) and ('timestamp', informat)
+    until they are rendered for a dialect.
+    """
+    _date_informats = {
+        'date': ('%d%b%Y', '%d%b%y'), 'monyy': ('%b%Y', '%b%y'),
+        'mmddyy': ('%m%d%Y', '%m%d%y'), 'ddmmyy': ('%d%m%Y', '%d%m%y'),
+        'yymmdd': ('%Y%m%d', '%y%m%d'), 'yymmddn': ('%Y%m%d', '%y%m%d'), 'e8601da': ('%Y%m%d',),
+        'anydtdte': ()
+    }
+    _datetime_informats = {'datetime': ('%d%b%Y%H%M%S', '%d%b%y%H%M%S'), 'e8601dt': ('%Y%m%dT%H%M%S',),
+                           'anydtdtm': ()}
+    _numeric_informats = {'', 'f', 'comma', 'commax', 'dollar', 'dollarx', 'nlnum', 'z'}
+    # Years written with two digits fall in the 100 years starting here (SAS YEARCUTOFF)
+    _year_cutoff = 1926
+    # Most decimal digits each integer type always holds
+    _integer_types = ((4, 'SMALLINT'), (9, 'INTEGER'), (18, 'BIGINT'))
+    _missing_re = re.compile(r'\.[A-Za-z_]?')
+    # Values that can be written as SQL numeric literals (not nan, inf, infinity or 1_000)
+    _decimal_literal_re = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+    _plain_number_re = re.compile(r'[+-]?(\d*)\.?(\d*)')
+    _date_separator_re = re.compile(r'[-/.:\s]')
+    
+    def __init__(self, dialect: str = 'default'):
+        self.dialect = dialect
+    
+    def format_kind(self, fmt: str) -> Optional[Tuple]:
+        """Type of a value read with an informat, or shown with a format, such as $10., 8.2 or date9."""
+        fmt = fmt.replace(' ', '').lower()
+        if fmt == '$':
+            return ('char', None)
+        format_match = SASFunctionTranslator._format_re.match(fmt)
+        if not format_match:
+            return None
+        char_flag, name, width, decimals = format_match.groups()
+        width = int(width) if width else None
+        if char_flag:
+            return ('char', width)
+        if name in self._date_informats:
+            return ('date', name)
+        if name in self._datetime_informats:
+            return ('timestamp', name)
+        if name in self._numeric_informats:
+            if decimals and int(decimals):
+                return ('decimal', max(width or 0, int(decimals) + 1), int(decimals))
+            # w. still reads decimals written in the data; only samples can show it holds integers
+            return ('double',)
+        if name in ('best', 'percent', 'e'):
+            return ('double',)
+        return None
+    
+    def sql_type(self, kind: Tuple) -> str:
+        """DDL type for a kind"""
+        spark = self.dialect == 'spark'
+        if kind[0] == 'char':
+            return f"VARCHAR({kind[1] or 8})"
+        if kind[0] == 'int':
+            for digits, name in self._integer_types:
+                if kind[1] <= digits:
+                    return 'INT' if spark and name == 'INTEGER' else name
+            return f"DECIMAL({min(kind[1], 38)}, 0)"
+        if kind[0] == 'decimal':
+            return f"DECIMAL({min(kind[1], 38)}, {kind[2]})"
+        if kind[0] == 'double':
+            return 'DOUBLE' if spark else 'DOUBLE PRECISION'
+        return kind[0].upper()
+    
+    def cast_type(self, kind: Tuple) -> str:
+        """CAST target for a kind; Spark only has unbounded strings outside table schemas"""
+        if kind[0] == 'char' and self.dialect == 'spark':
+            return 'STRING'
+        return self.sql_type(kind)
+    
+    def infer(self, operations: Dict, frame: Optional[pd.DataFrame] = None) -> Dict[str, Tuple]:
+        """Kinds of a data step's INPUT variables and every variable it declares, refined by its DATALINES rows"""
+        informats = self._parse_declarations(operations.get('informat', []))
+        informats.update(operations.get('input_informats', {}))
+        lengths = self.declared_lengths(operations)
+        formats = self._parse_declarations(operations.get('format', []))
+        
+        kinds = {}
+        input_vars = operations.get('input', [])
+        for column in list(dict.fromkeys(input_vars + list(informats) + list(lengths) + list(formats))):
+            kind = self.format_kind(informats[column]) if column in informats else None
+            if kind is None and column in input_vars:
+                # List input reads anything without a $ as a number
+                kind = ('double',)
+            if column in lengths and lengths[column][0] == 'char':
+                kind = lengths[column]
+            if frame is not None and column in frame.columns and kind is not None:
+                kind = self._sample_kind(frame[column], kind)
+            if kind is None and column in formats:
+                kind = self.format_kind(formats[column])
+            if kind is not None:
+                kinds[column] = kind
+        return kinds
+    
+    def normalize(self, frame: pd.DataFrame, kinds: Dict[str, Tuple]) -> Dict[str, List[Optional[str]]]:
+        """DATALINES columns as SQL literal text: None for missing, ISO dates, numbers only where valid.
+        
+        Each distinct value is converted once and the results mapped back onto the column, which
+        keeps both long reference tables and many tiny DATALINES blocks cheap.
+        """
+        normalized = {}
+        for column in frame.columns:
+            values = frame[column].tolist()
+            kind = kinds.get(column, ('char', None))
+            distinct = [value for value in set(values) if not self._missing_re.fullmatch(value)]
+            if kind[0] == 'char':
+                # Values longer than the variable are truncated, as SAS stores them
+                converted = [value[:kind[1]] if kind[1] else value for value in distinct]
+            elif kind[0] in ('date', 'timestamp'):
+                converted = self._parse_dates(distinct, kind)
+            else:
+                # Invalid numbers are read as missing
+                converted = [value.lstrip('+') if self._is_number(value) else None for value in distinct]
+            lookup = dict(zip(distinct, converted))
+            normalized[column] = [lookup.get(value) for value in values]
+        return normalized
+    
+    def typed_frame(self, normalized: Dict[str, List[Optional[str]]], kinds: Dict[str, Tuple]) -> pd.DataFrame:
+        """Normalized DATALINES values converted to typed columns, for self-describing files"""
+        typed = {}
+        for column, values in normalized.items():
+            kind = kinds.get(column, ('char', None))
+            values = pd.Series(values, dtype=object)
+            if kind[0] == 'int' and kind[1] <= 18:
+                typed[column] = pd.to_numeric(values).astype('Int64')
+            elif kind[0] in ('int', 'decimal', 'double'):
+                typed[column] = pd.to_numeric(values).astype('float64')
+            elif kind[0] == 'date':
+                typed[column] = pd.to_datetime(values).dt.date
+            elif kind[0] == 'timestamp':
+                typed[column] = pd.to_datetime(values)
+            else:
+                typed[column] = values
+        return pd.DataFrame(typed)
+    
+    def _is_number(self, value: str) -> bool:
+        return self._decimal_literal_re.fullmatch(value) is not None
+    
+    def _sample_kind(self, values: pd.Series, kind: Tuple) -> Tuple:
+        present = [value for value in set(values.tolist()) if not self._missing_re.fullmatch(value)]
+        if kind[0] == 'char':
+            if kind[1] is None:
+                return ('char', max(map(len, present))) if present else ('char', 8)
+            return kind
+        if kind[0] not in ('int', 'double', 'decimal') or not present:
+            return kind
+        integer_digits = scale = 0
+        numbers = False
+        for value in present:
+            number_match = self._plain_number_re.fullmatch(value)
+            if number_match and (number_match.group(1) or number_match.group(2)):
+                integer_digits = max(integer_digits, len(number_match.group(1).lstrip('0')))
+                scale = max(scale, len(number_match.group(2)))
+                numbers = True
+            elif self._is_number(value):
+                # Exponent notation leaves no exact precision to infer
+                return ('double',)
+            # Anything else is invalid data, read as missing
+        if not numbers:
+            return kind
+        if kind[0] == 'decimal':
+            integer_digits = max(integer_digits, kind[1] - kind[2])
+            scale = max(scale, kind[2])
+        if not scale:
+            return ('int', max(integer_digits, 1))
+        if integer_digits + scale > 38:
+            return ('double',)
+        return ('decimal', integer_digits + scale, scale)
+    
+    def _parse_dates(self, values: List[str], kind: Tuple) -> List[Optional[str]]:
+        informats = self._date_informats if kind[0] == 'date' else self._datetime_informats
+        patterns = informats.get(kind[1], ())
+        text_format = '%Y-%m-%d' if kind[0] == 'date' else '%Y-%m-%d %H:%M:%S'
+        if not patterns:
+            parsed = pd.to_datetime(pd.Series(values, dtype=object), format='mixed', errors='coerce')
+            return [None if pd.isna(value) else value.strftime(text_format) for value in parsed]
+        # Patterns have fixed widths; a one-digit leading day or month is padded to fit
+        widths = [(pattern, len(datetime(2000, 12, 28, 10, 10, 10).strftime(pattern))) for pattern in patterns]
+        converted = []
+        for value in values:
+            compact = self._date_separator_re.sub('', value).upper()
+            result = None
+            for pattern, width in widths:
+                candidate = '0' + compact if len(compact) == width - 1 else compact
+                if len(candidate) != width:
+                    continue
+                try:
+                    parsed = datetime.strptime(candidate, pattern)
+                except ValueError:
+                    continue
+                if '%y' in pattern and parsed.year >= self._year_cutoff + 100:
+                    # Two-digit years follow SAS YEARCUTOFF rather than Python's 1969 pivot
+                    parsed = parsed.replace(year=parsed.year - 100)
+                result = parsed.strftime(text_format)
+                break
+            converted.append(result)
+        return converted
+    
+    def _parse_declarations(self, tokens: List[str]) -> Dict[str, str]:
+        """FORMAT/INFORMAT statement tokens ('a b date9. c $10.') to {variable: format}"""
+        declared = {}
+        pending = []
+        for token in tokens:
+            if '.' in token:
+                declared.update((variable, token.lower()) for variable in pending)
+                pending = []
+            elif re.fullmatch(r'[A-Za-z_]\w*', token):
+                pending.append(token)
+        return declared
+    
+    def declared_lengths(self, operations: Dict) -> Dict[str, Tuple]:
+        """LENGTH statements ('name $ 20 amount 8', 'a b $10') as {variable: kind}"""
+        lengths = {}
+        pending = []
+        char = False
+        for token in operations.get('length', []):
+            length_match = re.fullmatch(r'(\$?)(\d+)\.?', token)
+            if token == '$':
+                char = True
+            elif length_match:
+                char = char or bool(length_match.group(1))
+                for variable in pending:
+                    # Numeric lengths only change storage bytes, not the SQL type
+                    lengths[variable] = ('char', int(length_match.group(2))) if char else ('double',)
+                pending, char = [], False
+            elif re.fullmatch(r'[A-Za-z_]\w*', token):
+                pending.append(token)
+        return lengths
 
 class SASToSQLTranslator:
-    def __init__(self):
+    # PROC MEANS statistic -> (AUTONAME suffix, SQL aggregate)
+    _means_statistics = {
+        'n': ('N', 'COUNT({0})'), 'nmiss': ('NMiss', 'COUNT(*) - COUNT({0})'), 'mean': ('Mean', 'AVG({0})'),
+        'std': ('StdDev', 'STDDEV_SAMP({0})'), 'stddev': ('StdDev', 'STDDEV_SAMP({0})'), 'var': ('Var', 'VAR_SAMP({0})'),
+        'min': ('Min', 'MIN({0})'), 'max': ('Max', 'MAX({0})'), 'sum': ('Sum', 'SUM({0})'),
+        'range': ('Range', 'MAX({0}) - MIN({0})'), 'uss': ('USS', 'SUM({0} * {0})'),
+        'css': ('CSS', 'VAR_SAMP({0}) * (COUNT({0}) - 1)'), 'stderr': ('StdErr', 'STDDEV_SAMP({0}) / SQRT(COUNT({0}))'),
+        'cv': ('CV', '100 * STDDEV_SAMP({0}) / AVG({0})'),
+    }
+    # SAS condition tokens: quoted strings whole, so nothing inside them reads as a flag or AND
+    _flag_token_re = re.compile(r"""'(?:[^']|'')*'?|"(?:[^"]|"")*"?|\w+|\s+|\S""")
+    
+    def __init__(self, cache: TranslationCache = None, dialect: str = 'default', insert_batch_size: int = 1000):
         self.sas_sql_mapping = {
             'eq': '=', 'ne': '<>', 'gt': '>', 'lt': '<', 'ge': '>=', 'le': '<=',
             'and': 'AND', 'or': 'OR', 'not': 'NOT', 'in': 'IN'
         }
-        self.function_translator = SASFunctionTranslator()
+        self.dialect = dialect
+        self.function_translator = SASFunctionTranslator(cache, dialect)
+        # Rows per multi-row INSERT for DATALINES data
+        self.insert_batch_size = max(insert_batch_size, 1)
+        self.type_inferrer = SASTypeInferrer(dialect)
+        # Known distinct values by lower-cased table and column name, for PROC TRANSPOSE ID columns
+        self.column_values = {}
+        # (position, [(column, descending)]) of the PROC SORT steps writing each table
+        self.sort_orders = {}
     
     def translate_data_step(self, data_step: Dict) -> str:
         try:
@@ -430,26 +1860,26 @@ class SASToSQLTranslator:
             select_clause = self._build_select_clause(operations)
             from_clause = self._build_from_clause(source_tables)
             where_clause = self._build_where_clause(operations)
-            group_by_clause = self._build_group_by_clause(operations)
-            calculated_fields = self._build_calculated_fields(operations)
             
             sql = f"SELECT {select_clause}"
-            
-            if calculated_fields:
-                sql += f", {calculated_fields}"
-            
             sql += f"\nFROM {from_clause}"
             
             if where_clause:
                 sql += f"\nWHERE {where_clause}"
-            if group_by_clause:
-                sql += f"\nGROUP BY {group_by_clause}"
             
             return sql
         except Exception as e:
             return f"-- Error translating data step {data_step.get('table_name', 'unknown')}: {str(e)}"
     
     def _translate_merge_step(self, data_step: Dict) -> str:
+        """MERGE ... BY as a chain of joins USING the BY variables.
+        
+        Each dataset is joined under its IN= flag name, or a, b, ... without one. Subsetting IF
+        conditions that only test IN= flags choose the joins: datasets that must contribute are
+        inner joined first, datasets that must not are anti-joined and the rest are left joined,
+        or full joined when no dataset is required. A flag condition that doesn't fit that shape
+        (IF A OR B over three datasets) filters a full join on which datasets have the BY value.
+        """
         try:
             table_name = data_step['table_name']
             operations = data_step['operations']
@@ -462,28 +1892,157 @@ class SASToSQLTranslator:
             if not by_vars:
                 return f"-- MERGE requires BY statement: {table_name}"
             
-            join_conditions = []
-            for by_var in by_vars:
-                join_conditions.append(f"a.{by_var} = b.{by_var}")
-            join_condition = " AND ".join(join_conditions)
+            options = operations.get('dataset_options', {})
+            flags = [options.get(table, {}).get('in') for table in source_tables]
+            taken = {flag.lower() for flag in flags if flag}
+            letters = [chr(code) for code in range(ord('a'), ord('z') + 1)]
+            spare = [name for name in letters + [f"t{number}" for number in range(1, len(flags) + 1)]
+                     if name not in taken]
+            aliases = [flag or spare.pop(0) for flag in flags]
+            # Flag name -> SQL test for "this dataset has the BY value"
+            presence = {flag.lower(): f"{alias}.{by_vars[0]} IS NOT NULL"
+                        for flag, alias in zip(flags, aliases) if flag}
+            
+            flag_trees, conditions = [], []
+            for condition in operations.get('if', []):
+                for conjunct in self._split_sas_conjuncts(condition.rstrip(';').strip()):
+                    tree = self._parse_flag_condition(conjunct, set(presence))
+                    if tree is not None:
+                        flag_trees.append(tree)
+                    else:
+                        conditions.append(self._translate_condition(self._replace_flags(conjunct, presence)))
+            conditions[:0] = [self._translate_condition(condition) for condition in operations.get('where', [])]
             
-            where_conditions = []
-            if "a and b" in data_step['content'].lower():
-                where_conditions.append("a.acct_num IS NOT NULL AND b.acct_num IS NOT NULL")
+            joins = ['full'] * len(source_tables)
+            if flag_trees:
+                names = sorted(presence)
+                combinations = [{name: bool(number >> bit & 1) for bit, name in enumerate(names)}
+                                for number in range(2 ** len(names))]
+                satisfied = [combination for combination in combinations
+                             if all(self._flag_value(tree, combination) for tree in flag_trees)]
+                required = {name for name in names if satisfied and all(c[name] for c in satisfied)}
+                excluded = {name for name in names if satisfied and not any(c[name] for c in satisfied)}
+                free = len(names) - len(required) - len(excluded)
+                if satisfied and len(satisfied) == 2 ** free and len(excluded) < len(source_tables):
+                    for position, flag in enumerate(flags):
+                        if flag and flag.lower() in required:
+                            joins[position] = 'inner'
+                        elif flag and flag.lower() in excluded:
+                            joins[position] = 'anti'
+                        elif required:
+                            joins[position] = 'left'
+                else:
+                    # Rows come from a full join and the condition is checked on what each dataset supplied
+                    conditions[:0] = [self._flag_sql(tree, presence) for tree in flag_trees]
             
+            # Required datasets drive the join, anti-joined ones come last
+            rank = {'inner': 0, 'left': 1, 'full': 1, 'anti': 2}
+            order = sorted(range(len(source_tables)), key=lambda position: rank[joins[position]])
+            keywords = {'inner': 'INNER JOIN', 'left': 'LEFT JOIN', 'full': 'FULL JOIN', 'anti': 'LEFT JOIN'}
+            using = ", ".join(by_vars)
             select_clause = self._build_select_clause(operations)
-            if select_clause == "*":
-                select_clause = "a.*, b.*"
             
-            sql = f"SELECT {select_clause}\nFROM {source_tables[0]} a\nINNER JOIN {source_tables[1]} b ON {join_condition}"
-            
-            if where_conditions:
-                sql += f"\nWHERE {' AND '.join(where_conditions)}"
+            sql = f"SELECT {select_clause}\nFROM {source_tables[order[0]]} {aliases[order[0]]}"
+            for position in order[1:]:
+                sql += f"\n{keywords[joins[position]]} {source_tables[position]} {aliases[position]} USING ({using})"
+            conditions[:0] = [f"{aliases[position]}.{by_vars[0]} IS NULL" for position in order
+                              if joins[position] == 'anti']
+            if conditions:
+                sql += f"\nWHERE {' AND '.join(conditions)}"
             
             return sql
         except Exception as e:
             return f"-- Error translating merge step: {str(e)}"
     
+    def _split_sas_conjuncts(self, condition: str) -> List[str]:
+        # Top-level AND / & only
+        conjuncts = [[]]
+        depth = 0
+        for token in self._flag_token_re.findall(condition):
+            if token == '(':
+                depth += 1
+            elif token == ')':
+                depth -= 1
+            elif depth == 0 and token.lower() in ('and', '&'):
+                conjuncts.append([])
+                continue
+            conjuncts[-1].append(token)
+        return [''.join(conjunct).strip() for conjunct in conjuncts if ''.join(conjunct).strip()]
+    
+    def _parse_flag_condition(self, condition: str, flags: Set[str]) -> Optional[Tuple]:
+        """('flag', name) / ('not', x) / ('and'|'or', x, y) for a condition over IN= flags only, else None"""
+        words = {'and': 'and', '&': 'and', 'or': 'or', '|': 'or', 'not': 'not', '^': 'not', '~': 'not'}
+        tokens = [token.lower() for token in self._flag_token_re.findall(condition) if not token.isspace()]
+        symbols = []
+        index = 0
+        while index < len(tokens):
+            token = tokens[index]
+            if token in flags:
+                # A = 1, A EQ 0, A NE 0
+                if index + 2 < len(tokens) and tokens[index + 1] in ('=', 'eq', 'ne') and tokens[index + 2] in ('0', '1'):
+                    positive = (tokens[index + 1] == 'ne') != (tokens[index + 2] == '1')
+                    symbols.append(('flag', token) if positive else ('not', ('flag', token)))
+                    index += 3
+                    continue
+                symbols.append(('flag', token))
+            elif token in words or token in ('(', ')'):
+                symbols.append(words.get(token, token))
+            else:
+                return None
+            index += 1
+        position = 0
+        
+        def expression(operator: str = 'or') -> Tuple:
+            nonlocal position
+            operand = expression('and') if operator == 'or' else factor()
+            while position < len(symbols) and symbols[position] == operator:
+                position += 1
+                operand = (operator, operand, expression('and') if operator == 'or' else factor())
+            return operand
+        
+        def factor() -> Tuple:
+            nonlocal position
+            symbol = symbols[position]
+            position += 1
+            if symbol == 'not':
+                return ('not', factor())
+            if symbol == '(':
+                operand = expression()
+                if symbols[position] != ')':
+                    raise ValueError(condition)
+                position += 1
+                return operand
+            if isinstance(symbol, tuple):
+                return symbol
+            raise ValueError(condition)
+        
+        try:
+            tree = expression()
+        except (IndexError, ValueError):
+            return None
+        return tree if position == len(symbols) else None
+    
+    def _flag_value(self, tree: Tuple, present: Dict[str, bool]) -> bool:
+        if tree[0] == 'flag':
+            return present[tree[1]]
+        if tree[0] == 'not':
+            return not self._flag_value(tree[1], present)
+        if tree[0] == 'and':
+            return self._flag_value(tree[1], present) and self._flag_value(tree[2], present)
+        return self._flag_value(tree[1], present) or self._flag_value(tree[2], present)
+    
+    def _flag_sql(self, tree: Tuple, presence: Dict[str, str]) -> str:
+        if tree[0] == 'flag':
+            return f"({presence[tree[1]]})"
+        if tree[0] == 'not':
+            return f"NOT {self._flag_sql(tree[1], presence)}"
+        return f"({self._flag_sql(tree[1], presence)} {tree[0].upper()} {self._flag_sql(tree[2], presence)})"
+    
+    def _replace_flags(self, condition: str, presence: Dict[str, str]) -> str:
+        # IN= flags mixed into other conditions read as presence tests
+        return ''.join(f"({presence[token.lower()]})" if token.lower() in presence else token
+                       for token in self._flag_token_re.findall(condition))
+    
     def _translate_set_step(self, data_step: Dict) -> str:
         try:
             table_name = data_step['table_name']
@@ -494,13 +2053,12 @@ class SASToSQLTranslator:
                 return f"-- No source tables found for SET statement: {table_name}"
             
             if len(source_tables) == 1:
+                if self._depends_on_row_order(operations):
+                    return self._translate_row_order_step(data_step)
                 select_clause = self._build_select_clause(operations)
                 where_clause = self._build_where_clause(operations)
-                calculated_fields = self._build_calculated_fields(operations)
                 
                 sql = f"SELECT {select_clause}"
-                if calculated_fields:
-                    sql += f", {calculated_fields}"
                 sql += f"\nFROM {source_tables[0]}"
                 if where_clause:
                     sql += f"\nWHERE {where_clause}"
@@ -513,6 +2071,331 @@ class SASToSQLTranslator:
         except Exception as e:
             return f"-- Error translating set step: {str(e)}"
     
+    def _translate_row_order_step(self, data_step: Dict) -> str:
+        """SET of one table whose logic reads earlier rows or BY group boundaries, as window functions.
+        
+        FIRST.x/LAST.x are ROW_NUMBER() = 1 over the BY group read forwards or backwards. Sum
+        statements and RETAINed accumulators (v = v + e, SUM/MAX/MIN(v, e)) are running
+        SUM/MAX/MIN() OVER the rows read so far, partitioned by the BY level an IF FIRST.x
+        THEN v = c resets them on; a RETAINed variable only set on FIRST.x carries that value
+        through the group. LAGn/DIFn read back through LAG() OVER the same order, except under
+        IF, where they see only the rows that ran them and are left untranslated. Rows are
+        ordered by the BY variables, or by the keys of the PROC SORT that wrote the input when
+        those extend them. BY group flags see every row read, subsetting IFs before the first
+        order-dependent statement filter what the windows see, later ones what is written. The
+        flag columns are left out of what is written (* EXCEPT in Spark, as for NODUPKEY in
+        translate_proc_sort, and * EXCLUDE elsewhere).
+        """
+        try:
+            table_name = data_step['table_name']
+            operations = data_step['operations']
+            source = data_step['source_tables'][0]
+            notes = []
+            # LAG/DIF queue a value only when they run, so under IF they return the last row that
+            # ran them, not the previous row; a window function can't say which rows those were
+            conditional, lagged = [], []
+            for block in operations.get('conditional', []):
+                kept = []
+                for statement in block['statements']:
+                    (lagged if SASAnalyzer._lag_re.search(statement) else kept).append(statement)
+                conditional.append(dict(block, statements=kept))
+            if lagged:
+                notes.append("LAG/DIF under IF not translated, they only queue the rows they run on: "
+                             + ", ".join(f"'{statement}'" for statement in lagged))
+                operations = dict(operations, conditional=conditional)
+            if 'notsorted' in (word.lower() for word in operations.get('by', [])):
+                return f"-- BY NOTSORTED groups follow row order, which SQL doesn't keep: {table_name}"
+            by_keys = self._by_keys(' '.join(operations.get('by', [])))
+            order = by_keys
+            known = self._input_order(source, data_step)
+            if known and [(column.lower(), descending) for column, descending in known[:len(by_keys)]] == \
+                    [(column.lower(), descending) for column, descending in by_keys]:
+                order = known
+            if not order:
+                return (f"-- Data step {table_name} depends on row order (RETAIN, LAG or a sum statement); "
+                        f"add a BY statement or sort {source} first")
+            by_names = [column.lower() for column, _ in by_keys]
+            flags = {}
+            for kind, variable in re.findall(r'\b(first|last)\.(\w+)', ' '.join(self._step_texts(operations)),
+                                             re.IGNORECASE):
+                if variable.lower() not in by_names:
+                    return f"-- {kind.upper()}.{variable} needs {variable} in the BY statement: {table_name}"
+                flags[(kind.lower(), variable.lower())] = f"_{kind.lower()}_{variable.lower()}"
+            
+            def over(level: int = 0, reverse: bool = False, running: bool = False) -> str:
+                clauses = []
+                if level:
+                    clauses.append(f"PARTITION BY {', '.join(column for column, _ in by_keys[:level])}")
+                # Rows within a partition only need the keys after it
+                keys = order[level:] or order
+                clauses.append("ORDER BY " + ", ".join(f"{column} DESC" if descending != reverse else column
+                                                       for column, descending in keys))
+                if running:
+                    clauses.append("ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW")
+                return f"OVER ({' '.join(clauses)})"
+            
+            def rewrite(sql: str, boolean: bool) -> str:
+                def flag(match):
+                    column = flags[(match.group(1).lower(), match.group(2).lower())]
+                    compared = (sql[:match.start()].rstrip().endswith(('=', '<', '>')) or
+                                sql[match.end():].lstrip().startswith(('=', '<', '>', '!')))
+                    return f"{column} = 1" if boolean and not compared else column
+                sql = re.sub(r'\b(first|last)\.(\w+)\b', flag, sql, flags=re.IGNORECASE)
+                return self._rewrite_lags(sql, over())
+            
+            def inline(sql: str, fields: Dict) -> str:
+                # Fields computed in the same SELECT can't be referenced by name
+                plain = {key: value for key, (_, value) in fields.items() if ' OVER (' not in value}
+                
+                def substitute(match):
+                    value = plain.get((match.group(1) or '').lower())
+                    if value is None:
+                        return match.group(0)
+                    return value if re.fullmatch(r"[\w.]+|'[^']*'", value) else f"({value})"
+                return re.sub(r"'[^']*'|\b([A-Za-z_]\w*)\b(?!\s*\()", substitute, sql) if plain else sql
+            
+            def expression(text: str, fields: Dict) -> str:
+                return inline(rewrite(self._translate_condition(text), False), fields)
+            
+            def condition(text: str, fields: Dict) -> str:
+                return inline(rewrite(self._translate_condition(text), True), fields)
+            
+            # Accumulators and RETAINed variables carried from the first row of a group
+            retained = {entry['name'].lower(): entry for entry in operations.get('retain', [])}
+            chains = self._conditional_chains(operations.get('conditional', []))
+            unconditional = {field['name'].lower() for field in operations.get('calculated_fields', [])}
+            accumulated = {entry['name'].lower() for entry in operations.get('sum_statements', [])}
+            reset_only = {}
+            for field in operations.get('calculated_fields', []):
+                if field['name'].lower() in retained and self._accumulation(field['name'], field['expression']):
+                    accumulated.add(field['name'].lower())
+            for chain in chains:
+                for block in chain:
+                    resets = len(chain) == 1 and re.fullmatch(r'first\.\w+', block['condition'] or '', re.IGNORECASE)
+                    for statement in block['statements']:
+                        sum_match = SASAnalyzer._sum_statement_re.fullmatch(statement)
+                        assignment_match = SASAnalyzer._assignment_re.fullmatch(statement)
+                        if sum_match:
+                            accumulated.add(sum_match.group(1).lower())
+                        elif assignment_match and assignment_match.group(1).lower() in retained:
+                            key = assignment_match.group(1).lower()
+                            if self._accumulation(assignment_match.group(1), assignment_match.group(2).strip()):
+                                accumulated.add(key)
+                            reset_only[key] = reset_only.get(key, True) and bool(resets)
+            carried = {key for key, only in reset_only.items()
+                       if only and key not in accumulated and key not in unconditional}
+            unsupported = {key for key in reset_only if key not in accumulated | carried | unconditional}
+            for key in sorted(unsupported):
+                notes.append(f"RETAINed {retained[key]['name']} set under IF (carried forward) not translated")
+            fields = self._build_calculated_fields(operations, expression, condition,
+                                                   skip=accumulated | carried | unsupported, notes=notes)
+            
+            accumulators, starts, outputs = {}, {}, []
+            
+            def accumulate(variable: str, function: str, term: str):
+                entry = accumulators.setdefault(variable.lower(), {'name': variable, 'function': function,
+                                                                   'terms': []})
+                if entry['function'] != function:
+                    notes.append(f"{variable} mixes {entry['function']} and {function} accumulation")
+                entry['terms'].append(term)
+            
+            def guarded(prior: List[str], own: Optional[str], value: str) -> str:
+                whens = ''.join(f"WHEN {block_condition} THEN NULL " for block_condition in prior)
+                if own is None:
+                    return f"CASE {whens}ELSE {value} END" if prior else value
+                return f"CASE {whens}WHEN {own} THEN {value} END"
+            
+            for statement in operations.get('sum_statements', []):
+                accumulate(statement['name'], 'SUM', expression(statement['expression'], fields))
+            for field in operations.get('calculated_fields', []):
+                if field['name'].lower() in accumulated:
+                    accumulation = self._accumulation(field['name'], field['expression'])
+                    if accumulation:
+                        accumulate(field['name'], accumulation[0], expression(accumulation[1], fields))
+                    else:
+                        notes.append(f"assignment to accumulator {field['name']} not translated")
+            for chain in chains:
+                prior = []
+                for block in chain:
+                    own = None if block['condition'] is None else condition(block['condition'], fields)
+                    flag_match = re.fullmatch(r'first\.(\w+)', block['condition'] or '', re.IGNORECASE)
+                    for statement in block['statements']:
+                        sum_match = SASAnalyzer._sum_statement_re.fullmatch(statement)
+                        assignment_match = SASAnalyzer._assignment_re.fullmatch(statement)
+                        if statement.lower() == 'output':
+                            outputs.append(own if not prior else None)
+                        elif sum_match:
+                            accumulate(sum_match.group(1), 'SUM',
+                                       guarded(prior, own, expression(sum_match.group(2), fields)))
+                        elif assignment_match and assignment_match.group(1).lower() in accumulated | carried:
+                            variable, value = assignment_match.group(1), assignment_match.group(2).strip()
+                            accumulation = self._accumulation(variable, value)
+                            if accumulation:
+                                accumulate(variable, accumulation[0],
+                                           guarded(prior, own, expression(accumulation[1], fields)))
+                            elif flag_match and len(chain) == 1:
+                                # IF FIRST.x THEN v = c starts v over at each x group
+                                starts[variable.lower()] = (by_names.index(flag_match.group(1).lower()) + 1, value)
+                            else:
+                                notes.append(f"'{statement}' under IF not translated")
+                    if own is not None:
+                        prior.append(own)
+            
+            windowed = [f"{value} AS {name}" for name, value in fields.values() if ' OVER (' in value]
+            for key, entry in accumulators.items():
+                level, start = starts.get(key, (0, retained.get(key, {}).get('initial')))
+                start = None if start is None or re.fullmatch(r'\.[A-Za-z_]?', start) else expression(start, fields)
+                function, terms = entry['function'], entry['terms']
+                if function == 'SUM':
+                    total = terms[0] if len(terms) == 1 else ' + '.join(f"COALESCE({term}, 0)" for term in terms)
+                    value = f"COALESCE(SUM({total}) {over(level, running=True)}, 0)"
+                else:
+                    if len(terms) > 1:
+                        notes.append(f"{entry['name']}: only the first {function} accumulation translated")
+                    value = f"{function}({terms[0]}) {over(level, running=True)}"
+                if start is not None and (start != '0' or function != 'SUM'):
+                    literal = re.fullmatch(r"[-+]?(?:\d+\.?\d*|\.\d+)", start)
+                    if not literal:
+                        # Evaluated on the row that starts the group
+                        start = f"FIRST_VALUE({start}) {over(level)}"
+                    if function == 'SUM':
+                        value = f"{start} + {value}" if literal else f"COALESCE({start}, 0) + {value}"
+                    else:
+                        value = f"{'GREATEST' if function == 'MAX' else 'LEAST'}({start}, {value})"
+                windowed.append(f"{value} AS {entry['name']}")
+            for key in sorted(carried):
+                if key in starts:
+                    level, value = starts[key]
+                    windowed.append(f"FIRST_VALUE({expression(value, fields)}) {over(level)} AS {retained[key]['name']}")
+            plain = {key: value for key, value in fields.items() if ' OVER (' not in value[1]}
+            for key, entry in retained.items():
+                if entry['initial'] is not None and key not in fields and key not in accumulators and key not in carried:
+                    # Never assigned, so it keeps its initial value
+                    plain[key] = (entry['name'], expression(entry['initial'], fields))
+            
+            # Explicit OUTPUT replaces the implicit one at the end of the step
+            ifs = operations.get('if', [])
+            late = len(operations.get('late_if', []))
+            late_conditions = [condition(text, plain) for text in ifs[len(ifs) - late:]] if late else []
+            written = outputs + operations.get('output', [])
+            if len(written) == 1 and outputs and outputs[0] is not None:
+                late_conditions.append(outputs[0])
+            elif len(written) > 1 or (outputs and outputs[0] is None) or any(operations.get('output', [])):
+                notes.append("OUTPUT statements not translated, every row is written once")
+            
+            flag_items = [f"CASE WHEN ROW_NUMBER() {over(by_names.index(variable) + 1, kind == 'last')} = 1 "
+                          f"THEN 1 ELSE 0 END AS {column}" for (kind, variable), column in flags.items()]
+            from_clause = source
+            conditions = [self._translate_condition(text) for text in operations.get('where', [])]
+            if flag_items:
+                from_clause = self._subquery(f"SELECT *, {', '.join(flag_items)}\nFROM {from_clause}", conditions, 's')
+                conditions = []
+            conditions.extend(condition(text, plain) for text in ifs[:len(ifs) - late])
+            if windowed:
+                from_clause = self._subquery(f"SELECT *, {', '.join(windowed)}\nFROM {from_clause}", conditions, 'r')
+                conditions = []
+            conditions.extend(late_conditions)
+            # The BY group flags are read above but aren't the step's variables
+            star = "*"
+            if flags:
+                star = f"* {'EXCEPT' if self.dialect == 'spark' else 'EXCLUDE'} ({', '.join(flags.values())})"
+            sql = f"SELECT {self._build_select_clause(operations, star, plain)}\nFROM {from_clause}"
+            if conditions:
+                sql += f"\nWHERE {' AND '.join(conditions)}"
+            if notes:
+                sql += f"\n/* Note: {'; '.join(notes)} */"
+            return sql
+        except Exception as e:
+            return f"-- Error translating row order logic: {str(e)}"
+    
+    def _subquery(self, select: str, conditions: List[str], alias: str) -> str:
+        where = f"\nWHERE {' AND '.join(conditions)}" if conditions else ""
+        return f"(\n{select}{where}\n) {alias}"
+    
+    def _depends_on_row_order(self, operations: Dict) -> bool:
+        if operations.get('retain') or operations.get('sum_statements'):
+            return True
+        statements = [statement for block in operations.get('conditional', []) for statement in block['statements']]
+        return (any(SASAnalyzer._row_order_re.search(text) for text in self._step_texts(operations)) or
+                any(SASAnalyzer._sum_statement_re.fullmatch(statement) for statement in statements))
+    
+    def _step_texts(self, operations: Dict) -> List[str]:
+        # SAS expressions of a DATA step's IF conditions, assignments and IF-THEN blocks
+        texts = list(operations.get('if', []))
+        texts.extend(field['expression'] for field in operations.get('calculated_fields', []))
+        for block in operations.get('conditional', []):
+            texts.append(block['condition'] or '')
+            texts.extend(block['statements'])
+        return texts
+    
+    def _by_keys(self, args: str) -> List[Tuple[str, bool]]:
+        """BY statement variables as (name, descending) pairs"""
+        keys, descending = [], False
+        for word in args.split():
+            if word.lower() == 'descending':
+                descending = True
+            elif word.lower() not in ('notsorted', 'groupformat'):
+                keys.append((word, descending))
+                descending = False
+        return keys
+    
+    def _input_order(self, table: str, data_step: Dict) -> List[Tuple[str, bool]]:
+        # Keys of the last PROC SORT that wrote the table before the step
+        start = data_step.get('start')
+        order = []
+        for sorted_at, keys in self.sort_orders.get(table.lower(), []):
+            if start is None or sorted_at < start:
+                order = keys
+        return order
+    
+    def _accumulation(self, name: str, expression: str) -> Optional[Tuple[str, str]]:
+        """(SUM|MAX|MIN, increment) when expression adds to name: v + e, e + v, SUM/MAX/MIN(v, e)"""
+        variable = re.escape(name)
+        for pattern in (rf'{variable}\s*\+\s*(.+)', rf'(.+?)\s*\+\s*{variable}'):
+            match = re.fullmatch(pattern, expression, re.DOTALL | re.IGNORECASE)
+            if match and self._split_arguments(match.group(1)) is not None:
+                return 'SUM', match.group(1).strip()
+        match = re.fullmatch(rf'(sum|max|min)\s*\(\s*{variable}\s*,(.+)\)', expression, re.DOTALL | re.IGNORECASE)
+        if match:
+            arguments = self._split_arguments(match.group(2))
+            if arguments is not None and len(arguments) == 1:
+                return match.group(1).upper(), arguments[0]
+        return None
+    
+    def _split_arguments(self, text: str) -> Optional[List[str]]:
+        # Top-level comma separated parts, None when the parentheses don't balance
+        parts, depth, current = [], 0, ''
+        for token in re.findall(r"'[^']*'|\"[^\"]*\"|[^'\"]", text):
+            if token in '(),':
+                depth += {'(': 1, ')': -1}.get(token, 0)
+                if depth < 0:
+                    return None
+                if token == ',' and not depth:
+                    parts.append(current.strip())
+                    current = ''
+                    continue
+            current += token
+        return parts + [current.strip()] if not depth else None
+    
+    def _rewrite_lags(self, sql: str, window: str) -> str:
+        """LAGn(x) and DIFn(x) calls in translated SQL as LAG() OVER the window"""
+        parts, position = [], 0
+        for match in re.finditer(r'\b(lag|dif)(\d*)\s*\(', sql, re.IGNORECASE):
+            if match.start() < position:
+                continue
+            depth, end = 1, match.end()
+            while end < len(sql) and depth:
+                depth += {'(': 1, ')': -1}.get(sql[end], 0)
+                end += 1
+            argument = sql[match.end():end - 1].strip()
+            offset = f", {match.group(2)}" if match.group(2) not in ('', '1') else ''
+            lag = f"LAG({argument}{offset}) {window}"
+            parts.append(sql[position:match.start()])
+            parts.append(f"({argument} - {lag})" if match.group(1).lower() == 'dif' else lag)
+            position = end
+        parts.append(sql[position:])
+        return ''.join(parts)
+    
     def _translate_datalines_step(self, data_step: Dict) -> str:
         try:
             table_name = data_step['table_name']
@@ -520,26 +2403,117 @@ class SASToSQLTranslator:
             columns = operations.get('input', [])
             if not columns:
                 return f"-- No INPUT statement found for data step: {table_name}"
-            column_defs = []
-            for col in columns:
-                column_defs.append(f"{col} VARCHAR(100)")
-            create_sql = f"CREATE TABLE {table_name} (\n    " + ",\n    ".join(column_defs) + "\n)"
-            return create_sql
+            frame = data_step.get('datalines')
+            kinds = self.type_inferrer.infer(operations, frame)
+            statements = [self._datalines_table_ddl(table_name, columns, kinds)]
+            if frame is not None:
+                rows = self._datalines_value_rows(self.type_inferrer.normalize(frame, kinds), kinds)
+                insert = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES\n    "
+                size = self.insert_batch_size
+                for start in range(0, len(rows), size):
+                    statements.append(insert + ",\n    ".join(rows[start:start + size]))
+            return ";\n".join(statements) + ";"
         except Exception as e:
             return f"-- Error translating datalines step: {str(e)}"
     
-    def _build_select_clause(self, operations: Dict) -> str:
+    def translate_datalines_sidecar(self, data_step: Dict, path: str, file_format: str,
+                                    kinds: Dict[str, Tuple] = None) -> str:
+        """DDL that loads a DATALINES step from a sidecar file written by the caller"""
         try:
-            keep_cols = operations.get('keep', [])
-            drop_cols = operations.get('drop', [])
-            if keep_cols:
-                return ", ".join(keep_cols)
-            elif drop_cols:
-                return "*  -- Note: DROP operation requires explicit column list"
+            table_name = data_step['table_name']
+            columns = data_step['operations'].get('input', [])
+            if kinds is None:
+                kinds = self.type_inferrer.infer(data_step['operations'], data_step.get('datalines'))
+            location = path.replace("'", "''")
+            ddl = self._datalines_table_ddl(table_name, columns, kinds)
+            if self.dialect == 'spark':
+                if file_format == 'parquet':
+                    return f"CREATE TABLE {table_name} USING parquet OPTIONS (path '{location}');"
+                return f"{ddl} USING csv OPTIONS (path '{location}', header 'true', nullValue '');"
+            if file_format == 'parquet':
+                return f"{ddl};\nINSERT INTO {table_name} SELECT * FROM read_parquet('{location}');"
+            # Read as text so codes like 007 aren't sniffed as numbers; the table's types cast each value
+            return (f"{ddl};\nINSERT INTO {table_name} SELECT * FROM "
+                    f"read_csv_auto('{location}', header = true, all_varchar = true);")
+        except Exception as e:
+            return f"-- Error translating datalines step: {str(e)}"
+    
+    def _datalines_table_ddl(self, table_name: str, columns: List[str], kinds: Dict[str, Tuple]) -> str:
+        column_defs = [f"{col} {self.type_inferrer.sql_type(kinds.get(col, ('char', None)))}" for col in columns]
+        return f"CREATE TABLE {table_name} (\n    " + ",\n    ".join(column_defs) + "\n)"
+    
+    def _datalines_value_rows(self, normalized: Dict[str, List[Optional[str]]], kinds: Dict[str, Tuple]) -> List[str]:
+        """Render every row as a '(v1, v2, ...)' tuple, building each distinct literal once per column"""
+        columns = []
+        for column, values in normalized.items():
+            kind = kinds.get(column, ('char', None))[0]
+            prefix = '' if kind == 'char' else kind.upper() + ' '
+            literals = {None: 'NULL'}
+            for value in set(values):
+                if value is not None:
+                    if kind in ('char', 'date', 'timestamp'):
+                        literals[value] = prefix + "'" + value.replace("'", "''") + "'"
+                    else:
+                        literals[value] = value
+            columns.append([literals[value] for value in values])
+        return [f"({', '.join(row)})" for row in zip(*columns)]
+    
+    def _build_select_clause(self, operations: Dict, star: str = "*", calculated: Dict = None) -> str:
+        """Output columns of a DATA step, calculated fields included.
+        
+        KEEP=/DROP=/RENAME= on the input datasets act on what is read, the step's KEEP, DROP and
+        RENAME statements (and output dataset options) on what is written, calculated fields
+        included. Columns dropped or renamed while only reachable through * can't be left out
+        here; ColumnLineage expands the * once the columns are known.
+        """
+        try:
+            input_options = [operations.get('dataset_options', {}).get(table, {})
+                             for table in operations.get('set', []) + operations.get('merge', [])]
+            read = []
+            if input_options and all('keep' in options for options in input_options):
+                for options in input_options:
+                    read.extend(column for column in options['keep'].split() if column not in read)
+            read_dropped = {column.lower() for options in input_options
+                            for column in options.get('drop', '').split()}
+            renames = {}
+            for options in input_options:
+                renames.update(self.parse_renames([options.get('rename', '')]))
+            renames.update(self.parse_renames(operations.get('rename', [])))
+            written = operations.get('keep', [])
+            dropped = {column.lower() for column in operations.get('drop', [])}
+            if calculated is None:
+                calculated = self._build_calculated_fields(operations)
+            
+            def output(column: str, expression: str = None) -> str:
+                new_name = renames.get(column.lower(), (None, None))[1]
+                if expression is None:
+                    return f"{column} AS {new_name}" if new_name else column
+                return f"{expression} AS {new_name or column}"
+            
+            items = []
+            if written:
+                for column in written:
+                    if column.lower() not in dropped:
+                        items.append(output(column, calculated.get(column.lower(), (None, None))[1]))
+                return ", ".join(items)
+            if read:
+                items.extend(output(column) for column in read
+                             if not {column.lower()} & (dropped | read_dropped | set(calculated)))
             else:
-                return "*"
+                items.append(star)
+                items.extend(output(old) for key, (old, _) in renames.items() if key not in calculated)
+            items.extend(output(name, expression) for key, (name, expression) in calculated.items()
+                         if key not in dropped)
+            select_clause = ", ".join(items)
+            if not read and ((dropped | read_dropped) - set(calculated) or set(renames) - set(calculated)):
+                select_clause += "  -- Note: DROP/RENAME of columns read through * requires an explicit column list"
+            return select_clause
         except:
-            return "*"
+            return star
+    
+    def parse_renames(self, rename: List[str]) -> Dict[str, Tuple[str, str]]:
+        """RENAME pairs ('old=new', possibly split on whitespace) as {old lower: (old, new)}"""
+        return {old.lower(): (old, new) for old, new in re.findall(r'(\w+)\s*=\s*(\w+)', ' '.join(rename))}
     
     def _build_from_clause(self, source_tables: List[str]) -> str:
         try:
@@ -570,41 +2544,111 @@ class SASToSQLTranslator:
         except:
             return ""
     
-    def _build_group_by_clause(self, operations: Dict) -> str:
-        try:
-            by_cols = operations.get('by', [])
-            if by_cols:
-                return ", ".join(by_cols)
-            return ""
-        except:
-            return ""
-    
-    def _build_calculated_fields(self, operations: Dict) -> str:
+    def _build_calculated_fields(self, operations: Dict, expression: Callable = None, condition: Callable = None,
+                                 skip: Set[str] = frozenset(), notes: List[str] = None) -> Dict[str, Tuple[str, str]]:
+        """{name lower: (name, SQL expression)} of the step's assignments, in program order.
+        
+        Assignments under IF-THEN/ELSE become a CASE over the conditions of their IF/ELSE IF
+        chain, falling back to the value the variable had before the chain. expression and
+        condition translate SAS text given the fields so far, for callers that rewrite more
+        than functions and operators; variables in skip are left to the caller, and other
+        statements under an IF are listed in notes.
+        """
         try:
+            if expression is None:
+                expression = lambda text, fields: self._translate_condition(text)
+            condition = condition or expression
+            lengths = self.type_inferrer.declared_lengths(operations)
+            fields = {}
+            read = set()
+            for text in self._step_texts(operations):
+                assignment_match = SASAnalyzer._assignment_re.fullmatch(text)
+                read.update(word.lower() for word in re.findall(r'[A-Za-z_]\w*',
+                                                                 assignment_match.group(2) if assignment_match else text))
+            
+            def assign(variable: str, translated_expr: str):
+                kind = lengths.get(variable)
+                if kind and kind[0] == 'char':
+                    # SAS truncates values to the declared length
+                    if self.dialect == 'spark':
+                        translated_expr = f"substr({translated_expr}, 1, {kind[1]})"
+                    else:
+                        translated_expr = f"CAST({translated_expr} AS {self.type_inferrer.cast_type(kind)})"
+                # A variable assigned twice keeps its first position and its last value
+                name = fields.get(variable.lower(), (variable,))[0]
+                fields[variable.lower()] = (name, translated_expr)
+            
+            def assign_chain(chain: List[Dict]):
+                conditions = [None if block['condition'] is None else condition(block['condition'], fields)
+                              for block in chain]
+                values = [{} for _ in chain]
+                for block, assigned in zip(chain, values):
+                    for statement in block['statements']:
+                        assignment_match = SASAnalyzer._assignment_re.fullmatch(statement)
+                        if assignment_match and assignment_match.group(1).lower() not in skip:
+                            assigned[assignment_match.group(1).lower()] = (assignment_match.group(1),
+                                                                           assignment_match.group(2).strip())
+                        elif (not assignment_match and notes is not None and statement.lower() != 'output'
+                              and not SASAnalyzer._sum_statement_re.fullmatch(statement)):
+                            notes.append(f"'{statement}' under IF not translated")
+                chained = {}
+                for assigned in values:
+                    for key, (variable, _) in assigned.items():
+                        chained.setdefault(key, variable)
+                cases = []
+                for key, variable in chained.items():
+                    # A variable the step never reads is new and starts out missing
+                    before = fields[key][1] if key in fields else (variable if key in read and variable not in lengths
+                                                                   else 'NULL')
+                    whens, otherwise = [], before
+                    for block_condition, assigned in zip(conditions, values):
+                        value = expression(assigned[key][1], fields) if key in assigned else before
+                        if block_condition is None:
+                            otherwise = value
+                        else:
+                            whens.append((block_condition, value))
+                    while whens and whens[-1][1] == before and otherwise == before:
+                        whens.pop()
+                    case = ' '.join(f"WHEN {block_condition} THEN {value}" for block_condition, value in whens)
+                    if otherwise != 'NULL':
+                        case += f" ELSE {otherwise}"
+                    cases.append((variable, f"CASE {case} END" if whens else otherwise))
+                for variable, value in cases:
+                    assign(variable, value)
+            
+            chains = defaultdict(list)
+            for chain in self._conditional_chains(operations.get('conditional', [])):
+                chains[chain[0]['position']].append(chain)
             calculated_fields = operations.get('calculated_fields', [])
-            if calculated_fields:
-                fields = []
-                for field in calculated_fields:
-                    translated_expr = self._translate_condition(field['expression'])
-                    fields.append(f"{translated_expr} AS {field['name']}")
-                return ", ".join(fields)
-            return ""
+            for position in range(len(calculated_fields) + 1):
+                for chain in chains.get(position, []):
+                    assign_chain(chain)
+                if position < len(calculated_fields) and calculated_fields[position]['name'].lower() not in skip:
+                    field = calculated_fields[position]
+                    assign(field['name'], expression(field['expression'], fields))
+            return fields
         except:
-            return ""
+            return {}
+    
+    def _conditional_chains(self, blocks: List[Dict]) -> List[List[Dict]]:
+        # IF-THEN blocks, each with the ELSE blocks that follow it
+        chains = []
+        for block in blocks:
+            if block['else'] and chains:
+                chains[-1].append(block)
+            else:
+                chains.append([block])
+        return chains
     
     def _translate_condition(self, condition: str) -> str:
         try:
             # Clean up the condition first
             condition = condition.rstrip(';').strip()
+            if re.fullmatch(r'\.[A-Za-z_]?', condition):
+                return "NULL"
             
-            # Convert SAS date literals and other functions
-            condition = self.function_translator.translate(condition)
-            
-            # Translate SAS operators to SQL
-            for sas_op, sql_op in self.sas_sql_mapping.items():
-                condition = re.sub(r'\b' + sas_op + r'\b', sql_op, condition, flags=re.IGNORECASE)
-            
-            return condition
+            # Convert SAS date literals, functions and operators in a single pass
+            return self.function_translator.translate(condition, self.sas_sql_mapping)
         except:
             return condition
     
@@ -615,20 +2659,15 @@ class SASToSQLTranslator:
             sql = re.sub(r'format\s*=\s*[^,\s]+\s*', '', sql, flags=re.IGNORECASE)
             sql = re.sub(r'outobs\s*=\s*\d+', '', sql, flags=re.IGNORECASE)
             
-            # Convert SAS date literals first
-            sql = self.function_translator.translate(sql)
-            
-            # Translate SAS operators to SQL
-            for sas_op, sql_op in self.sas_sql_mapping.items():
-                sql = re.sub(r'\b' + sas_op + r'\b', sql_op, sql, flags=re.IGNORECASE)
+            # Convert SAS date literals, functions and operators in a single pass
+            sql = self.function_translator.translate(sql, self.sas_sql_mapping)
             
             # Remove PROC SQL and QUIT statements
-            sql = re.sub(r'\bproc\s+sql\b', '', sql, flags=re.IGNORECASE)
-            sql = re.sub(r'\bquit\b', '', sql, flags=re.IGNORECASE)
+            sql = re.sub(r'\bproc\s+sql\b[^;]*;?', '', sql, flags=re.IGNORECASE)
+            sql = re.sub(r'\bquit\s*;?', '', sql, flags=re.IGNORECASE)
             
-            # Handle macros
-            sql = re.sub(r'%(\w+)\(', r'/* MACRO \1 CALL: ', sql)
-            sql = re.sub(r'\)', r' */', sql)
+            # Comment out macro calls that were not expanded (e.g. defined in an %include)
+            sql = self._comment_macro_calls(sql)
             
             # Remove trailing semicolons
             sql = sql.rstrip(';').strip()
@@ -637,9 +2676,557 @@ class SASToSQLTranslator:
         except Exception as e:
             return f"-- Error translating PROC SQL: {str(e)}"
     
+    def _comment_macro_calls(self, sql: str) -> str:
+        output = []
+        pos = 0
+        for match in re.finditer(r'%(\w+)\s*\(', sql):
+            if match.start() < pos:
+                continue
+            # Find the balanced closing parenthesis of the call
+            depth, end = 1, match.end()
+            while end < len(sql) and depth:
+                if sql[end] == '(':
+                    depth += 1
+                elif sql[end] == ')':
+                    depth -= 1
+                end += 1
+            args = sql[match.end():end - 1] if depth == 0 else sql[match.end():end]
+            output.append(sql[pos:match.start()])
+            output.append(f"/* MACRO {match.group(1)} CALL: {args.replace('*/', '* /')} */")
+            pos = end
+        output.append(sql[pos:])
+        return ''.join(output)
+    
+    def translate_proc_means(self, proc_content: str) -> str:
+        """PROC MEANS / SUMMARY as a single aggregation over the input.
+        
+        Every requested CLASS combination comes out of one scan: CUBE when all of them are
+        wanted, GROUPING SETS for TYPES/WAYS or BY groups, a plain GROUP BY under NWAY. _TYPE_
+        is derived from GROUPING_ID, whose bits mark the CLASS variables rolled up where
+        _TYPE_'s mark those kept. OUTPUT OUT= creates the table with the named (or AUTONAME)
+        statistics, or SAS's _STAT_ rows when it names none; without it the printed NWAY table
+        is selected.
+        """
+        try:
+            statements = [statement.strip() for statement in proc_content.split(';') if statement.strip()]
+            header = statements[0]
+            proc_type = header.split()[1].upper()
+            data_match = re.search(r'\bdata\s*=\s*(\w+(?:\.\w+)?)\s*(\((?:[^()]|\([^()]*\))*\))?', header, re.IGNORECASE)
+            if not data_match:
+                return f"-- No data source specified in PROC {proc_type}"
+            flags = [word.lower() for word in re.sub(r'\w+\s*=\s*(?:\((?:[^()]|\([^()]*\))*\)|\S+)', ' ', header).split()[2:]]
+            
+            class_vars, by_vars, analysis_vars, conditions, notes = [], [], [], [], []
+            types, ways, output = None, None, None
+            missing = 'missing' in flags
+            input_options = SASAnalyzer._parse_dataset_options((data_match.group(2) or '()').strip()[1:-1])
+            if input_options.get('where'):
+                conditions.append(self._translate_condition(input_options['where']))
+            for statement in statements[1:]:
+                keyword, args = SASBlockScanner.split_keyword(statement)
+                args, _, statement_options = args.partition('/')
+                if keyword == 'class':
+                    class_vars.extend(args.split())
+                    missing = missing or 'missing' in statement_options.lower().split()
+                elif keyword == 'by':
+                    by_vars.extend(word for word in args.split() if word.lower() != 'descending')
+                elif keyword == 'var':
+                    analysis_vars.extend(args.split())
+                elif keyword == 'where':
+                    conditions.append(self._translate_condition(args))
+                elif keyword == 'types':
+                    types = re.findall(r'\(\s*\)|[\w*]+', args)
+                elif keyword == 'ways':
+                    ways = {int(number) for number in args.split()}
+                elif keyword == 'output' and output is None:
+                    output = (args, statement_options.lower().split())
+                elif keyword in ('output', 'weight', 'freq', 'id'):
+                    notes.append(f"{keyword.upper()} statement not translated")
+            if not analysis_vars:
+                return f"-- PROC {proc_type} needs a VAR statement naming the analysis variables"
+            if output is None and proc_type == 'SUMMARY':
+                return "-- PROC SUMMARY without OUTPUT OUT= produces no table"
+            
+            # CLASS combinations as tuples of positions; NWAY and printed output keep only the full one
+            full = tuple(range(len(class_vars)))
+            subsets = [tuple(position for position in full if number >> (len(full) - 1 - position) & 1)
+                       for number in range(1 << len(full))]
+            if 'nway' in flags or output is None:
+                combinations = [full]
+            elif types is not None:
+                lowered = [column.lower() for column in class_vars]
+                combinations = [() if term.startswith('(') else
+                                tuple(sorted(lowered.index(column.lower()) for column in term.split('*')))
+                                for term in types]
+            elif ways is not None:
+                combinations = [subset for subset in subsets if len(subset) in ways]
+            else:
+                combinations = subsets
+            all_types = len(subsets) - 1
+            if not class_vars or combinations == [full]:
+                type_expression = str(all_types)
+                group_by = by_vars + class_vars
+            else:
+                type_expression = f"{all_types} - GROUPING_ID({', '.join(class_vars)})"
+                if len(combinations) == len(subsets) and not by_vars:
+                    group_by = [f"CUBE ({', '.join(class_vars)})"]
+                else:
+                    sets = [f"({', '.join(by_vars + [class_vars[position] for position in combination])})"
+                            for combination in combinations]
+                    group_by = [f"GROUPING SETS ({', '.join(sets)})"]
+            if not missing:
+                # Observations with a missing CLASS value are left out unless MISSING is given
+                conditions.extend(f"{column} IS NOT NULL" for column in class_vars)
+            
+            # (statistic, variable, output name) per computed column
+            long_format = False
+            if output is not None:
+                out_match = re.search(r'\bout\s*=\s*(\w+(?:\.\w+)?)\s*(\((?:[^()]|\([^()]*\))*\))?', output[0], re.IGNORECASE)
+                requests = self._means_requests(output[0][out_match.end():] if out_match else output[0],
+                                                analysis_vars, 'autoname' in output[1])
+                if not requests:
+                    long_format = True
+                    requests = self._means_requests('n= min= max= mean= std=', analysis_vars, True)
+            else:
+                statistics = [flag for flag in flags if flag in self._means_statistics] or ['n', 'mean', 'std', 'min', 'max']
+                requests = self._means_requests(' '.join(f"{statistic}=" for statistic in statistics), analysis_vars, True)
+            unsupported = sorted({statistic for statistic, _, _ in requests if statistic not in self._means_statistics})
+            if unsupported:
+                notes.append(f"statistics not translated: {', '.join(unsupported).upper()}")
+            
+            keys = [(column, column) for column in by_vars + class_vars]
+            if output is not None:
+                keys += [('_TYPE_', type_expression), ('_FREQ_', "COUNT(*)")]
+            else:
+                keys.append(('NObs', "COUNT(*)"))
+            values = [(name, self._means_statistics[statistic][1].format(column))
+                      for statistic, column, name in requests if statistic in self._means_statistics]
+            
+            select = [expression if expression == name else f"{expression} AS {name}" for name, expression in keys + values]
+            sql = f"SELECT {', '.join(select)}\nFROM {data_match.group(1)}"
+            if conditions:
+                sql += f"\nWHERE {' AND '.join(conditions)}"
+            if group_by:
+                sql += f"\nGROUP BY {', '.join(group_by)}"
+            if output is None:
+                if group_by:
+                    sql += f"\nORDER BY {', '.join(by_vars + class_vars)}"
+            else:
+                columns = [(name, f"s.{name}") for name, _ in keys]
+                if long_format:
+                    # One row per statistic, as SAS writes OUTPUT without statistic keywords
+                    columns.append(('_STAT_', "t._STAT_"))
+                    for column in analysis_vars:
+                        cases = ' '.join(f"WHEN '{statistic.upper()}' THEN s.{name}"
+                                         for statistic, source, name in requests if source == column)
+                        columns.append((column, f"CASE t._STAT_ {cases} END"))
+                else:
+                    columns += [(name, f"s.{name}") for name, _ in values]
+                columns = self._apply_output_options(columns, out_match.group(2) if out_match else None)
+                if long_format or len(columns) != len(keys) + len(values) or any(
+                        expression != f"s.{name}" for name, expression in columns):
+                    select = [expression if expression.endswith(f".{name}") else f"{expression} AS {name}"
+                              for name, expression in columns]
+                    sql = f"SELECT {', '.join(select)}\nFROM (\n{sql}\n) s"
+                    if long_format:
+                        sql += "\nCROSS JOIN (VALUES ('N'), ('MIN'), ('MAX'), ('MEAN'), ('STD')) AS t(_STAT_)"
+                if out_match:
+                    sql = f"CREATE TABLE {out_match.group(1)} AS\n{sql}"
+            if notes:
+                sql += f"\n/* Note: {'; '.join(notes)} */"
+            return sql
+        except Exception as e:
+            return f"-- Error translating PROC MEANS: {str(e)}"
+    
+    def _means_requests(self, text: str, analysis_vars: List[str], autoname: bool) -> List[Tuple[str, str, str]]:
+        """(statistic, variable, output name) for 'mean= sum(x y)=sx sy' style OUTPUT specifications"""
+        requests = []
+        markers = list(re.finditer(r'(\w+)\s*(?:\(([^)]*)\))?\s*=', text))
+        for position, marker in enumerate(markers):
+            following = markers[position + 1].start() if position + 1 < len(markers) else len(text)
+            statistic = marker.group(1).lower()
+            columns = marker.group(2).split() if marker.group(2) else analysis_vars
+            names = text[marker.end():following].split()
+            for index, column in enumerate(columns):
+                if index < len(names):
+                    requests.append((statistic, column, names[index]))
+                elif autoname:
+                    suffix = self._means_statistics.get(statistic, (statistic.upper(),))[0]
+                    requests.append((statistic, column, f"{column}_{suffix}"))
+                elif not names:
+                    # A bare statistic= keeps the variable names
+                    requests.append((statistic, column, column))
+        return requests
+    
+    def _apply_output_options(self, columns: List[Tuple[str, str]], options: Optional[str]) -> List[Tuple[str, str]]:
+        # KEEP=/DROP=/RENAME= on an OUT= dataset
+        if not options:
+            return columns
+        parsed = SASAnalyzer._parse_dataset_options(options.strip()[1:-1])
+        keep = {column.lower() for column in parsed.get('keep', '').split()}
+        drop = {column.lower() for column in parsed.get('drop', '').split()}
+        renames = self.parse_renames([parsed.get('rename', '')])
+        selected = []
+        for name, expression in columns:
+            if keep and name.lower() not in keep or name.lower() in drop:
+                continue
+            new_name = renames.get(name.lower(), (None, None))[1]
+            selected.append((new_name, expression) if new_name else (name, expression))
+        return selected
+    
+    def translate_proc_freq(self, proc_content: str) -> str:
+        """PROC FREQ as one aggregation over the input.
+        
+        Printed output covers every TABLES request, one-way and crosstab alike, from a single
+        GROUPING SETS scan: _TABLE_ names the request each row belongs to, and PERCENT, the
+        cumulative columns of one-way tables and the row/column percents of two-way tables are
+        window functions over the counts. OUT= holds the last request of its TABLES statement,
+        as in SAS, with OUTCUM/OUTPCT adding those columns. WEIGHT sums positive weights instead
+        of counting rows; missing levels are left out unless MISSING is given.
+        """
+        try:
+            statements = [statement.strip() for statement in proc_content.split(';') if statement.strip()]
+            header = statements[0]
+            data_match = re.search(r'\bdata\s*=\s*(\w+(?:\.\w+)?)\s*(\((?:[^()]|\([^()]*\))*\))?', header, re.IGNORECASE)
+            if not data_match:
+                return "-- No data source specified in PROC FREQ"
+            header_options = SASAnalyzer._parse_dataset_options(header)
+            flags = [word.lower() for word in re.sub(r'\w+\s*=\s*(?:\((?:[^()]|\([^()]*\))*\)|\S+)', ' ', header).split()[2:]]
+            
+            requests, by_vars, conditions, notes = [], [], [], []
+            weight, output = None, None
+            input_options = SASAnalyzer._parse_dataset_options((data_match.group(2) or '()').strip()[1:-1])
+            if input_options.get('where'):
+                conditions.append(self._translate_condition(input_options['where']))
+            for statement in statements[1:]:
+                keyword, args = SASBlockScanner.split_keyword(statement)
+                args, _, statement_options = args.partition('/')
+                if keyword in ('tables', 'table'):
+                    tables = self._freq_requests(args)
+                    options = SASAnalyzer._parse_dataset_options(statement_options)
+                    words = [word.lower() for word in re.sub(r'\w+\s*=\s*(?:\((?:[^()]|\([^()]*\))*\)|\S+)', ' ',
+                                                             statement_options).split()]
+                    requests.extend((table, words) for table in tables)
+                    if 'out' in options and tables:
+                        if output is None:
+                            output = (options['out'].split()[0], tables[-1], words)
+                        else:
+                            notes.append(f"OUT={options['out']} not translated")
+                elif keyword == 'by':
+                    by_vars.extend(word for word in args.split() if word.lower() != 'descending')
+                elif keyword == 'where':
+                    conditions.append(self._translate_condition(args))
+                elif keyword == 'weight':
+                    weight = args.split()[0]
+            if not requests:
+                return "-- PROC FREQ needs a TABLES statement"
+            if weight:
+                # Observations with a missing or non-positive weight don't count
+                conditions.append(f"{weight} > 0")
+            
+            if output is not None:
+                out_name, table, words = output
+                tables = [table]
+                columns = ['percent'] + (['cumulative'] if 'outcum' in words else []) + \
+                          (['row_col'] if 'outpct' in words else [])
+                missing = 'missing' in words
+            elif 'noprint' in flags:
+                return "-- PROC FREQ with NOPRINT and no OUT= produces no table"
+            else:
+                tables = []
+                for table, _ in requests:
+                    if not any({column.lower() for column in table} == {column.lower() for column in seen}
+                               for seen in tables):
+                        tables.append(table)
+                words = [word for _, table_words in requests for word in table_words]
+                columns = [name for name, skip in (('percent', 'nopercent'), ('cumulative', 'nocum'),
+                                                   ('row_col', 'nopercent')) if skip not in words]
+                missing = 'missing' in words
+            
+            order = (header_options.get('order') or 'internal').split()[0].lower()
+            sql = self._freq_query(data_match.group(1), tables, by_vars, weight, conditions, missing, columns,
+                                   None if output is not None else order)
+            if output is not None:
+                sql = f"CREATE TABLE {out_name} AS\n{sql}"
+            if notes:
+                sql += f"\n/* Note: {'; '.join(notes)} */"
+            return sql
+        except Exception as e:
+            return f"-- Error translating PROC FREQ: {str(e)}"
+    
+    def _freq_requests(self, text: str) -> List[List[str]]:
+        """Variable lists of 'a b a*c (a b)*(c d)' table requests, crosstab groups expanded"""
+        tokens = re.findall(r'[()*]|[A-Za-z_]\w*', text)
+        terms = []
+        index = 0
+        joined = False
+        while index < len(tokens):
+            token = tokens[index]
+            if token == '*':
+                joined = True
+                index += 1
+                continue
+            if token == '(':
+                close = tokens.index(')', index)
+                factor = [word for word in tokens[index + 1:close] if word not in '()*']
+                index = close + 1
+            elif token == ')':
+                index += 1
+                continue
+            else:
+                factor = [token]
+                index += 1
+            if joined and terms:
+                terms[-1] = [combination + [word] for combination in terms[-1] for word in factor]
+            else:
+                terms.append([[word] for word in factor])
+            joined = False
+        return [combination for term in terms for combination in term]
+    
+    def _freq_query(self, input_table: str, tables: List[List[str]], by_vars: List[str], weight: Optional[str],
+                    conditions: List[str], missing: bool, columns: List[str], order: Optional[str]) -> str:
+        variables = []
+        for table in tables:
+            variables.extend(column for column in table if column.lower() not in map(str.lower, variables))
+        count = f"SUM({weight})" if weight else "COUNT(*)"
+        several = len(tables) > 1
+        labels = ['*'.join(table) for table in tables]
+        
+        def member(table: List[str]) -> Set[str]:
+            return {column.lower() for column in table}
+        
+        def for_tables(expression: str, chosen: List[int]) -> str:
+            # An expression that only applies to some of the requests
+            if not several:
+                return expression
+            names = ', '.join(f"'{labels[position]}'" for position in chosen)
+            return f"CASE WHEN _TABLE_ IN ({names}) THEN {expression} END"
+        
+        inner = list(by_vars)
+        having = []
+        if several:
+            cases = []
+            for table, label in zip(tables, labels):
+                grouping_id = sum(1 << (len(variables) - 1 - position) for position, column in enumerate(variables)
+                                  if column.lower() not in member(table))
+                cases.append(f"WHEN {grouping_id} THEN '{label}'")
+            inner.append(f"CASE GROUPING_ID({', '.join(variables)}) {' '.join(cases)} END AS _TABLE_")
+            sets = [f"({', '.join(by_vars + table)})" for table in tables]
+            group_by = f"GROUPING SETS ({', '.join(sets)})"
+            if not missing:
+                having = [f"({column} IS NOT NULL OR GROUPING({column}) = 1)" for column in variables]
+        else:
+            group_by = ', '.join(by_vars + variables)
+            if not missing:
+                conditions = conditions + [f"{column} IS NOT NULL" for column in variables]
+        inner.extend(variables)
+        inner.append(f"{count} AS COUNT")
+        sql = f"SELECT {', '.join(inner)}\nFROM {input_table}"
+        if conditions:
+            sql += f"\nWHERE {' AND '.join(conditions)}"
+        sql += f"\nGROUP BY {group_by}"
+        if having:
+            sql += f"\nHAVING {' AND '.join(having)}"
+        
+        partition = by_vars + (['_TABLE_'] if several else [])
+        over = f"PARTITION BY {', '.join(partition)}" if partition else ""
+        outer = (['_TABLE_'] if several else []) + by_vars + variables + ['COUNT']
+        if 'percent' in columns:
+            outer.append(f"100.0 * COUNT / SUM(COUNT) OVER ({over}) AS PERCENT")
+        one_way = [position for position, table in enumerate(tables) if len(table) == 1]
+        if 'cumulative' in columns and one_way:
+            levels = ', '.join((['COUNT DESC'] if order == 'freq' else []) +
+                               [tables[position][0] for position in one_way])
+            running = f"SUM(COUNT) OVER ({over}{' ' if over else ''}ORDER BY {levels} ROWS UNBOUNDED PRECEDING)"
+            outer.append(f"{for_tables(running, one_way)} AS CUM_FREQ")
+            outer.append(f"{for_tables(f'100.0 * {running} / SUM(COUNT) OVER ({over})', one_way)} AS CUM_PCT")
+        two_way = [position for position, table in enumerate(tables) if len(table) == 2]
+        if 'row_col' in columns and two_way:
+            for name, side in (('PCT_ROW', 0), ('PCT_COL', 1)):
+                # Each two-way request is partitioned by its own row (or column) variable
+                keys = []
+                for column in dict.fromkeys(tables[position][side] for position in two_way):
+                    chosen = [position for position in two_way if tables[position][side].lower() == column.lower()]
+                    keys.append(for_tables(column, chosen))
+                window = f"PARTITION BY {', '.join(partition + keys)}"
+                outer.append(f"{for_tables(f'100.0 * COUNT / SUM(COUNT) OVER ({window})', two_way)} AS {name}")
+        sql = f"SELECT {', '.join(outer)}\nFROM (\n{sql}\n) f"
+        if order:
+            order_by = list(by_vars)
+            if several:
+                positions = ' '.join(f"WHEN '{label}' THEN {position}" for position, label in enumerate(labels))
+                order_by.append(f"CASE _TABLE_ {positions} END")
+            # ORDER=FREQ lists the most frequent levels first
+            order_by += (['COUNT DESC'] if order == 'freq' else []) + variables
+            sql += f"\nORDER BY {', '.join(order_by)}"
+        return sql
+    
+    def translate_proc_sort(self, proc_content: str) -> Tuple[str, Optional[str]]:
+        """PROC SORT as (sql, ORDER BY list); the list is None when nothing was translated.
+        
+        The sort writes OUT=, or rewrites DATA= in place. NODUPKEY keeps one row per BY key
+        through ROW_NUMBER() in QUALIFY (in Spark, a subquery whose rank column * EXCEPT leaves
+        out: Databricks SQL, unless ColumnLineage lists the columns; the PySpark output drops
+        it instead); SQL has no input order, so which row of a key survives is not SAS's first
+        observation. NODUPRECS drops duplicate rows with DISTINCT. The ORDER BY
+        always comes last, so the caller can drop it when no reader needs the rows in order.
+        """
+        try:
+            statements = [statement.strip() for statement in proc_content.split(';') if statement.strip()]
+            header = statements[0]
+            data_match = re.search(r'\bdata\s*=\s*(\w+(?:\.\w+)?)\s*(\((?:[^()]|\([^()]*\))*\))?', header, re.IGNORECASE)
+            if not data_match:
+                return "-- No data source specified in PROC SORT", None
+            out_match = re.search(r'\bout\s*=\s*(\w+(?:\.\w+)?)\s*(\((?:[^()]|\([^()]*\))*\))?', header, re.IGNORECASE)
+            flags = [word.lower() for word in re.sub(r'\w+\s*=\s*(?:\((?:[^()]|\([^()]*\))*\)|\S+)', ' ', header).split()[2:]]
+            
+            by_keys, conditions, notes = [], [], []
+            input_options = SASAnalyzer._parse_dataset_options((data_match.group(2) or '()').strip()[1:-1])
+            output_options = SASAnalyzer._parse_dataset_options((out_match.group(2) or '()').strip()[1:-1]
+                                                                if out_match else '')
+            if input_options.get('where'):
+                conditions.append(self._translate_condition(input_options['where']))
+            for statement in statements[1:]:
+                keyword, args = SASBlockScanner.split_keyword(statement)
+                if keyword == 'by':
+                    by_keys.extend(self._by_keys(args))
+                elif keyword == 'where':
+                    conditions.append(self._translate_condition(args))
+            if not by_keys:
+                return "-- PROC SORT needs a BY statement", None
+            if re.search(r'\bdupout\s*=', header, re.IGNORECASE):
+                notes.append("DUPOUT= not translated")
+            unsupported = sorted((set(input_options) | set(output_options)) - {'where', 'keep'})
+            if unsupported:
+                notes.append(f"dataset options not translated: {', '.join(unsupported).upper()}")
+            
+            # KEEP= on either side names the columns; otherwise every column is carried
+            keep = (output_options.get('keep') or input_options.get('keep') or '').split()
+            columns = ', '.join(keep) if keep else '*'
+            keys = ', '.join(column for column, _ in by_keys)
+            order_by = ', '.join(f"{column} DESC" if descending else column for column, descending in by_keys)
+            source = data_match.group(1)
+            where = f"\nWHERE {' AND '.join(conditions)}" if conditions else ""
+            if 'nodupkey' in flags:
+                rank = f"ROW_NUMBER() OVER (PARTITION BY {keys} ORDER BY {order_by})"
+                if self.dialect == 'spark':
+                    # No QUALIFY in Spark: rank in a subquery, and keep the rank out of the table
+                    sql = (f"SELECT {'* EXCEPT (_dup_rank)' if columns == '*' else columns}\nFROM (\n"
+                           f"SELECT {'t.*' if columns == '*' else columns}, {rank} AS _dup_rank\n"
+                           f"FROM {source} t{where}\n) s\nWHERE _dup_rank = 1")
+                else:
+                    sql = f"SELECT {columns}\nFROM {source}{where}\nQUALIFY {rank} = 1"
+            elif 'noduprecs' in flags or 'nodup' in flags:
+                sql = f"SELECT DISTINCT {columns}\nFROM {source}{where}"
+            else:
+                sql = f"SELECT {columns}\nFROM {source}{where}"
+            sql = f"CREATE TABLE {out_match.group(1) if out_match else source} AS\n{sql}\nORDER BY {order_by}"
+            if notes:
+                sql += f"\n/* Note: {'; '.join(notes)} */"
+            return sql, order_by
+        except Exception as e:
+            return f"-- Error translating PROC SORT: {str(e)}", None
+    
+    def translate_proc_transpose(self, proc_content: str) -> str:
+        """PROC TRANSPOSE with BY/ID/VAR as one pass over the input.
+        
+        Each ID value becomes a column, so the values must be known up front: they come from
+        column_values, filled from DATALINES tables and the caller's catalog. Spark gets a PIVOT
+        (stack() first unpivots several VAR variables into _NAME_ rows); elsewhere it is
+        MAX(CASE WHEN ...) per ID value, with several VAR variables unpivoted by a cross join
+        against their names instead of one scan each. Without an ID statement the columns
+        depend on row order, which SQL doesn't keep, so those are not translated.
+        """
+        try:
+            statements = [statement.strip() for statement in proc_content.split(';') if statement.strip()]
+            header = statements[0]
+            data_match = re.search(r'\bdata\s*=\s*(\w+(?:\.\w+)?)\s*(\((?:[^()]|\([^()]*\))*\))?', header, re.IGNORECASE)
+            if not data_match:
+                return "-- No data source specified in PROC TRANSPOSE"
+            header_options = SASAnalyzer._parse_dataset_options(header)
+            
+            by_vars, id_vars, transposed, conditions, notes = [], [], [], [], []
+            input_options = SASAnalyzer._parse_dataset_options((data_match.group(2) or '()').strip()[1:-1])
+            if input_options.get('where'):
+                conditions.append(self._translate_condition(input_options['where']))
+            for statement in statements[1:]:
+                keyword, args = SASBlockScanner.split_keyword(statement)
+                if keyword == 'by':
+                    by_vars.extend(word for word in args.split() if word.lower() != 'descending')
+                elif keyword == 'id':
+                    id_vars.extend(args.split())
+                elif keyword == 'var':
+                    transposed.extend(args.split())
+                elif keyword == 'where':
+                    conditions.append(self._translate_condition(args))
+                elif keyword in ('idlabel', 'copy'):
+                    notes.append(f"{keyword.upper()} statement not translated")
+            if not id_vars:
+                return "-- PROC TRANSPOSE without an ID statement depends on row order and is not translated"
+            if len(id_vars) > 1:
+                return "-- PROC TRANSPOSE with several ID variables is not translated"
+            if not transposed:
+                return "-- PROC TRANSPOSE needs a VAR statement naming the variables to transpose"
+            source = data_match.group(1)
+            id_var = id_vars[0]
+            values = self.column_values.get(source.lower(), {}).get(id_var.lower())
+            if not values:
+                return (f"-- PROC TRANSPOSE needs the distinct values of {id_var} in {source}; "
+                        f"supply them through column_values")
+            
+            name_column = (header_options.get('name') or '_NAME_').split()[0]
+            prefix = (header_options.get('prefix') or '').split()[0] if header_options.get('prefix') else ''
+            suffix = (header_options.get('suffix') or '').split()[0] if header_options.get('suffix') else ''
+            numeric = all(self.type_inferrer._is_number(str(value).strip()) for value in values)
+            literals = [str(value) if numeric else "'" + str(value).replace("'", "''") + "'" for value in values]
+            columns = [self._transpose_column(prefix + str(value) + suffix, bool(prefix)) for value in values]
+            where = f"\nWHERE {' AND '.join(conditions)}" if conditions else ""
+            
+            if self.dialect == 'spark':
+                if len(transposed) == 1:
+                    unpivot = f"'{transposed[0]}' AS {name_column}, {transposed[0]} AS _VALUE_"
+                else:
+                    pairs = ', '.join(f"'{column}', {column}" for column in transposed)
+                    unpivot = f"stack({len(transposed)}, {pairs}) AS ({name_column}, _VALUE_)"
+                pivoted = ', '.join(f"{literal} AS {column}" for literal, column in zip(literals, columns))
+                sql = (f"SELECT *\nFROM (\nSELECT {', '.join(by_vars + [id_var])}, {unpivot}\nFROM {source}{where}\n) t\n"
+                       f"PIVOT (MAX(_VALUE_) FOR {id_var} IN ({pivoted}))")
+            else:
+                if len(transposed) == 1:
+                    value, name, join = transposed[0], f"'{transposed[0]}' AS {name_column}", ""
+                    group_by = by_vars
+                else:
+                    cases = ' '.join(f"WHEN '{column}' THEN {column}" for column in transposed)
+                    value = f"CASE v.{name_column} {cases} END"
+                    name = f"v.{name_column}"
+                    names = ', '.join(f"('{column}')" for column in transposed)
+                    join = f"\nCROSS JOIN (VALUES {names}) AS v({name_column})"
+                    group_by = by_vars + [f"v.{name_column}"]
+                select = by_vars + [name] + [f"MAX(CASE WHEN {id_var} = {literal} THEN {value} END) AS {column}"
+                                             for literal, column in zip(literals, columns)]
+                sql = f"SELECT {', '.join(select)}\nFROM {source}{join}{where}"
+                if group_by:
+                    sql += f"\nGROUP BY {', '.join(group_by)}"
+            
+            out_match = re.search(r'\bout\s*=\s*(\w+(?:\.\w+)?)', header, re.IGNORECASE)
+            if out_match:
+                sql = f"CREATE TABLE {out_match.group(1)} AS\n{sql}"
+            if notes:
+                sql += f"\n/* Note: {'; '.join(notes)} */"
+            return sql
+        except Exception as e:
+            return f"-- Error translating PROC TRANSPOSE: {str(e)}"
+    
+    def _transpose_column(self, text: str, prefixed: bool) -> str:
+        # ID values become SAS names: other characters turn into underscores, digits can't lead
+        name = re.sub(r'\W', '_', text.strip())
+        if name[:1].isdigit() and not prefixed:
+            name = '_' + name
+        return name
+    
     def translate_proc_print(self, proc_content: str) -> str:
         try:
-            data_match = re.search(r'data\s*=\s*(\w+)', proc_content, re.IGNORECASE)
+            data_match = re.search(r'data\s*=\s*(\w+(?:\.\w+)?)', proc_content, re.IGNORECASE)
             var_match = re.search(r'var\s+([^;]+);', proc_content, re.IGNORECASE)
             where_match = re.search(r'where\s+([^;]+);', proc_content, re.IGNORECASE)
             
@@ -648,7 +3235,7 @@ class SASToSQLTranslator:
             
             input_table = data_match.group(1)
             columns = ", ".join([v.strip() for v in var_match.group(1).split()]) if var_match else "*"
-            where_clause = f"WHERE {self.function_translator.translate(where_match.group(1).rstrip(';'))}" if where_match else ""
+            where_clause = f"WHERE {self._translate_condition(where_match.group(1))}" if where_match else ""
             
             sql = f"SELECT {columns}\nFROM {input_table}"
             if where_clause:
@@ -657,97 +3244,511 @@ class SASToSQLTranslator:
         except Exception as e:
             return f"-- Error translating PROC PRINT: {str(e)}"
 
+class DependencyGraph:
+    """Table dependency graph of one program, indexed once so consolidation lookups are O(1)"""
+
+    def __init__(self, components: Dict, individual_queries: List[Dict] = None):
+        # Forward edges: table -> tables it reads, in program order so schedules are deterministic
+        self.dependencies = {}
+        for data_step in components.get('data_steps', []):
+            self.dependencies[data_step['table_name']] = list(data_step.get('source_tables', []))
+        for procedure in components.get('procedures', []):
+            table_name = procedure.get('creates_table')
+            if table_name:
+                self.dependencies.setdefault(table_name, []).extend(procedure.get('data_sources', []))
+        for table_name in components.get('tables', []):
+            self.dependencies.setdefault(table_name, [])
+        
+        # Reverse edges: table -> tables reading it
+        self.dependents = defaultdict(set)
+        for table_name, sources in self.dependencies.items():
+            for source in sources:
+                self.dependents[source].add(table_name)
+        
+        # First query creating each table
+        self.creating_queries = {}
+        for query in individual_queries or []:
+            if query['type'] == 'DATA_STEP':
+                table_name = query.get('table_name')
+            else:
+                table_name = query.get('creates_table')
+            if table_name:
+                self.creating_queries.setdefault(table_name, query)
+        # Procedures rewriting a table in place (PROC SORT without OUT=), in program order
+        self.rewrites = defaultdict(list)
+        for query in individual_queries or []:
+            table_name = query.get('creates_table')
+            if (query['type'] != 'DATA_STEP' and table_name and self.creating_queries[table_name] is not query
+                    and query.get('source') is not None and table_name in query['source'].get('data_sources', [])):
+                self.rewrites[table_name].append(query)
+        
+        # Final outputs are not read by another step and are either created by a procedure
+        # or by the program's last step; they are not turned into CTEs
+        used = {source for table_name, sources in components.get('table_dependencies', {}).items()
+                for source in sources if source != table_name}
+        for procedure in components.get('procedures', []):
+            used.update(source for source in procedure.get('data_sources', [])
+                        if source != procedure.get('creates_table'))
+        last_query = individual_queries[-1] if individual_queries else None
+        self.final_outputs = set()
+        for table_name, query in self.creating_queries.items():
+            if table_name in used:
+                continue
+            if query['type'] != 'DATA_STEP' or query is last_query:
+                self.final_outputs.add(table_name)
+        
+        self._schedule = None
+    
+    def creating_query(self, table_name: str) -> Optional[Dict]:
+        return self.creating_queries.get(table_name)
+    
+    def is_final_output(self, table_name: str) -> bool:
+        return table_name in self.final_outputs
+    
+    def schedule(self) -> Dict:
+        """Execution order, levels of tables that can be computed concurrently, and dependency cycles.
+        
+        Kahn's algorithm, one level at a time: a table is ready once every table it reads that
+        the program creates is done. Tables reading themselves (in-place rewrites) are not cycles.
+        Tables on or downstream of a cycle are appended to the order after the levels.
+        """
+        if self._schedule is not None:
+            return self._schedule
+        position = {table_name: index for index, table_name in enumerate(self.dependencies)}
+        pending = {table_name: len({source for source in sources if source in position and source != table_name})
+                   for table_name, sources in self.dependencies.items()}
+        
+        levels = []
+        order = []
+        level = [table_name for table_name, count in pending.items() if count == 0]
+        while level:
+            levels.append(level)
+            order.extend(level)
+            next_level = []
+            for table_name in level:
+                for dependent in self.dependents.get(table_name, ()):
+                    if dependent == table_name:
+                        continue
+                    pending[dependent] -= 1
+                    if pending[dependent] == 0:
+                        next_level.append(dependent)
+            level = sorted(next_level, key=position.__getitem__)
+        
+        blocked = [table_name for table_name in self.dependencies if pending[table_name] > 0]
+        order.extend(blocked)
+        self._schedule = {'order': order, 'levels': levels, 'cycles': self._find_cycles(set(blocked))}
+        return self._schedule
+    
+    def _find_cycles(self, blocked: Set[str]) -> List[List[str]]:
+        # Every blocked table reads another blocked table, so walking those edges always
+        # ends on a table already on the path (a new cycle) or on one walked before
+        cycles = []
+        walked = set()
+        for start in self.dependencies:
+            if start not in blocked or start in walked:
+                continue
+            path = []
+            on_path = {}
+            table_name = start
+            while table_name not in on_path and table_name not in walked:
+                on_path[table_name] = len(path)
+                path.append(table_name)
+                table_name = next(source for source in self.dependencies[table_name]
+                                  if source in blocked and source != table_name)
+            if table_name in on_path:
+                cycles.append(path[on_path[table_name]:] + [table_name])
+            walked.update(path)
+        return cycles
+    
+    def downstream(self, tables: Set[str]) -> Set[str]:
+        """The given tables plus every table that reads them, directly or not"""
+        result = set(tables)
+        pending = list(tables)
+        while pending:
+            for dependent in self.dependents.get(pending.pop(), ()):
+                if dependent not in result:
+                    result.add(dependent)
+                    pending.append(dependent)
+        return result
+
+class ColumnLineage:
+    """Column-level lineage of a program's tables and the projections it allows.
+    
+    A forward pass over the translated steps, in dependency order, records each table's
+    output columns and where each comes from: a column of a source table, or the columns a
+    calculated field reads. Tables the program reads but does not create are open: only the
+    columns some step references are known, others may still pass through a *. DROP and
+    RENAME of a DATA step remove columns from what its * passes on.
+    
+    A backward pass from the final query then collects the columns every intermediate table
+    in the statement must provide, and prune() rewrites its SELECT list to exactly those,
+    expanding * where the columns are known. Anything ambiguous (a column that could come
+    from more than one open source, nested queries, set operations, DISTINCT) keeps its *.
+    """
+    
+    def __init__(self, components: Dict, graph: DependencyGraph, bodies: Dict[str, str],
+                 final_sql: Optional[str] = None):
+        self.tree = SQLQueryTree()
+        # Lower-cased table name -> {column lower: display name} in output order, and whether
+        # unknown columns may pass through
+        self.columns = {}
+        self.open = {}
+        # Lower-cased table name -> {column lower: ['table.column', ...]}
+        self.origins = {}
+        # Lower-cased table name -> columns readers need (lower-cased), None for all of them
+        self.required = {}
+        self.nodes = {}
+        self._names = {}
+        try:
+            self._forward(components, graph, bodies)
+            self._backward(graph, final_sql)
+        except Exception as e:
+            print(f"Error computing column lineage: {str(e)}")
+            self.nodes = {}
+    
+    def prune(self, table_name: str, sql: str) -> str:
+        """The table's query with its SELECT lists cut down to the columns readers need"""
+        try:
+            node = self.nodes.get(table_name.lower())
+            if node is None or not self._has_projection(node):
+                return sql
+            return self.tree.render(node['tokens'], node)
+        except Exception:
+            return sql
+    
+    def _has_projection(self, node: Dict) -> bool:
+        return node.get('projection') is not None or any(
+            self._has_projection(item['node']) for item in node['items'] if item['node'] is not None)
+    
+    def _projection(self, node: Dict, needed: Optional[Set[str]]) -> Optional[List[str]]:
+        """Select items producing exactly the needed columns, None if the node can't be cut down"""
+        if node['distinct'] or node['set_operation'] or node['select'] is None:
+            return None
+        items = []
+        produced = set()
+        for item in node['select_items']:
+            if item['star'] is None:
+                if item['name'] is None and needed is None or item['name'] is not None and (
+                        needed is None or item['name'] in needed):
+                    items.append(item['text'])
+                    produced.add(item['name'])
+                continue
+            indexes = self._star_sources(node, item['star'])
+            if needed is None:
+                if any(node['sources'][index][1] for index in indexes):
+                    return None
+                columns = [column for column, index in node['star_columns'].items() if index in indexes]
+            else:
+                columns = [column for column in node['star_columns']
+                           if column in needed and node['star_columns'][column] in indexes]
+                columns += sorted(column for column in needed - set(node['star_columns']) - node['named']
+                                  - item['except'] if self._star_source(node, column) in indexes)
+            for column in columns:
+                index = node['star_columns'].get(column, self._star_source(node, column))
+                display = node['sources'][index][0].get(column, self._names.get(column, column))
+                qualifier = item['star'] or (self._item_name(node['items'][index])
+                                             if len(node['items']) > 1 and column not in node['using'] else '')
+                items.append(f"{qualifier}.{display}" if qualifier else display)
+                produced.add(column)
+        if not items or needed is not None and needed - produced:
+            return None
+        return items
+    
+    def report(self) -> Dict[str, Dict]:
+        """Per table: its columns with their origins, and the columns readers need (None for all)"""
+        return {table: {'columns': {self.columns[table][column]: origins
+                                    for column, origins in self.origins.get(table, {}).items()},
+                        'open': self.open.get(table, True),
+                        'required': sorted(self.required[table]) if self.required.get(table) is not None else None}
+                for table in self.origins}
+    
+    def _forward(self, components: Dict, graph: DependencyGraph, bodies: Dict[str, str]):
+        steps = {step['table_name'].lower(): step for step in components.get('data_steps', [])}
+        translator = SASToSQLTranslator()
+        for table_name in graph.schedule()['order']:
+            key = table_name.lower()
+            step = steps.get(key)
+            if step is not None and step.get('has_datalines'):
+                self.columns[key] = {column.lower(): column for column in step['operations'].get('input', [])}
+                self.open[key] = False
+                self.origins[key] = {column: [] for column in self.columns[key]}
+                continue
+            node = self.tree.parse(bodies[table_name], table_name) if table_name in bodies else None
+            if node is None:
+                continue
+            excluded = set()
+            if step is not None:
+                # Dropped columns and the old names of renamed ones don't pass through *
+                operations = step['operations']
+                excluded.update(column.lower() for column in operations.get('drop', []))
+                excluded.update(translator.parse_renames(operations.get('rename', [])))
+                for options in operations.get('dataset_options', {}).values():
+                    excluded.update(column.lower() for column in options.get('drop', '').split())
+                    excluded.update(translator.parse_renames([options.get('rename', '')]))
+            self._node_columns(node, excluded)
+            self.nodes[key] = node
+            self.columns[key] = node['columns']
+            self.open[key] = node['open']
+            self.origins[key] = node['origins']
+    
+    def _node_columns(self, node: Dict, excluded: Set[str] = frozenset()):
+        """Fill in node['sources'], node['columns'], node['open'], node['origins'] and node['star_columns']"""
+        sources = []
+        for item in node['items']:
+            if item['node'] is not None:
+                self._node_columns(item['node'])
+                sources.append(({}, True, None) if item.get('pivot') else
+                               (item['node']['columns'], item['node']['open'], None))
+            elif item['table'] is None:
+                # VALUES lists and other derived tables that aren't queries
+                sources.append(({}, True, None))
+            else:
+                key = item['table'].lower()
+                self.columns.setdefault(key, {})
+                self.open.setdefault(key, True)
+                sources.append((self.columns[key], self.open[key], key))
+        node['sources'] = sources
+        node['named'] = {item['name'] for item in node['select_items'] if item['star'] is None and item['name']}
+        
+        refs = [(qualifier, column) for qualifier, column in node['refs'] or []
+                if not self._is_output_alias(node, qualifier, column)]
+        for item in node['select_items']:
+            refs.extend(item['refs'] or [])
+        for qualifier, column in refs:
+            index = self._attribute(node, qualifier, column)
+            if index is not None and sources[index][2] is not None and sources[index][1]:
+                # A column read from an open table is known to exist there
+                self.columns[sources[index][2]].setdefault(column.lower(), column)
+        for column in node['using']:
+            for _, is_open, key in sources:
+                if key is not None and is_open:
+                    self.columns[key].setdefault(column, self._names.get(column, column))
+        
+        columns, origins, star_columns = {}, {}, {}
+        is_open = False
+        for item in node['select_items']:
+            if item['star'] is not None:
+                for index in self._star_sources(node, item['star']):
+                    is_open = is_open or sources[index][1]
+                    for column, display in list(sources[index][0].items()):
+                        if (column in excluded or column in item['except'] or column in node['named']
+                                or column in columns):
+                            continue
+                        columns[column] = display
+                        star_columns[column] = index
+                        origins[column] = [self._origin(node, index, display)]
+            elif item['name'] is not None and item['name'] not in excluded:
+                columns[item['name']] = item['display']
+                origins[item['name']] = []
+                for qualifier, column in item['refs'] or []:
+                    index = self._attribute(node, qualifier, column)
+                    if index is not None:
+                        origins[item['name']].append(self._origin(node, index, column))
+        node['columns'], node['origins'], node['star_columns'], node['open'] = columns, origins, star_columns, is_open
+    
+    def _backward(self, graph: DependencyGraph, final_sql: Optional[str]):
+        if final_sql:
+            final = self.tree.parse(final_sql, 'final query')
+            if final is not None:
+                self._node_columns(final)
+                self._require(final, None)
+        # Readers come later in the order, so a table's requirements are complete when it is reached
+        for table_name in reversed(graph.schedule()['order']):
+            node = self.nodes.get(table_name.lower())
+            if node is not None:
+                self._require(node, self.required.get(table_name.lower()) or None)
+    
+    def _require(self, node: Dict, needed: Optional[Set[str]]):
+        # The select list is cut down here, so what the node reads matches what it will compute;
+        # a node that can't be cut down computes, and reads for, all of its columns
+        items = self._projection(node, needed)
+        if items is None:
+            needed = None
+        elif items != [item['text'] for item in node['select_items']]:
+            node['projection'] = ", ".join(items)
+        sources = node['sources']
+        demands = [set() for _ in sources]
+        
+        def demand(index: Optional[int], column: str, candidates: List[int]):
+            self._names.setdefault(column.lower(), column)
+            if index is not None:
+                if demands[index] is not None:
+                    demands[index].add(column.lower())
+                return
+            # Unattributable: every open source it could come from keeps all its columns
+            for candidate in candidates:
+                if sources[candidate][1]:
+                    demands[candidate] = None
+        
+        everything = list(range(len(sources)))
+        star_indexes = sorted({index for item in node['select_items'] if item['star'] is not None
+                               for index in self._star_sources(node, item['star'])})
+        if star_indexes and needed is None:
+            for index in star_indexes:
+                demands[index] = None
+        elif star_indexes:
+            for column in needed - node['named']:
+                demand(self._star_source(node, column), column, star_indexes)
+        for item in node['select_items']:
+            if item['star'] is not None or needed is not None and item['name'] not in needed:
+                continue
+            if item['refs'] is None:
+                demands = [None] * len(sources)
+                continue
+            for qualifier, column in item['refs']:
+                demand(self._attribute(node, qualifier, column), column, everything)
+        if node['refs'] is None:
+            demands = [None] * len(sources)
+        else:
+            for qualifier, column in node['refs']:
+                if not self._is_output_alias(node, qualifier, column):
+                    demand(self._attribute(node, qualifier, column), column, everything)
+        for column in node['using']:
+            for index in everything:
+                demand(index, column, everything)
+        
+        for item, demanded in zip(node['items'], demands):
+            if item['node'] is not None:
+                self._require(item['node'], None if item.get('pivot') else demanded)
+                continue
+            if item['table'] is None:
+                continue
+            key = item['table'].lower()
+            if demanded is None or self.required.get(key, set()) is None:
+                self.required[key] = None
+            else:
+                self.required.setdefault(key, set()).update(demanded)
+    
+    def _is_output_alias(self, node: Dict, qualifier: Optional[str], column: str) -> bool:
+        # ORDER BY / HAVING / GROUP BY on a name the select list defines rather than a source column
+        return (qualifier is None and column.lower() in node['named']
+                and not any(column.lower() in source[0] for source in node['sources'])
+                and node['outputs'].get(column.lower()) != column)
+    
+    def _attribute(self, node: Dict, qualifier: Optional[str], column: str) -> Optional[int]:
+        """Index of the FROM item a column reference reads, None if it can't be told"""
+        items = node['items']
+        if qualifier is not None:
+            matches = [index for index, item in enumerate(items)
+                       if qualifier.lower() == self._item_name(item).lower()]
+            return matches[0] if len(matches) == 1 else None
+        if len(items) == 1:
+            return 0
+        known = [index for index, source in enumerate(node['sources']) if column.lower() in source[0]]
+        if known:
+            return known[0]
+        open_sources = [index for index, source in enumerate(node['sources']) if source[1]]
+        return open_sources[0] if len(open_sources) == 1 else None
+    
+    def _star_source(self, node: Dict, column: str) -> Optional[int]:
+        """Index of the FROM item a column passing through the node's * items comes from"""
+        column = column.lower()
+        if column in node.get('star_columns', {}):
+            return node['star_columns'][column]
+        candidates = sorted({index for item in node['select_items'] if item['star'] is not None
+                             for index in self._star_sources(node, item['star'])})
+        open_candidates = [index for index in candidates if node['sources'][index][1]]
+        return open_candidates[0] if len(open_candidates) == 1 else None
+    
+    def _star_sources(self, node: Dict, qualifier: str) -> List[int]:
+        if not qualifier:
+            return list(range(len(node['items'])))
+        return [index for index, item in enumerate(node['items'])
+                if self._item_name(item).lower() == qualifier.lower()]
+    
+    def _item_name(self, item: Dict) -> str:
+        return item['alias'] or (item['table'] or '').split('.')[-1]
+    
+    def _origin(self, node: Dict, index: int, column: str) -> str:
+        item = node['items'][index]
+        return f"{item['table'] or self._item_name(item) or 'subquery'}.{column}"
+
 class SQLConsolidator:
-    def __init__(self):
+    # String literals, quoted identifiers and comments are single tokens so nothing inside them is rewritten
+    _sql_token_re = re.compile(r"""'(?:[^']|'')*'?|"(?:[^"]|"")*"?|--[^\n]*|/\*.*?(?:\*/|\Z)|\d[\w.]*|[A-Za-z_][\w$]*|\s+|.""", re.DOTALL)
+    # Keywords followed by a table name, and keywords that end a FROM list
+    _table_keywords = {'from', 'join', 'into', 'update', 'table'}
+    _clause_keywords = {'where', 'group', 'order', 'having', 'on', 'using', 'limit', 'union', 'except',
+                        'intersect', 'select', 'set', 'values', 'window', 'qualify'}
+    _join_keywords = {'join', 'inner', 'left', 'right', 'full', 'outer', 'cross', 'natural', 'lateral', 'anti', 'semi'}
+
+    def __init__(self, dialect: str = 'default', inline_max_consumers: int = 1, cache_min_consumers: int = 3):
         self.cte_counter = 0
+        self.dialect = dialect
+        # Materialization thresholds, in references to an intermediate table within the statement
+        self.inline_max_consumers = inline_max_consumers
+        self.cache_min_consumers = cache_min_consumers
     
-    def consolidate_queries(self, components: Dict, individual_queries: List[Dict]) -> str:
+    def consolidate_queries(self, components: Dict, individual_queries: List[Dict],
+                            graph: DependencyGraph = None, plan: Dict[str, Dict] = None,
+                            lineage: ColumnLineage = None) -> str:
         try:
-            # Build dependency graph
-            dependency_graph = self._build_dependency_graph(components)
-            
-            # Get execution order (topological sort)
-            execution_order = self._topological_sort(dependency_graph)
-            
-            cte_definitions = []
-            final_queries = []
-            
-            # Process tables in dependency order - only create CTEs for intermediate tables
-            for table_name in execution_order:
-                # Skip creating CTEs for final output tables that are not used elsewhere
-                if self._is_final_output_table(table_name, components, individual_queries):
-                    continue
-                    
-                creating_query = self._find_creating_query(table_name, individual_queries)
-                if creating_query:
-                    cte_name = f"cte_{table_name}"
-                    
-                    # Get the SQL for this CTE
-                    query_sql = creating_query['sql']
-                    
-                    # For data steps, we need to ensure all conditions are included
-                    if creating_query['type'] == 'DATA_STEP':
-                        if not query_sql.strip().upper().startswith('SELECT'):
-                            # Handle CREATE TABLE statements
-                            create_match = re.search(r'CREATE TABLE \w+ AS\s*(.*)', query_sql, re.DOTALL | re.IGNORECASE)
-                            if create_match:
-                                query_sql = create_match.group(1).strip()
-                    
-                    # Remove any trailing semicolons
-                    query_sql = query_sql.rstrip(';').strip()
-                    cte_def = f"{cte_name} AS (\n{self._indent_sql(query_sql)}\n)"
-                    cte_definitions.append(cte_def)
-                    
-                    # Also create CTEs for PROC SQL that create tables (if they're intermediate)
-                    if (creating_query['type'] == 'PROC_SQL' and 
-                        creating_query.get('creates_table') and
-                        not self._is_final_output_table(table_name, components, individual_queries)):
-                        query_sql = creating_query['sql']
-                        create_match = re.search(r'CREATE TABLE \w+ AS\s*(.*)', query_sql, re.DOTALL | re.IGNORECASE)
-                        if create_match:
-                            query_sql = create_match.group(1).strip()
-                            query_sql = query_sql.rstrip(';').strip()
-                            cte_def = f"{cte_name} AS (\n{self._indent_sql(query_sql)}\n)"
-                            cte_definitions.append(cte_def)
-            
-            # Find the final query (usually the last PROC SQL that doesn't create a table)
-            for query in reversed(individual_queries):
-                if query['type'] == 'PROC_SQL' and not query.get('creates_table'):
-                    final_query = query['sql']
-                    
-                    # Remove CREATE TABLE statement if present
-                    final_query = re.sub(r'CREATE TABLE \w+ AS\s*', '', final_query, flags=re.IGNORECASE)
-                    
-                    # Replace table references with CTEs
-                    for table_name in execution_order:
-                        if not self._is_final_output_table(table_name, components, individual_queries):
-                            cte_name = f"cte_{table_name}"
-                            final_query = re.sub(rf'\b{re.escape(table_name)}\b', cte_name, final_query)
-                    
-                    # Remove any trailing semicolons
-                    final_query = final_query.rstrip(';').strip()
-                    final_queries.append(final_query)
-                    break
+            # Build dependency graph
+            if graph is None:
+                graph = DependencyGraph(components, individual_queries)
+            if plan is None:
+                plan = self.plan_materialization(individual_queries, graph)
+            if lineage is None:
+                lineage = self.column_lineage(components, individual_queries, graph, plan)
             
-            # If no final query found, use the last query
-            if not final_queries and individual_queries:
-                final_query = individual_queries[-1]['sql']
-                # Remove CREATE TABLE statement if present
-                final_query = re.sub(r'CREATE TABLE \w+ AS\s*', '', final_query, flags=re.IGNORECASE)
-                
-                for table_name in execution_order:
-                    if not self._is_final_output_table(table_name, components, individual_queries):
-                        cte_name = f"cte_{table_name}"
-                        final_query = re.sub(rf'\b{re.escape(table_name)}\b', cte_name, final_query)
-                
-                # Remove any trailing semicolons
-                final_query = final_query.rstrip(';').strip()
-                final_queries.append(final_query)
+            # Get execution order (topological sort)
+            schedule = graph.schedule()
+            
+            preamble = []
+            cte_definitions = []
+            # Lower-cased table name -> CTE name, and -> SQL of tables inlined as subqueries
+            cte_names = {}
+            inline_bodies = {}
+            
+            # Process tables in dependency order; upstream tables are already renamed or inlined,
+            # the table itself is not yet, so a step that rewrites a table in place reads the original
+            for table_name in schedule['order']:
+                decision = plan.get(table_name)
+                if decision is None:
+                    continue
+                # Each table only computes the columns its readers use
+                query_sql = self._rewrite_table_references(
+                    lineage.prune(table_name, self._table_body(graph, table_name)),
+                    cte_names, inline_bodies)
+                cte_name = "cte_" + re.sub(r'\W', '_', table_name)
+                strategy = decision['strategy']
+                if strategy == 'statement':
+                    preamble.append(f"{query_sql};")
+                elif strategy == 'inline':
+                    inline_bodies[table_name.lower()] = query_sql
+                elif strategy == 'materialize':
+                    preamble.append(f"{self._materialize_statement(cte_name)} AS\n{query_sql.rstrip()};")
+                    cte_names[table_name.lower()] = cte_name
+                elif strategy == 'table':
+                    preamble.append(f"CREATE TABLE {table_name} AS\n{query_sql.rstrip()};")
+                else:
+                    cte_definitions.append(f"{cte_name} AS (\n{self._indent_sql(query_sql)}\n)")
+                    cte_names[table_name.lower()] = cte_name
+            
+            final_queries = []
+            final_query = self._select_final_query(individual_queries)
+            if final_query is not None:
+                final_queries.append(self._rewrite_table_references(
+                    self._query_body(final_query), cte_names, inline_bodies))
             
             # Build the final SQL
             consolidated_sql = ""
+            for cycle in schedule['cycles']:
+                consolidated_sql += f"-- Dependency cycle (each table reads the next): {' -> '.join(cycle)}\n"
+            if self.dialect == 'spark' and any(PySparkGenerator._star_except_re.search(sql)
+                                               for sql in preamble + cte_definitions + final_queries):
+                consolidated_sql += ("-- SELECT * EXCEPT (...) drops helper columns where lineage can't list the "
+                                     "columns; it needs Databricks SQL (the PySpark output drops them instead)\n")
+            if plan:
+                consolidated_sql += (f"-- Materialization plan (inline up to {self.inline_max_consumers} reader(s), "
+                                     f"materialize from {self.cache_min_consumers}):\n")
+                for table_name, decision in plan.items():
+                    consolidated_sql += f"--   {table_name}: {decision['strategy']} - {decision['reason']}\n"
+                consolidated_sql += "\n"
+            for statement in preamble:
+                consolidated_sql += statement + "\n\n"
             if cte_definitions:
-                consolidated_sql = "WITH " + ",\n".join(cte_definitions) + "\n\n"
+                consolidated_sql += "WITH " + ",\n".join(cte_definitions) + "\n\n"
             if final_queries:
                 consolidated_sql += final_queries[0]
             
@@ -757,89 +3758,194 @@ class SQLConsolidator:
             import traceback
             return f"-- Error consolidating SQL: {str(e)}\n{traceback.format_exc()}"
     
-    def _is_final_output_table(self, table_name: str, components: Dict, individual_queries: List[Dict]) -> bool:
-        """Check if a table is a final output table that shouldn't be converted to CTE"""
-        # Check if this table is used by any other table
-        is_used = False
-        for other_table, deps in components.get('table_dependencies', {}).items():
-            if table_name in deps and other_table != table_name:
-                is_used = True
-                break
+    def plan_materialization(self, individual_queries: List[Dict], graph: DependencyGraph) -> Dict[str, Dict]:
+        """Choose how each intermediate table enters the consolidated statement.
         
-        # Check if this is the last created table (likely the final output)
-        if not is_used:
-            # Find the creating query
-            creating_query = self._find_creating_query(table_name, individual_queries)
-            if creating_query:
-                # If this is a PROC SQL that creates a table and it's not used elsewhere,
-                # it's likely the final output
-                if creating_query['type'] == 'PROC_SQL' and creating_query.get('creates_table'):
-                    return True
-                # If this is the last data step and not used elsewhere, it's likely final output
-                if (creating_query['type'] == 'DATA_STEP' and 
-                    creating_query == individual_queries[-1]):
-                    return True
+        Readers are the references to the table from the other intermediate tables and the
+        final query, so a self-join counts each side. A table read at most inline_max_consumers
+        times is inlined as a subquery, one read at least cache_min_consumers times is
+        materialized once (CACHE TABLE on Spark, a temporary table elsewhere) and anything in
+        between stays a shared CTE. A table nothing in the statement reads is created as its
+        own table, so its output isn't lost. Steps that do not produce a query (e.g. CREATE
+        TABLE for DATALINES) run as statements.
         
-        return False
-    
-    def _build_dependency_graph(self, components: Dict) -> Dict[str, List[str]]:
-        graph = {}
-        # Add all tables as nodes
-        for table in components.get('tables', []):
-            graph[table] = []
+        Materialized and own tables are written before the WITH clause and can't read its
+        CTEs, so a CTE they read, directly or through inlined tables, is materialized too.
+        """
+        intermediates = [table_name for table_name in graph.schedule()['order']
+                         if not graph.is_final_output(table_name) and graph.creating_query(table_name)]
+        names = {table_name.lower(): table_name for table_name in intermediates}
+        bodies = {table_name: self._table_body(graph, table_name) for table_name in intermediates}
+        queries = [table_name for table_name in intermediates
+                   if bodies[table_name].lower().startswith(('select', 'with', '('))]
         
-        # Add dependencies from data steps
-        for data_step in components.get('data_steps', []):
-            table_name = data_step['table_name']
-            source_tables = data_step.get('source_tables', [])
-            graph[table_name] = source_tables
+        # Lower-cased table name -> references to it inside the statement
+        references = {}
+        reads = {table_name: [names[name.lower()] for name in self._table_references(bodies[table_name])
+                              if name.lower() in names and name.lower() != table_name.lower()]
+                 for table_name in queries}
+        for sources in reads.values():
+            for source in sources:
+                references[source.lower()] = references.get(source.lower(), 0) + 1
+        final_query = self._select_final_query(individual_queries)
+        if final_query:
+            for name in self._table_references(self._query_body(final_query)):
+                references[name.lower()] = references.get(name.lower(), 0) + 1
         
-        # Add dependencies from procedures
-        for procedure in components.get('procedures', []):
-            if procedure['type'] == 'SQL':
-                # Extract dependencies from PROC SQL
-                data_sources = procedure.get('data_sources', [])
-                creates_table_match = re.search(r'create\s+table\s+(\w+)', procedure['content'], re.IGNORECASE)
-                if creates_table_match:
-                    table_name = creates_table_match.group(1)
-                    if table_name not in graph:
-                        graph[table_name] = []
-                    graph[table_name].extend(data_sources)
-        
-        return graph
-    
-    def _topological_sort(self, graph: Dict[str, List[str]]) -> List[str]:
-        visited = set()
-        temp_visited = set()
-        result = []
-        
-        def visit(node):
-            if node in temp_visited:
-                return
-            if node not in visited:
-                temp_visited.add(node)
-                # Visit all dependencies first
-                for neighbor in graph.get(node, []):
-                    if neighbor in graph:  # Only visit nodes that are in our graph
-                        visit(neighbor)
-                temp_visited.remove(node)
-                visited.add(node)
-                result.append(node)
-        
-        # Visit all nodes
-        for node in list(graph.keys()):
-            if node not in visited:
-                visit(node)
+        plan = {}
+        for table_name in intermediates:
+            readers = references.get(table_name.lower(), 0)
+            times = 'once' if readers == 1 else f"{readers} times"
+            if table_name not in reads:
+                strategy, reason = 'statement', "not a query, runs as its own statement"
+            elif readers == 0:
+                strategy, reason = 'table', "not read inside this statement, created as its own table"
+            elif readers <= self.inline_max_consumers:
+                strategy, reason = 'inline', f"read {times}, inlined as a subquery"
+            elif readers >= self.cache_min_consumers:
+                strategy, reason = 'materialize', f"read {times}, computed once instead of per reference"
+            else:
+                strategy, reason = 'cte', f"read {times}, shared as a CTE"
+            plan[table_name] = {'strategy': strategy, 'consumers': readers, 'reason': reason}
         
-        return result
+        # Readers come first in reverse order, so a table is promoted before its own sources are seen
+        before_with = set()
+        for table_name in reversed(queries):
+            if plan[table_name]['strategy'] in ('materialize', 'table'):
+                before_with.add(table_name)
+            if table_name not in before_with:
+                continue
+            for source in reads[table_name]:
+                decision = plan[source]
+                if decision['strategy'] == 'cte':
+                    decision['strategy'] = 'materialize'
+                    decision['reason'] = (f"read {decision['consumers']} times, materialized as {table_name} "
+                                          f"is computed before the WITH clause")
+                if decision['strategy'] in ('inline', 'materialize'):
+                    before_with.add(source)
+        return plan
     
-    def _find_creating_query(self, table_name: str, queries: List[Dict]) -> Optional[Dict]:
-        for query in queries:
-            if query['type'] == 'DATA_STEP' and query.get('table_name') == table_name:
-                return query
-            elif query['type'] == 'PROC_SQL' and query.get('creates_table') == table_name:
+    def column_lineage(self, components: Dict, individual_queries: List[Dict], graph: DependencyGraph,
+                       plan: Dict[str, Dict]) -> ColumnLineage:
+        """Lineage of the tables the statement computes, read back from the final query"""
+        bodies = {table_name: self._table_body(graph, table_name)
+                  for table_name, decision in plan.items() if decision['strategy'] != 'statement'}
+        final_query = self._select_final_query(individual_queries)
+        return ColumnLineage(components, graph, bodies, self._query_body(final_query) if final_query else None)
+    
+    def _select_final_query(self, individual_queries: List[Dict]) -> Optional[Dict]:
+        # The last PROC SQL that doesn't create a table, otherwise the last query
+        for query in reversed(individual_queries):
+            if query['type'] == 'PROC_SQL' and not query.get('creates_table'):
                 return query
-        return None
+        return individual_queries[-1] if individual_queries else None
+    
+    def _query_body(self, query: Dict) -> str:
+        # CREATE TABLE x AS is dropped, the rest of the query is kept
+        sql = re.sub(r'CREATE TABLE [\w.]+ AS\s*', '', query['sql'], count=1, flags=re.IGNORECASE)
+        return sql.strip().rstrip(';').strip()
+    
+    def _table_body(self, graph: DependencyGraph, table_name: str) -> str:
+        # The creating query, with each in-place rewrite reading the version before it; a table
+        # created by a statement (DATALINES) has no query to build on
+        body = self._query_body(graph.creating_query(table_name))
+        if not body.lower().startswith(('select', 'with', '(')):
+            return body
+        for query in graph.rewrites.get(table_name, ()):
+            body = self._rewrite_table_references(self._query_body(query), {}, {table_name.lower(): body})
+        return body
+    
+    def _materialize_statement(self, name: str) -> str:
+        if self.dialect == 'spark':
+            return f"CACHE TABLE {name}"
+        return f"CREATE TEMPORARY TABLE {name}"
+    
+    def _rewrite_table_references(self, sql: str, replacements: Dict[str, str],
+                                  inline: Dict[str, str] = None) -> str:
+        """Rename tables in one pass over the SQL tokens.
+        
+        Only names in table position (lib.table included) and table qualifiers of column
+        references are looked up in replacements, which is keyed by lower-cased table name.
+        Tables in inline are replaced by their SQL as a subquery, aliased to the table name
+        (without its libref) unless the reference has its own alias; a renamed lib.table keeps
+        its table name as alias, so column qualifiers still resolve.
+        """
+        if not replacements and not inline:
+            return sql
+        inline = inline or {}
+        tokens = self._sql_token_re.findall(sql)
+        for start, end, is_table in list(self._iter_table_tokens(tokens)):
+            name = ''.join(tokens[start:end])
+            body = inline.get(name.lower()) if is_table else None
+            alias = '' if self._alias_follows(tokens, end - 1) else f" AS {tokens[end - 1]}"
+            if body is not None:
+                tokens[start] = f"(\n{self._indent_sql(body)}\n){alias}"
+            elif name.lower() in replacements:
+                tokens[start] = replacements[name.lower()] + (alias if end - start > 1 else '')
+            else:
+                continue
+            tokens[start + 1:end] = [''] * (end - start - 1)
+        return ''.join(tokens)
+    
+    def _table_references(self, sql: str) -> List[str]:
+        tokens = self._sql_token_re.findall(sql)
+        return [''.join(tokens[start:end]) for start, end, is_table in self._iter_table_tokens(tokens) if is_table]
+    
+    def _iter_table_tokens(self, tokens: List[str]):
+        """Yield (start, end, is_table) for the token ranges naming a table.
+        
+        is_table is True in table position (after FROM/JOIN/INTO/UPDATE/TABLE or a comma in a
+        FROM list), where lib.table is one name, and False for the qualifier of a column
+        reference (table.column).
+        """
+        expect_table = False
+        # One flag per parenthesis level: inside a FROM list, where commas introduce tables
+        from_list = [False]
+        previous = ''
+        for index, token in enumerate(tokens):
+            first = token[0]
+            if first.isalpha() or first == '_':
+                following = tokens[index + 1] if index + 1 < len(tokens) else ''
+                if previous == '.':
+                    # Second part of a qualified name
+                    expect_table = False
+                elif following == '.':
+                    name = tokens[index + 2] if index + 2 < len(tokens) else ''
+                    if not expect_table:
+                        # Column qualifier (table.column)
+                        yield index, index + 1, False
+                    elif name[:1].isalpha() or name[:1] == '_':
+                        yield index, index + 3, True
+                elif expect_table:
+                    yield index, index + 1, True
+                    expect_table = False
+                else:
+                    keyword = token.lower()
+                    if keyword in self._table_keywords:
+                        expect_table = True
+                        if keyword in ('from', 'join'):
+                            from_list[-1] = True
+                    elif keyword in self._clause_keywords:
+                        from_list[-1] = False
+            elif token == '(':
+                from_list.append(False)
+                expect_table = False
+            elif token == ')':
+                if len(from_list) > 1:
+                    from_list.pop()
+            elif token == ',':
+                expect_table = from_list[-1]
+            elif first.isspace() or token.startswith(('--', '/*')):
+                continue
+            previous = token
+    
+    def _alias_follows(self, tokens: List[str], index: int) -> bool:
+        for token in tokens[index + 1:]:
+            if token[0].isspace() or token.startswith(('--', '/*')):
+                continue
+            return ((token[0].isalpha() or token[0] == '_')
+                    and token.lower() not in self._clause_keywords and token.lower() not in self._join_keywords)
+        return False
     
     def _indent_sql(self, sql: str, indent_level: int = 1) -> str:
         try:
@@ -850,12 +3956,857 @@ class SQLConsolidator:
         except:
             return sql
 
-class AICodeEnhancer:
+class SQLQueryTree:
+    """Parse generated SQL into a tree of SELECT nodes and render it back.
+    
+    A node holds its CTEs, FROM items (base table or subquery, alias and join type), select
+    items, WHERE conjuncts, GROUP BY keys and the column references of its other clauses.
+    Rendering copies the original tokens and only rebuilds a node's select list when it has a
+    'projection' and its WHERE clause when it is 'changed', so untouched SQL keeps its layout.
+    """
+    _token_re = SQLConsolidator._sql_token_re
+    _clause_starts = {'select', 'from', 'where', 'group', 'having', 'order', 'limit', 'offset', 'fetch',
+                      'window', 'qualify', 'union', 'except', 'intersect', 'minus'}
+    _join_words = {'join', 'inner', 'left', 'right', 'full', 'outer', 'cross', 'natural', 'lateral', 'anti', 'semi'}
+    # Words that are never column references inside an expression
+    _expression_keywords = {'and', 'or', 'not', 'is', 'null', 'in', 'like', 'ilike', 'rlike', 'between', 'case',
+                            'when', 'then', 'else', 'end', 'true', 'false', 'exists', 'escape', 'as', 'distinct',
+                            'asc', 'desc', 'nulls', 'first', 'last', 'by', 'calculated', 'from', 'for', 'div',
+                            'precision', 'any', 'some', 'all', 'current_date', 'current_timestamp', 'current_time',
+                            # Window specifications
+                            'partition', 'order', 'rows', 'range', 'unbounded', 'preceding', 'following',
+                            'current', 'row'}
+    # Date parts given as the first argument of date functions (DATEDIFF(day, a, b))
+    _date_part_functions = {'datediff', 'dateadd', 'datepart', 'date_part', 'date_trunc', 'extract',
+                            'timestampdiff', 'timestampadd'}
+    # Typed literals (DATE '2024-01-01'); the same words followed by anything else are columns
+    _literal_prefixes = {'date', 'timestamp', 'time', 'interval'}
+    _volatile_functions = {'rand', 'random', 'uuid', 'newid', 'monotonically_increasing_id'}
+    
+    def parse(self, sql: str, name: str = 'query') -> Optional[Dict]:
+        """The root node of a single query, with its tokens under 'tokens', or None"""
+        tokens = self._token_re.findall(sql)
+        start = self._next(tokens, 0, len(tokens))
+        if start is None:
+            return None
+        end = len(tokens)
+        while not self._is_significant(tokens[end - 1]):
+            end -= 1
+        if tokens[end - 1] == ';':
+            end -= 1
+        root = self._parse_query(tokens, start, end, name)
+        if root is not None:
+            root['tokens'] = tokens
+        return root
+    
+    def render(self, tokens: List[str], node: Dict) -> str:
+        spans = [(cte['start'], cte['end'], cte) for cte in node['ctes']]
+        if node.get('joins') is not None:
+            spans.append((node['from'][0], node['from'][1], 'joins'))
+        else:
+            spans += [(item['node']['start'], item['node']['end'], item['node'])
+                      for item in node['items'] if item['node']]
+        if node.get('hint'):
+            spans.append((node['select'][0], node['select'][0], 'hint'))
+        if node.get('projection') is not None:
+            spans.append((node['select'][0], node['select'][1], 'projection'))
+        if node['changed']:
+            where_start, where_end = node['where'] or (node['where_at'], node['where_at'])
+            spans.append((where_start, where_end, 'where'))
+        parts = []
+        position = node['start']
+        for span_start, span_end, child in sorted(spans, key=lambda span: (span[0], span[1])):
+            parts.append(''.join(tokens[position:span_start]))
+            if child == 'hint':
+                parts.append(f" {node['hint']}")
+            elif child == 'joins':
+                parts.append(self._from_clause(tokens, node))
+            elif child == 'projection':
+                trailing = tokens[span_end - 1] if tokens[span_end - 1][:1].isspace() else ' '
+                parts.append(f" {node['projection']}{trailing}")
+            elif child == 'where':
+                parts.append(self._where_clause(tokens, node))
+            else:
+                parts.append(self.render(tokens, child))
+            position = span_end
+        parts.append(''.join(tokens[position:node['end']]))
+        return ''.join(parts)
+    
+    def _rewrite_statements(self, sql: str, rewrite) -> str:
+        """Call rewrite(tokens, root) for the query of each statement and re-render it when that returns True.
+        
+        Statements split on top-level semicolons. The query of CREATE ... AS / CACHE TABLE ... AS
+        is named after its table, a bare SELECT or WITH is the 'final query'.
+        """
+        tokens = self._token_re.findall(sql)
+        parts = []
+        start = 0
+        depth = 0
+        for index, token in enumerate(tokens):
+            if token == '(':
+                depth += 1
+            elif token == ')':
+                depth -= 1
+            elif token == ';' and depth == 0:
+                parts.append(self._rewrite_statement(tokens[start:index + 1], rewrite))
+                start = index + 1
+        parts.append(self._rewrite_statement(tokens[start:], rewrite))
+        return ''.join(parts)
+    
+    def _rewrite_statement(self, tokens: List[str], rewrite) -> str:
+        start = self._next(tokens, 0, len(tokens))
+        if start is None:
+            return ''.join(tokens)
+        keyword = tokens[start].lower()
+        name = 'final query'
+        if keyword in ('create', 'cache'):
+            # CREATE TEMPORARY TABLE x AS / CACHE TABLE x AS followed by the query
+            header = [index for index in range(start, min(start + 20, len(tokens)))
+                      if self._is_significant(tokens[index])]
+            for position in range(1, len(header) - 1):
+                following = tokens[header[position + 1]].lower()
+                if tokens[header[position]].lower() == 'as' and following in ('select', 'with'):
+                    name = tokens[header[position - 1]]
+                    start = header[position + 1]
+                    break
+            else:
+                return ''.join(tokens)
+        elif keyword not in ('select', 'with'):
+            return ''.join(tokens)
+        end = len(tokens)
+        while not self._is_significant(tokens[end - 1]):
+            end -= 1
+        if tokens[end - 1] == ';':
+            end -= 1
+        root = self._parse_query(tokens, start, end, name)
+        if root is None or not rewrite(tokens, root):
+            return ''.join(tokens)
+        return ''.join(tokens[:start]) + self.render(tokens, root) + ''.join(tokens[end:])
+    
+    def _from_clause(self, tokens: List[str], node: Dict) -> str:
+        # node['joins']: [{'item', 'keyword', 'condition'}] in their new order, the first without keyword
+        from_end = node['from'][1]
+        trailing = tokens[from_end - 1] if tokens[from_end - 1][:1].isspace() else ''
+        parts = []
+        for join in node['joins']:
+            item = join['item']
+            if item['node'] is not None:
+                text = (''.join(tokens[item['start']:item['node']['start']]) + self.render(tokens, item['node'])
+                        + ''.join(tokens[item['node']['end']:item['end']]))
+            else:
+                text = ''.join(tokens[item['start']:item['end']])
+            text = text.strip()
+            if join['keyword']:
+                text = f"\n{join['keyword']} {text}"
+            if join['condition']:
+                text += f" {join['condition']}"
+            parts.append(text)
+        return ' ' + ''.join(parts) + trailing
+    
+    def _parse_query(self, tokens: List[str], start: int, end: int, name: str) -> Optional[Dict]:
+        node = {'name': name, 'start': start, 'end': end, 'ctes': [], 'items': [], 'select_items': [],
+                'outputs': {}, 'stars': [], 'refs': [], 'select': None, 'distinct': False, 'set_operation': False,
+                'group_by': None, 'where': None, 'where_at': end, 'conjuncts': [], 'changed': False,
+                'accepts': True, 'from': None, 'using': set()}
+        index = self._next(tokens, start, end)
+        if index is None:
+            return None
+        if tokens[index].lower() == 'with':
+            index = self._next(tokens, index + 1, end)
+            while index is not None and tokens[index].lower() != 'recursive':
+                cte_name = tokens[index]
+                as_index = self._next(tokens, index + 1, end)
+                open_index = self._next(tokens, as_index + 1, end) if as_index is not None else None
+                if (as_index is None or tokens[as_index].lower() != 'as'
+                        or open_index is None or tokens[open_index] != '('):
+                    return None
+                close_index = self._close(tokens, open_index, end)
+                cte = self._parse_query(tokens, open_index + 1, close_index, cte_name)
+                if cte is not None:
+                    node['ctes'].append(cte)
+                index = self._next(tokens, close_index + 1, end)
+                if index is None or tokens[index] != ',':
+                    break
+                index = self._next(tokens, index + 1, end)
+            if index is None or tokens[index].lower() != 'select':
+                return None
+        elif tokens[index].lower() != 'select':
+            return None
+        
+        # Clause keywords at this query's own parenthesis level
+        clauses = []
+        depth = 0
+        previous = ''
+        for position in range(index, end):
+            token = tokens[position]
+            if token == '(':
+                depth += 1
+            elif token == ')':
+                depth -= 1
+            elif depth == 0 and token.lower() in self._clause_starts and not (
+                    token.lower() == 'except' and previous == '*'):
+                # * EXCEPT (...) in a select list leaves columns out; it isn't a set operation
+                clauses.append((token.lower(), position))
+            if self._is_significant(token):
+                previous = token
+        keywords = [keyword for keyword, _ in clauses]
+        if keywords.count('select') > 1 or {'union', 'except', 'intersect', 'minus'} & set(keywords):
+            # Set operations keep their predicates and columns; their branches are not parsed
+            node['accepts'] = False
+            node['set_operation'] = True
+            return node
+        if {'limit', 'offset', 'fetch', 'qualify'} & set(keywords):
+            node['accepts'] = False
+        bounds = {}
+        for position, (keyword, token_index) in enumerate(clauses):
+            following = clauses[position + 1][1] if position + 1 < len(clauses) else end
+            bounds.setdefault(keyword, (token_index, following))
+        
+        select_start, select_end = bounds['select']
+        node['select'] = (select_start + 1, select_end)
+        self._parse_select_list(node, tokens, select_start + 1, select_end)
+        if 'from' in bounds:
+            node['from'] = (bounds['from'][0] + 1, bounds['from'][1])
+            self._parse_from(node, tokens, bounds['from'][0] + 1, bounds['from'][1])
+        if not node['items']:
+            node['accepts'] = False
+        if 'where' in bounds:
+            node['where'] = bounds['where']
+            node['conjuncts'] = self._split_conjuncts(tokens, bounds['where'][0] + 1, bounds['where'][1])
+        else:
+            later = [token_index for keyword, token_index in clauses
+                     if keyword in ('group', 'having', 'order', 'limit', 'window', 'qualify', 'offset', 'fetch')]
+            node['where_at'] = min(later) if later else end
+        if 'group' in bounds:
+            group_tokens = [token for token in tokens[bounds['group'][0] + 1:bounds['group'][1]]
+                            if self._is_significant(token)]
+            if group_tokens and group_tokens[0].lower() == 'by':
+                group_tokens = group_tokens[1:]
+            if {token.lower() for token in group_tokens} & {'rollup', 'cube', 'grouping'}:
+                node['accepts'] = False
+            node['group_by'] = {item.lower() for item in ''.join(group_tokens).split(',')}
+        # Columns read outside the select list; None when a nested query makes them unknowable
+        for keyword in ('where', 'group', 'having', 'order', 'window', 'qualify'):
+            if keyword in bounds and node['refs'] is not None:
+                refs = self._column_refs(tokens[bounds[keyword][0] + 1:bounds[keyword][1]])
+                node['refs'] = None if refs is None else node['refs'] + [(qualifier, column)
+                                                                         for _, _, qualifier, column in refs]
+        return node
+    
+    def _parse_select_list(self, node: Dict, tokens: List[str], start: int, end: int):
+        items = [[]]
+        depth = 0
+        for token in tokens[start:end]:
+            if token == '(':
+                depth += 1
+            elif token == ')':
+                depth -= 1
+            if token == ',' and depth == 0:
+                items.append([])
+            elif not token.startswith(('--', '/*')):
+                items[-1].append(token)
+        for raw in items:
+            item = [token for token in raw if self._is_significant(token)]
+            lowered = [token.lower() for token in item]
+            if lowered[:1] in (['distinct'], ['all']):
+                node['distinct'] = node['distinct'] or lowered[0] == 'distinct'
+                raw = raw[raw.index(item[0]) + 1:]
+                item, lowered = item[1:], lowered[1:]
+            if 'over' in lowered or 'top' in lowered or not item:
+                node['accepts'] = False
+            entry = {'text': ''.join(raw).strip(), 'name': None, 'display': None, 'star': None, 'refs': [],
+                     'except': set()}
+            node['select_items'].append(entry)
+            if not item:
+                continue
+            star = lowered.index('*') if '*' in lowered else None
+            if star in (0, 2) and lowered[star + 1:star + 3] in (['except', '('], ['exclude', '(']) \
+                    and item[-1] == ')':
+                # * EXCEPT (a, b) / * EXCLUDE (a, b): the star without the listed columns
+                entry['except'] = {token.lower().strip('"') for token in item[star + 3:-1] if token != ','}
+                item, lowered = item[:star + 1], lowered[:star + 1]
+            if item == ['*']:
+                entry['star'] = ''
+                node['stars'].append(None)
+                continue
+            if len(item) == 3 and item[1:] == ['.', '*']:
+                entry['star'] = item[0]
+                node['stars'].append(item[0])
+                continue
+            expression, alias = item, None
+            if len(item) >= 3 and lowered[-2] == 'as':
+                expression, alias = item[:-2], item[-1]
+            elif (len(item) >= 2 and self._is_identifier(item[-1]) and item[-2] != '.'
+                  and lowered[-1] not in self._expression_keywords):
+                expression, alias = item[:-1], item[-1]
+            refs = self._column_refs(expression)
+            entry['refs'] = None if refs is None else [(qualifier, column) for _, _, qualifier, column in refs]
+            column = self._plain_column(expression)
+            if alias is None and column is None:
+                # An unnamed expression: nothing downstream can read it by name
+                continue
+            entry['display'] = (alias if alias is not None else column.split('.')[-1]).strip('"')
+            entry['name'] = entry['display'].lower()
+            node['outputs'][entry['name']] = column
+    
+    def _parse_from(self, node: Dict, tokens: List[str], start: int, end: int):
+        join = 'from'
+        keyword = ''
+        index = start
+        while True:
+            index = self._next(tokens, index, end)
+            if index is None:
+                return
+            token = tokens[index]
+            lowered = token.lower()
+            if token == ',':
+                join = 'inner'
+                keyword = ','
+                index += 1
+                continue
+            if lowered in self._join_words:
+                words = []
+                while index is not None and tokens[index].lower() in self._join_words:
+                    words.append(tokens[index].lower())
+                    index = self._next(tokens, index + 1, end)
+                    if words[-1] == 'join':
+                        break
+                if {'natural', 'lateral', 'anti', 'semi'} & set(words):
+                    join = 'other'
+                else:
+                    join = next((word for word in ('left', 'right', 'full') if word in words), 'inner')
+                keyword = ' '.join(words).upper()
+                continue
+            if lowered in ('on', 'using'):
+                # The join condition runs up to the next FROM item
+                depth = 0
+                condition_start = index + 1
+                index += 1
+                while index < end:
+                    token = tokens[index]
+                    if token == '(':
+                        depth += 1
+                    elif token == ')':
+                        depth -= 1
+                    elif depth == 0 and (token == ',' or token.lower() in self._join_words):
+                        break
+                    index += 1
+                if node['items']:
+                    node['items'][-1]['condition'] = (lowered, condition_start, index)
+                if lowered == 'using':
+                    # Columns every side has; they read as one column afterwards
+                    node['using'].update(token.strip('"').lower() for token in tokens[condition_start:index]
+                                         if self._is_identifier(token))
+                elif node['refs'] is not None:
+                    refs = self._column_refs(tokens[condition_start:index])
+                    node['refs'] = None if refs is None else node['refs'] + [(qualifier, column)
+                                                                             for _, _, qualifier, column in refs]
+                continue
+            item = {'join': join, 'keyword': keyword, 'table': None, 'node': None, 'alias': None,
+                    'start': index, 'end': None, 'condition': None}
+            if token == '(':
+                close_index = self._close(tokens, index, end)
+                item['node'] = self._parse_query(tokens, index + 1, close_index, 'subquery')
+                index = close_index + 1
+            elif self._is_identifier(token):
+                name = token
+                index += 1
+                while index + 1 < end and tokens[index] == '.' and self._is_identifier(tokens[index + 1]):
+                    name += '.' + tokens[index + 1]
+                    index += 2
+                item['table'] = name
+            else:
+                return
+            alias_index = self._next(tokens, index, end)
+            if alias_index is not None and tokens[alias_index].lower() == 'as':
+                alias_index = self._next(tokens, alias_index + 1, end)
+            if (alias_index is not None and self._is_identifier(tokens[alias_index])
+                    and tokens[alias_index].lower() not in self._join_words
+                    and tokens[alias_index].lower() not in ('on', 'using', 'pivot', 'unpivot')):
+                item['alias'] = tokens[alias_index]
+                index = alias_index + 1
+                column_list = self._next(tokens, index, end)
+                if column_list is not None and tokens[column_list] == '(':
+                    # Column aliases of a derived table: t(a, b)
+                    index = self._close(tokens, column_list, end) + 1
+            pivot_index = self._next(tokens, index, end)
+            if pivot_index is not None and tokens[pivot_index].lower() in ('pivot', 'unpivot'):
+                # The pivoted item's columns come from its data, so its query is kept whole
+                open_index = self._next(tokens, pivot_index + 1, end)
+                index = self._close(tokens, open_index, end) + 1
+                alias_index = self._next(tokens, index, end)
+                if alias_index is not None and tokens[alias_index].lower() == 'as':
+                    alias_index = self._next(tokens, alias_index + 1, end)
+                if (alias_index is not None and self._is_identifier(tokens[alias_index])
+                        and tokens[alias_index].lower() not in self._join_words
+                        and tokens[alias_index].lower() not in ('on', 'using')):
+                    item['alias'] = tokens[alias_index]
+                    index = alias_index + 1
+                item['pivot'] = True
+            item['end'] = index
+            if item['node'] is not None:
+                item['node']['name'] = item['alias'] or 'subquery'
+            node['items'].append(item)
+            join = 'inner'
+            keyword = ','
+    
+    def _split_conjuncts(self, tokens: List[str], start: int, end: int) -> List[str]:
+        # Top-level ANDs only; a top-level OR keeps the whole condition as one conjunct
+        conjuncts = [[]]
+        depth = 0
+        in_between = False
+        for token in tokens[start:end]:
+            lowered = token.lower()
+            if token == '(':
+                depth += 1
+            elif token == ')':
+                depth -= 1
+            elif depth == 0 and lowered == 'or':
+                return [''.join(tokens[start:end]).strip()]
+            elif depth == 0 and lowered == 'between':
+                in_between = True
+            elif depth == 0 and lowered == 'and':
+                if in_between:
+                    in_between = False
+                else:
+                    conjuncts.append([])
+                    continue
+            conjuncts[-1].append(token)
+        return [''.join(conjunct).strip() for conjunct in conjuncts if ''.join(conjunct).strip()]
+    
+    def _column_refs(self, tokens: List[str]) -> Optional[List[Tuple[int, int, Optional[str], str]]]:
+        """(start, end, qualifier, column) per column reference, None for nested queries and volatile functions"""
+        significant = [index for index, token in enumerate(tokens) if self._is_significant(token)]
+        refs = []
+        for position, index in enumerate(significant):
+            token = tokens[index]
+            if not self._is_identifier(token):
+                continue
+            lowered = token.lower()
+            previous = tokens[significant[position - 1]] if position else ''
+            following = tokens[significant[position + 1]] if position + 1 < len(significant) else ''
+            if lowered == 'select':
+                return None
+            if following == '(':
+                if lowered in self._volatile_functions:
+                    return None
+                continue
+            if previous == '.':
+                continue
+            if following == '.':
+                if position + 2 >= len(significant) or not self._is_identifier(tokens[significant[position + 2]]):
+                    return None
+                refs.append((index, significant[position + 2] + 1, token, tokens[significant[position + 2]]))
+                continue
+            if lowered in self._expression_keywords or previous.lower() == 'as':
+                continue
+            if lowered in self._literal_prefixes and (following[:1] == "'" or following[:1].isdigit()):
+                continue
+            if (previous == '(' and position > 1
+                    and tokens[significant[position - 2]].lower() in self._date_part_functions):
+                continue
+            refs.append((index, index + 1, None, token))
+        return refs
+    
+    def _where_clause(self, tokens: List[str], node: Dict) -> str:
+        if node['where'] is not None:
+            trailing = tokens[node['where'][1] - 1]
+            trailing = trailing if trailing[:1].isspace() else ''
+        else:
+            trailing = '\n' if node['where_at'] < node['end'] else ''
+        if not node['conjuncts']:
+            return trailing
+        conditions = [f"({conjunct})" if self._has_top_level_or(conjunct) else conjunct
+                      for conjunct in node['conjuncts']]
+        leading = '' if node['where'] is not None or node['where_at'] < node['end'] else '\n'
+        return f"{leading}WHERE {' AND '.join(conditions)}{trailing}"
+    
+    def _has_top_level_or(self, condition: str) -> bool:
+        depth = 0
+        for token in self._token_re.findall(condition):
+            if token == '(':
+                depth += 1
+            elif token == ')':
+                depth -= 1
+            elif depth == 0 and token.lower() == 'or':
+                return True
+        return False
+    
+    def _next(self, tokens: List[str], index: int, end: int) -> Optional[int]:
+        while index < end:
+            if self._is_significant(tokens[index]):
+                return index
+            index += 1
+        return None
+    
+    def _close(self, tokens: List[str], open_index: int, end: int) -> int:
+        depth = 0
+        for index in range(open_index, end):
+            if tokens[index] == '(':
+                depth += 1
+            elif tokens[index] == ')':
+                depth -= 1
+                if depth == 0:
+                    return index
+        return end
+    
+    def _plain_column(self, expression: List[str]) -> Optional[str]:
+        if len(expression) == 1 and self._is_identifier(expression[0]):
+            return expression[0]
+        if len(expression) == 3 and expression[1] == '.' and all(map(self._is_identifier, expression[::2])):
+            return ''.join(expression)
+        return None
+    
+    def _is_identifier(self, token: str) -> bool:
+        return token[:1].isalpha() or token[:1] in ('_', '"')
+    
+    def _is_significant(self, token: str) -> bool:
+        return not (token[:1].isspace() or token.startswith(('--', '/*')))
+
+class PredicatePushdown(SQLQueryTree):
+    """Move WHERE conjuncts down the query tree of each consolidated statement.
+    
+    A conjunct whose columns all come from one FROM item and pass through it unchanged (not
+    computed, and grouped if the item aggregates) is moved into that item's WHERE, renamed to
+    the item's own columns, and keeps moving until it reaches a base-table scan. CTEs read more
+    than once, null-supplying sides of outer joins and items with LIMIT, set operations or
+    window functions never receive a predicate.
+    """
+    
     def __init__(self):
+        self.consolidator = SQLConsolidator()
+    
+    def optimize(self, sql: str) -> Tuple[str, List[Dict]]:
+        """Return the SQL with predicates pushed down and one record per predicate moved"""
+        pushed = []
+        
+        def push(tokens: List[str], root: Dict) -> bool:
+            # A CTE only takes a reader's predicate when that reader is its only one
+            references = {}
+            for table in self.consolidator._table_references(self.render(tokens, root)):
+                references[table.lower()] = references.get(table.lower(), 0) + 1
+            moved = len(pushed)
+            self._push(root, {}, references, pushed)
+            return len(pushed) > moved
+        
+        return self._rewrite_statements(sql, push), pushed
+    
+    def _push(self, node: Dict, scope: Dict[str, Dict], references: Dict[str, int], pushed: List[Dict]):
+        scope = dict(scope)
+        scope.update((cte['name'].lower(), cte) for cte in node['ctes'])
+        remaining = []
+        for conjunct in node['conjuncts']:
+            target = self._push_target(node, conjunct, scope, references)
+            if target is None:
+                remaining.append(conjunct)
+                continue
+            child, rewritten = target
+            child['conjuncts'].append(rewritten)
+            child['changed'] = node['changed'] = True
+            pushed.append({'predicate': conjunct, 'from': node['name'], 'into': child['name'], 'as': rewritten})
+        node['conjuncts'] = remaining
+        for item in node['items']:
+            if item['node'] is not None:
+                self._push(item['node'], scope, references, pushed)
+        # Later CTEs read earlier ones, so they hand their predicates down first
+        for cte in reversed(node['ctes']):
+            self._push(cte, scope, references, pushed)
+    
+    def _push_target(self, node: Dict, conjunct: str, scope: Dict[str, Dict],
+                     references: Dict[str, int]) -> Optional[Tuple[Dict, str]]:
+        tokens = self._token_re.findall(conjunct)
+        refs = self._column_refs(tokens)
+        items = node['items']
+        if not refs or not items or any(item['join'] in ('right', 'full', 'other') for item in items):
+            return None
+        qualifiers = {qualifier.lower() if qualifier else None for _, _, qualifier, _ in refs}
+        if len(items) == 1:
+            item = items[0]
+            names = {None, (item['alias'] or '').lower(), (item['table'] or '').lower()}
+            if not qualifiers <= names:
+                return None
+        else:
+            if None in qualifiers or len(qualifiers) != 1:
+                return None
+            qualifier = qualifiers.pop()
+            matches = [item for item in items if (item['alias'] or item['table'] or '').lower() == qualifier]
+            # The right side of a LEFT JOIN is null-extended after the join, not filtered
+            if len(matches) != 1 or matches[0]['join'] == 'left':
+                return None
+            item = matches[0]
+        if item.get('pivot'):
+            return None
+        target = item['node']
+        if target is None and item['table'] is not None:
+            target = scope.get(item['table'].lower())
+            if target is not None and references.get(item['table'].lower()) != 1:
+                return None
+        if target is None or not target['accepts']:
+            return None
+        
+        columns = {}
+        for _, _, _, column in refs:
+            inner = self._pass_through(target, column)
+            if inner is None:
+                return None
+            columns[column.lower()] = inner
+        rewritten = []
+        position = 0
+        for ref_start, ref_end, _, column in refs:
+            rewritten.extend(tokens[position:ref_start])
+            rewritten.append(columns[column.lower()])
+            position = ref_end
+        rewritten.extend(tokens[position:])
+        return target, ''.join(rewritten).strip()
+    
+    def _pass_through(self, target: Dict, column: str) -> Optional[str]:
+        """The target's own expression for an output column, if that column is a plain column"""
+        lowered = column.strip('"').lower()
+        if lowered in target['outputs']:
+            inner = target['outputs'][lowered]
+        elif target['stars'] == [None] and len(target['items']) == 1:
+            inner = column
+        elif len(target['stars']) == 1 and target['stars'][0] is not None:
+            inner = f"{target['stars'][0]}.{column}"
+        else:
+            return None
+        if inner is None:
+            return None
+        if target['group_by'] is not None and not {inner.lower(), inner.split('.')[-1].lower()} & target['group_by']:
+            return None
+        return inner
+
+class JoinPlanner(SQLQueryTree):
+    """Plan the joins of each consolidated statement.
+    
+    Comma and CROSS joins whose WHERE relates the two sides by equality become INNER JOINs on
+    those conditions. A leading run of inner joins is reordered greedily so that inputs known to
+    be small or filtered join first, each next input connected to those already joined; a
+    select list with a bare * keeps its order, since reordering would change its columns. With
+    the spark dialect, inputs of at most broadcast_max_rows rows get a BROADCAST hint unless they
+    are the preserved side of an outer join. Row counts come from DATALINES tables and the
+    caller's table_sizes; a query reading a single input is assumed no larger than that input.
+    """
+    
+    def __init__(self, dialect: str = 'default', table_sizes: Dict[str, int] = None,
+                 broadcast_max_rows: int = 10000):
+        self.dialect = dialect
+        self.table_sizes = {name.lower(): rows for name, rows in (table_sizes or {}).items()}
+        self.broadcast_max_rows = broadcast_max_rows
+    
+    def plan(self, sql: str, sizes: Dict[str, int] = None) -> Tuple[str, List[Dict]]:
+        """Return the SQL with its joins planned and one record per change.
+        
+        sizes maps lower-cased table names to row counts; tables the statements create are added.
+        """
+        sizes = {} if sizes is None else sizes
+        for name, rows in self.table_sizes.items():
+            sizes.setdefault(name, rows)
+        records = []
+        
+        def plan(tokens: List[str], root: Dict) -> bool:
+            planned = len(records)
+            self._plan(tokens, root, {}, sizes, records)
+            if root['name'] != 'final query':
+                # Later statements read the table this one creates
+                rows, _ = self._estimate({'node': root, 'table': None}, {}, sizes)
+                if rows is not None:
+                    sizes[root['name'].lower()] = rows
+            return len(records) > planned
+        
+        return self._rewrite_statements(sql, plan), records
+    
+    def _plan(self, tokens: List[str], node: Dict, scope: Dict[str, Dict], sizes: Dict[str, int],
+              records: List[Dict]):
+        scope = dict(scope)
+        scope.update((cte['name'].lower(), cte) for cte in node['ctes'])
+        for cte in node['ctes']:
+            self._plan(tokens, cte, scope, sizes, records)
+        for item in node['items']:
+            if item['node'] is not None:
+                self._plan(tokens, item['node'], scope, sizes, records)
+        items = node['items']
+        if len(items) < 2 or node['from'] is None:
+            return
+        names = [self._item_name(item).lower() for item in items]
+        if len(set(names)) != len(names):
+            return
+        joins = []
+        for position, item in enumerate(items):
+            condition = None
+            if item['condition'] is not None:
+                kind, start, end = item['condition']
+                condition = f"{kind.upper()} {''.join(tokens[start:end]).strip()}"
+            joins.append({'item': item, 'keyword': '' if position == 0 else item['keyword'], 'condition': condition})
+        changed = self._remove_cross_joins(node, joins, names, records)
+        changed = self._reorder(node, joins, names, scope, sizes, records) or changed
+        if changed:
+            for join in joins[1:]:
+                # Commas bind looser than JOIN; spelled out, every join reads left to right
+                if join['keyword'] == ',':
+                    join['keyword'] = 'CROSS JOIN'
+            node['joins'] = joins
+        self._broadcast(tokens, node, joins, scope, sizes, records)
+    
+    def _remove_cross_joins(self, node: Dict, joins: List[Dict], names: List[str], records: List[Dict]) -> bool:
+        # Mixed with outer joins, comma precedence would change what the WHERE condition means
+        if any(join['item']['join'] not in ('from', 'inner') for join in joins):
+            return False
+        bare = {position for position, join in enumerate(joins) if position and join['condition'] is None}
+        if not bare:
+            return False
+        moved = {position: [] for position in bare}
+        remaining = []
+        for conjunct in node['conjuncts']:
+            positions = self._equi_join_positions(conjunct, names)
+            if positions is not None and max(positions) in bare:
+                moved[max(positions)].append(conjunct)
+            else:
+                remaining.append(conjunct)
+        if not any(moved.values()):
+            return False
+        for position, conjuncts in moved.items():
+            if conjuncts:
+                joins[position]['keyword'] = 'INNER JOIN'
+                joins[position]['condition'] = f"ON {' AND '.join(conjuncts)}"
+                records.append({'query': node['name'], 'action': 'inner join',
+                                'detail': f"{names[position]} ON {' AND '.join(conjuncts)}, moved from WHERE"})
+        node['conjuncts'] = remaining
+        node['changed'] = True
+        return True
+    
+    def _equi_join_positions(self, conjunct: str, names: List[str]) -> Optional[Tuple[int, int]]:
+        # x.a = y.b between two different FROM items
+        tokens = [token for token in self._token_re.findall(conjunct) if self._is_significant(token)]
+        if tokens.count('=') != 1 or '(' in tokens:
+            return None
+        sides = []
+        for side in (tokens[:tokens.index('=')], tokens[tokens.index('=') + 1:]):
+            if len(side) != 3 or side[1] != '.' or side[0].lower() not in names:
+                return None
+            sides.append(names.index(side[0].lower()))
+        return tuple(sides) if sides[0] != sides[1] else None
+    
+    def _reorder(self, node: Dict, joins: List[Dict], names: List[str], scope: Dict[str, Dict],
+                 sizes: Dict[str, int], records: List[Dict]) -> bool:
+        if None in node['stars']:
+            return False
+        run = 1
+        while run < len(joins) and joins[run]['item']['join'] == 'inner' and joins[run]['condition']:
+            run += 1
+        if run < 2:
+            return False
+        keys = []
+        for join in joins[:run]:
+            rows, filtered = self._estimate(join['item'], scope, sizes)
+            keys.append((0, rows) if rows is not None else (1 if filtered else 2, 0))
+        if len(set(keys)) == 1:
+            return False
+        
+        conditions = [join['condition'] for join in joins[1:run]]
+        if all(condition.startswith('USING') for condition in conditions):
+            # Every input has the USING columns, so any order joins on them
+            if len({condition.replace(' ', '').lower() for condition in conditions}) != 1:
+                return False
+            order = sorted(range(run), key=lambda position: keys[position])
+            attached = {position: conditions[0] for position in order[1:]}
+        else:
+            links = []
+            for condition in conditions:
+                if not condition.startswith('ON'):
+                    return False
+                condition_tokens = self._token_re.findall(condition[2:])
+                for conjunct in self._split_conjuncts(condition_tokens, 0, len(condition_tokens)):
+                    refs = self._column_refs(self._token_re.findall(conjunct))
+                    if not refs or any(qualifier is None or qualifier.lower() not in names[:run]
+                                       for _, _, qualifier, _ in refs):
+                        return False
+                    links.append((conjunct, {names.index(qualifier.lower()) for _, _, qualifier, _ in refs}))
+            # Smallest input first, then the smallest one connected to what is already joined
+            order = [min(range(run), key=lambda position: keys[position])]
+            while len(order) < run:
+                connected = [position for position in range(run) if position not in order
+                             and any(position in tables and tables - {position} and tables - {position} <= set(order)
+                                     for _, tables in links)]
+                if not connected:
+                    return False
+                order.append(min(connected, key=lambda position: keys[position]))
+            attached = {}
+            placed = {order[0]}
+            for position in order[1:]:
+                placed.add(position)
+                conjuncts = [conjunct for conjunct, tables in links if tables <= placed and conjunct is not None]
+                links = [(None, tables) if tables <= placed else (conjunct, tables) for conjunct, tables in links]
+                attached[position] = f"ON {' AND '.join(conjuncts)}"
+        if order == list(range(run)):
+            return False
+        
+        items = [joins[position]['item'] for position in order]
+        joins[:run] = [{'item': items[0], 'keyword': '', 'condition': None}]
+        joins[1:1] = [{'item': item, 'keyword': 'INNER JOIN', 'condition': attached[position]}
+                      for item, position in zip(items[1:], order[1:])]
+        records.append({'query': node['name'], 'action': 'join order',
+                        'detail': ', '.join(names[position] for position in order)})
+        return True
+    
+    def _broadcast(self, tokens: List[str], node: Dict, joins: List[Dict], scope: Dict[str, Dict],
+                   sizes: Dict[str, int], records: List[Dict]):
+        if self.dialect != 'spark' or node['select'] is None:
+            return
+        kinds = [join['item']['join'] for join in joins]
+        # Spark can't broadcast either side of a full join, nor the preserved side of an outer one
+        if {'right', 'full', 'other'} & set(kinds):
+            return
+        small = []
+        for position, join in enumerate(joins):
+            rows, _ = self._estimate(join['item'], scope, sizes)
+            if rows is not None and rows <= self.broadcast_max_rows and (position or 'left' not in kinds):
+                small.append(self._item_name(join['item']))
+        first = tokens[node['select'][0]:node['select'][1]]
+        if not small or len(small) == len(joins) or any(token.startswith('/*+') for token in first[:3]):
+            return
+        node['hint'] = f"/*+ BROADCAST({', '.join(small)}) */"
+        records.append({'query': node['name'], 'action': 'broadcast', 'detail': ', '.join(small)})
+    
+    def _estimate(self, item: Dict, scope: Dict[str, Dict], sizes: Dict[str, int],
+                  depth: int = 0) -> Tuple[Optional[int], bool]:
+        """Upper bound on an item's rows (None if unknown), and whether it filters or aggregates its input"""
+        node = item['node']
+        if node is None:
+            if item['table'] is None:
+                return None, False
+            key = item['table'].lower()
+            if key in sizes:
+                return sizes[key], False
+            node = scope.get(key)
+            if node is None or depth > 20:
+                return None, False
+        filtered = bool(node['conjuncts']) or node['group_by'] is not None
+        if node['set_operation'] or len(node['items']) != 1:
+            return None, filtered
+        inner_scope = dict(scope)
+        inner_scope.update((cte['name'].lower(), cte) for cte in node['ctes'])
+        rows, inner_filtered = self._estimate(node['items'][0], inner_scope, sizes, depth + 1)
+        return rows, filtered or inner_filtered
+    
+    def _item_name(self, item: Dict) -> str:
+        return item['alias'] or (item['table'] or '').split('.')[-1]
+
+class AICodeEnhancer:
+    # One multi-row INSERT as SASToSQLTranslator writes it; every row but the last ends in '),'
+    _bulk_insert_re = re.compile(r'^INSERT INTO [^\n]+ VALUES\n.*?\);$', re.MULTILINE | re.DOTALL)
+    
+    def __init__(self, dialect: str = 'default', table_sizes: Dict[str, int] = None,
+                 broadcast_max_rows: int = 10000):
         self.optimization_rules = [
             self._optimize_joins, self._optimize_subqueries, self._add_index_hints,
             self._improve_readability, self._suggest_performance_improvements
         ]
+        self.join_planner = JoinPlanner(dialect, table_sizes, broadcast_max_rows)
+        self.pushdown = PredicatePushdown()
+        # Join changes and predicates moved by the last enhance_sql call
+        self.join_plans = []
+        self.pushed_predicates = []
     
     def enhance_sql(self, sql_code: str, context: Dict = None) -> str:
         enhanced_sql = sql_code
@@ -864,23 +4815,87 @@ class AICodeEnhancer:
         return enhanced_sql
     
     def _optimize_joins(self, sql: str, context: Dict = None) -> str:
-        return sql
+        self.join_plans = []
+        try:
+            sizes = {name.lower(): len(frame) for name, frame in (context or {}).get('datalines_tables', {}).items()}
+            parts = []
+            for is_insert, text in self._split_bulk_inserts(sql):
+                if is_insert:
+                    parts.append(text)
+                    continue
+                planned, records = self.join_planner.plan(text, sizes)
+                parts.append(planned)
+                self.join_plans.extend(records)
+            if not self.join_plans:
+                return sql
+            report = ["-- Join planning:"]
+            report.extend(f"--   {record['query']}: {record['action']} {record['detail']}" for record in self.join_plans)
+            return "\n".join(report) + "\n" + ''.join(parts)
+        except Exception:
+            self.join_plans = []
+            return sql
     
     def _optimize_subqueries(self, sql: str, context: Dict = None) -> str:
-        return sql
+        self.pushed_predicates = []
+        try:
+            parts = []
+            for is_insert, text in self._split_bulk_inserts(sql):
+                if is_insert:
+                    parts.append(text)
+                    continue
+                optimized, pushed = self.pushdown.optimize(text)
+                parts.append(optimized)
+                self.pushed_predicates.extend(pushed)
+            if not self.pushed_predicates:
+                return sql
+            # One line per predicate, following it through every query it moved into
+            paths = []
+            for pushed in self.pushed_predicates:
+                for path in paths:
+                    if path['as'] == pushed['predicate'] and path['steps'][-1] == pushed['from']:
+                        path['steps'].append(pushed['into'])
+                        path['as'] = pushed['as']
+                        break
+                else:
+                    paths.append({'predicate': pushed['predicate'], 'as': pushed['as'],
+                                  'steps': [pushed['from'], pushed['into']]})
+            report = ["-- Predicate pushdown:"]
+            for path in paths:
+                predicate = ' '.join(path['predicate'].split())
+                report.append(f"--   {predicate}: {' -> '.join(path['steps'])}")
+            return "\n".join(report) + "\n" + ''.join(parts)
+        except Exception:
+            self.pushed_predicates = []
+            return sql
     
     def _add_index_hints(self, sql: str, context: Dict = None) -> str:
         return sql
     
     def _improve_readability(self, sql: str, context: Dict = None) -> str:
         try:
-            # Remove extra whitespace and format SQL
-            sql = re.sub(r'\s+', ' ', sql)
-            sql = sqlparse.format(sql, reindent=True, keyword_case='upper')
-            return sql
+            # Generated DATALINES INSERT batches are already laid out and too big to reformat
+            parts = [text if is_insert else self._format_sql(text)
+                     for is_insert, text in self._split_bulk_inserts(sql)]
+            return "\n\n".join(part.strip("\n") for part in parts if part.strip())
         except:
             return sql
     
+    def _split_bulk_inserts(self, sql: str) -> List[Tuple[bool, str]]:
+        # (is_insert, text) pieces covering the whole SQL
+        parts = []
+        position = 0
+        for match in self._bulk_insert_re.finditer(sql):
+            parts.append((False, sql[position:match.start()]))
+            parts.append((True, match.group(0)))
+            position = match.end()
+        parts.append((False, sql[position:]))
+        return parts
+    
+    def _format_sql(self, sql: str) -> str:
+        # Remove extra whitespace and format SQL; line comments keep their line break
+        sql = re.sub(r'(--[^\n]*\n)\s*|\s+', lambda match: match.group(1) or ' ', sql)
+        return sqlparse.format(sql, reindent=True, keyword_case='upper')
+    
     def _suggest_performance_improvements(self, sql: str, context: Dict = None) -> str:
         suggestions = []
         if "SELECT *" in sql.upper():
@@ -891,67 +4906,298 @@ class AICodeEnhancer:
             sql = "\n".join(suggestions) + "\n" + sql
         return sql
 
+class PySparkGenerator:
+    """Turn translated steps into a PySpark job with one DataFrame per SAS table.
+    
+    Steps are emitted in program order, which SAS itself runs in, and each DataFrame is
+    registered as a temp view so later steps' Spark SQL reads it by its SAS name. Rewriting a
+    table in place creates a new DataFrame variable, so every version is tracked separately.
+    A version read by cache_threshold or more steps is cached and unpersisted after the
+    last action (show or write) that needs it. Versions nothing reads are written out.
+    """
+
+    _create_table_re = re.compile(r'^\s*create\s+table\s+([\w.]+)\s+as\s+(.*)$', re.IGNORECASE | re.DOTALL)
+    _helper_column_re = re.compile(r'\bAS (_dup_rank|_first_\w+|_last_\w+)\b')
+    # Databricks' * EXCEPT (...), which Apache Spark SQL doesn't have
+    _star_except_re = re.compile(r'\*\s*EXCEPT\s*\([^()]*\)', re.IGNORECASE)
+    _notebook_metadata = {
+        'kernelspec': {'display_name': 'Python 3 (ipykernel)', 'language': 'python', 'name': 'python3'},
+        'language_info': {'name': 'python', 'file_extension': '.py', 'mimetype': 'text/x-python',
+                          'codemirror_mode': {'name': 'ipython', 'version': 3},
+                          'nbconvert_exporter': 'python', 'pygments_lexer': 'ipython3'}
+    }
+
+    def __init__(self, cache_threshold: int = 2, app_name: str = 'sas_conversion'):
+        self.cache_threshold = cache_threshold
+        self.app_name = app_name
+        self.type_inferrer = SASTypeInferrer('spark')
+    
+    def generate_script(self, components: Dict, individual_queries: List[Dict]) -> str:
+        parts = []
+        for cell_type, source in self._build_cells(components, individual_queries):
+            if cell_type == 'markdown':
+                source = '\n'.join(f"# {line.lstrip('#').strip()}" for line in source.split('\n'))
+            parts.append(source)
+        return '\n\n'.join(parts) + '\n'
+    
+    def generate_notebook(self, components: Dict, individual_queries: List[Dict]) -> Dict:
+        cells = []
+        for cell_type, source in self._build_cells(components, individual_queries):
+            lines = source.split('\n')
+            cell = {'cell_type': cell_type, 'metadata': {},
+                    'source': [line + '\n' for line in lines[:-1]] + [lines[-1]]}
+            if cell_type == 'code':
+                cell.update({'execution_count': None, 'outputs': []})
+            cells.append(cell)
+        return {'cells': cells, 'metadata': self._notebook_metadata, 'nbformat': 4, 'nbformat_minor': 5}
+    
+    def _build_cells(self, components: Dict, individual_queries: List[Dict]) -> List[Tuple[str, str]]:
+        steps = self._plan_steps(individual_queries)
+        cells = [
+            ('markdown', f"# {self.app_name}\nGenerated from SAS; each SAS table is a DataFrame registered as a temp view."),
+            ('code', "from pyspark.sql import SparkSession"),
+            ('code', f"spark = (SparkSession\n         .builder\n         .appName({self.app_name!r})\n         .getOrCreate()\n        )")
+        ]
+        
+        inputs = []
+        for step in steps:
+            inputs.extend(name for name in step['external'] if name not in inputs)
+        if inputs:
+            lines = ["# Tables the program reads but does not create; point them at the real data if needed"]
+            for name in inputs:
+                variable = self._variable(name, 1)
+                lines.append(f"{variable} = spark.table({name!r})")
+                if '.' not in name:
+                    lines.append(f"{variable}.createOrReplaceTempView({name!r})")
+            cells.append(('code', '\n'.join(lines)))
+        
+        for step in steps:
+            cells.append(('markdown', f"### {step['label']}"))
+            cells.append(('code', '\n'.join(self._step_lines(step, steps, components))))
+        return cells
+    
+    def _plan_steps(self, individual_queries: List[Dict]) -> List[Dict]:
+        # Queries are grouped by kind; their source spans give back the program order
+        queries = sorted(individual_queries,
+                         key=lambda query: query['source'].start if query.get('source') is not None else 0)
+        steps = []
+        producers = {}
+        versions = defaultdict(int)
+        for index, query in enumerate(queries):
+            node = query.get('source')
+            if query['type'] == 'DATA_STEP':
+                output = query.get('table_name')
+                reads = node.get('source_tables', []) if node is not None else []
+                label = f"DATA {output}"
+            else:
+                output = query.get('creates_table')
+                reads = node.get('data_sources', []) if node is not None else []
+                label = query['type'].replace('_', ' ') + (f" -> {output}" if output else '')
+            
+            step = {'index': index, 'query': query, 'label': label, 'output': None, 'variable': None,
+                    'inputs': [], 'external': [], 'consumers': [], 'upstream_cached': set(),
+                    'cached': False, 'unpersist': []}
+            for name in reads:
+                producer = producers.get(name.lower())
+                if producer is not None:
+                    if producer not in step['inputs']:
+                        step['inputs'].append(producer)
+                        steps[producer]['consumers'].append(index)
+                elif name not in step['external']:
+                    step['external'].append(name)
+                    # The loaded input is version 1, so a step rewriting it creates version 2
+                    versions[name.lower()] = versions[name.lower()] or 1
+            
+            if output and not query['sql'].lstrip().startswith('--'):
+                versions[output.lower()] += 1
+                step['output'] = output
+                step['variable'] = self._variable(output, versions[output.lower()])
+                producers[output.lower()] = index
+            steps.append(step)
+        
+        # Shared versions are worth caching; unpersist once the last action depending on them ran
+        for step in steps:
+            step['cached'] = len(step['consumers']) >= self.cache_threshold
+            for producer in step['inputs']:
+                step['upstream_cached'] |= steps[producer]['upstream_cached']
+                if steps[producer]['cached']:
+                    step['upstream_cached'].add(producer)
+        last_action = {}
+        for step in steps:
+            if self._is_action(step):
+                for producer in step['upstream_cached']:
+                    last_action[producer] = step['index']
+        for step in steps:
+            if step['cached'] and step['index'] not in last_action:
+                # Nothing ever materializes it
+                step['cached'] = False
+        for producer, index in last_action.items():
+            steps[index]['unpersist'].append(producer)
+        return steps
+    
+    def _is_action(self, step: Dict) -> bool:
+        return step['output'] is None or not step['consumers']
+    
+    def _step_lines(self, step: Dict, steps: List[Dict], components: Dict) -> List[str]:
+        query = step['query']
+        sql = query['sql'].strip()
+        if sql.startswith('--'):
+            return [f"# {line.lstrip('-').strip()}" for line in sql.split('\n')]
+        
+        lines = []
+        variable = step['variable']
+        output = step['output']
+        node = query.get('source')
+        frame = node.get('datalines') if output and node is not None else None
+        sidecar = query.get('sidecar')
+        if frame is not None:
+            kinds = self.type_inferrer.infer(node['operations'], frame)
+            types = {column: self.type_inferrer.cast_type(kinds.get(column, ('char', None))) for column in frame.columns}
+        if sidecar and sidecar['format'] == 'parquet':
+            lines.append(f"{variable} = spark.read.parquet({sidecar['path']!r})")
+        elif sidecar and frame is not None:
+            schema = ', '.join(f"{column} {sql_type}" for column, sql_type in types.items())
+            lines.append(f"{variable} = spark.read.csv({sidecar['path']!r}, header=True, schema={schema!r})")
+        elif frame is not None:
+            # Rows go in as normalized text and are cast to the inferred types in Spark
+            normalized = self.type_inferrer.normalize(frame, kinds)
+            values = list(zip(*normalized.values()))
+            lines.append(f"{variable} = spark.createDataFrame({values!r}, {list(frame.columns)!r})")
+            if any(sql_type != 'STRING' for sql_type in types.values()):
+                columns = [column if sql_type == 'STRING' else f"CAST({column} AS {sql_type}) AS {column}"
+                           for column, sql_type in types.items()]
+                lines.append(f"{variable} = {variable}.selectExpr({', '.join(map(repr, columns))})")
+        else:
+            # The helper columns * EXCEPT leaves out are dropped from the DataFrame instead
+            for statement in sqlparse.split(self._star_except_re.sub('*', sql)):
+                statement = statement.strip().rstrip(';').strip()
+                if not statement:
+                    continue
+                create_match = self._create_table_re.match(statement)
+                if output and (query['type'] == 'DATA_STEP' or
+                               (create_match and create_match.group(1).lower() == output.lower())):
+                    body = create_match.group(2) if create_match else statement
+                    lines.append(f"{variable} = spark.sql({self._python_string(body)})")
+                elif statement.lower().startswith(('select', 'with')):
+                    lines.append(f"spark.sql({self._python_string(statement)}).show()")
+                else:
+                    lines.append(f"spark.sql({self._python_string(statement)})")
+            helpers = sorted(set(self._helper_column_re.findall(sql)))
+            if query['type'] in ('PROC_SORT', 'DATA_STEP') and variable and helpers:
+                # NODUPKEY's row numbers and BY group flags are not part of the table
+                lines.append(f"{variable} = {variable}.drop({', '.join(map(repr, helpers))})")
+        
+        if output:
+            if '.' not in output:
+                lines.append(f"{variable}.createOrReplaceTempView({output!r})")
+            if step['cached']:
+                lines.append(f"{variable}.cache()  # read by {len(step['consumers'])} steps")
+            if not step['consumers']:
+                lines.append(f"{variable}.write.mode('overwrite').saveAsTable({output!r})")
+        for producer in step['unpersist']:
+            lines.append(f"{steps[producer]['variable']}.unpersist()")
+        return lines
+    
+    def _variable(self, table_name: str, version: int) -> str:
+        variable = 'df_' + re.sub(r'\W', '_', table_name.lower())
+        return variable if version == 1 else f"{variable}_{version}"
+    
+    def _python_string(self, sql: str) -> str:
+        if '"""' in sql or '\\' in sql or sql.endswith('"'):
+            return repr(sql)
+        return f'"""\n{sql}\n"""'
+
 class SASProcessor:
-    def __init__(self):
+    datalines_modes = ('insert', 'parquet', 'csv')
+    
+    def __init__(self, incremental: bool = False, expression_cache_size: int = 4096,
+                 parallel_workers: int = 0, parallel_batch_size: int = 200,
+                 macro_max_depth: int = 50, macro_max_size: int = 50000000, dialect: str = 'default',
+                 inline_max_consumers: int = 1, cache_min_consumers: int = 3, datalines_mode: str = 'insert',
+                 datalines_dir: str = 'datalines', insert_batch_size: int = 1000,
+                 table_sizes: Dict[str, int] = None, broadcast_max_rows: int = 10000,
+                 column_values: Dict[str, Dict[str, List]] = None):
+        self.macro_processor = SASMacroProcessor(macro_max_depth, macro_max_size)
         self.analyzer = SASAnalyzer()
-        self.translator = SASToSQLTranslator()
-        self.consolidator = SQLConsolidator()
-        self.enhancer = AICodeEnhancer()
+        # Shared across calls so conditions repeated between programs are translated once
+        self.expression_cache = TranslationCache(expression_cache_size)
+        self.dialect = dialect
+        self.translator = SASToSQLTranslator(self.expression_cache, dialect, insert_batch_size)
+        self.consolidator = SQLConsolidator(dialect, inline_max_consumers, cache_min_consumers)
+        # Row counts of input tables, where known, let the join planner broadcast small ones
+        self.enhancer = AICodeEnhancer(dialect, table_sizes, broadcast_max_rows)
+        # Distinct values of table columns from a catalog (table -> column -> values); with
+        # DATALINES data they name PROC TRANSPOSE's ID columns
+        self.column_values = {table.lower(): {column.lower(): list(values) for column, values in columns.items()}
+                              for table, columns in (column_values or {}).items()}
+        self.translator.column_values = self.column_values
+        
+        # Incremental mode keeps the previous run's translations keyed by step content hash
+        self.incremental = incremental
+        self._step_cache = {}
+        self._table_keys = {}
+        self._last_consolidated = None
+        self._last_enhanced = None
+        
+        # Programs with at least two batches of steps are translated in a process pool
+        self.parallel_workers = parallel_workers
+        self.parallel_batch_size = max(parallel_batch_size, 1)
+        
+        # DATALINES data goes inline as INSERT batches, or to a parquet/csv file per step
+        if datalines_mode not in self.datalines_modes:
+            raise ValueError(f"Unsupported DATALINES mode: {datalines_mode}")
+        self.datalines_mode = datalines_mode
+        self.datalines_dir = datalines_dir
+        self.insert_batch_size = insert_batch_size
     
     def process_sas_code(self, sas_code: str) -> Dict:
         try:
-            components = self.analyzer.parse_sas_code(sas_code)
-            individual_queries = []
-            
-            # Translate data steps
-            for data_step in components['data_steps']:
-                sql = self.translator.translate_data_step(data_step)
-                individual_queries.append({
-                    'type': 'DATA_STEP',
-                    'table_name': data_step['table_name'],
-                    'sql': sql,
-                    'original_content': data_step['content']
-                })
-            
-            # Translate procedures
-            for procedure in components['procedures']:
-                if procedure['type'] == 'SQL':
-                    sql = self.translator.translate_proc_sql(procedure['content'])
-                    creates_table_match = re.search(r'create\s+table\s+(\w+)', procedure['content'], re.IGNORECASE)
-                    if creates_table_match:
-                        individual_queries.append({
-                            'type': 'PROC_SQL',
-                            'creates_table': creates_table_match.group(1),
-                            'sql': sql,
-                            'original_content': procedure['content']
-                        })
-                    else:
-                        individual_queries.append({
-                            'type': 'PROC_SQL',
-                            'sql': sql,
-                            'original_content': procedure['content']
-                        })
-                elif procedure['type'] == 'PRINT':
-                    sql = self.translator.translate_proc_print(procedure['content'])
-                    individual_queries.append({
-                        'type': 'PROC_PRINT',
-                        'sql': sql,
-                        'original_content': procedure['content']
-                    })
+            expanded_code = self.macro_processor.expand(sas_code)
+            components = self.analyzer.parse_sas_code(expanded_code)
+            components['macros'].update(self.macro_processor.definitions())
+            self.translator.column_values = self._known_column_values(components)
+            self.translator.sort_orders = self._known_sort_orders(components)
+            
+            if self.incremental:
+                individual_queries, incremental_stats = self._translate_components_incremental(components)
+            else:
+                individual_queries = self._translate_components(components)
+            individual_queries, eliminated_sorts = self._eliminate_sorts(individual_queries)
             
             # Consolidate queries
-            consolidated_sql = self.consolidator.consolidate_queries(components, individual_queries)
+            graph = DependencyGraph(components, individual_queries)
+            plan = self.consolidator.plan_materialization(individual_queries, graph)
+            lineage = self.consolidator.column_lineage(components, individual_queries, graph, plan)
+            consolidated_sql = self.consolidator.consolidate_queries(components, individual_queries, graph, plan,
+                                                                     lineage)
             
-            # Enhance SQL
-            enhanced_sql = self.enhancer.enhance_sql(consolidated_sql, components)
+            # Enhance SQL (formatting is by far the slowest part, so reuse it when nothing changed)
+            if self.incremental and consolidated_sql == self._last_consolidated:
+                enhanced_sql = self._last_enhanced
+            else:
+                enhanced_sql = self.enhancer.enhance_sql(consolidated_sql, components)
             
-            return {
+            result = {
                 'components': components,
                 'individual_queries': individual_queries,
                 'consolidated_sql': consolidated_sql,
                 'enhanced_sql': enhanced_sql,
+                # Tables in the same level do not depend on each other and can run concurrently
+                'execution_plan': graph.schedule(),
+                'materialization_plan': plan,
+                'join_plans': self.enhancer.join_plans,
+                'pushed_predicates': self.enhancer.pushed_predicates,
+                'eliminated_sorts': eliminated_sorts,
+                'column_lineage': lineage.report(),
+                'expression_cache': self.expression_cache.stats(),
+                'macro_expansion_cache': self.macro_processor.expansion_cache.stats(),
                 'success': True
             }
+            if self.incremental:
+                self._last_consolidated = consolidated_sql
+                self._last_enhanced = enhanced_sql
+                result['incremental'] = incremental_stats
+            return result
             
         except Exception as e:
             import traceback
@@ -965,6 +5211,445 @@ class SASProcessor:
                 'enhanced_sql': ''
             }
 
+    def iter_process(self, fileobj, chunk_size: int = 1 << 16):
+        """Stream per-step translations from a (possibly huge) SAS file object.
+        
+        Source is read in chunks and each DATA/PROC block is translated and yielded as soon
+        as it is complete, so memory is bounded by the largest step rather than the program.
+        Consolidation and enhancement need the whole program and are not applied here.
+        """
+        for components in self.analyzer.iter_blocks(fileobj, chunk_size):
+            for query in self._translate_components(components):
+                query['span'] = components['span']
+                query['source_tables'] = components['table_dependencies'].get(query.get('table_name'), [])
+                yield self.export_query(query)
+    
+    def export_query(self, query: Dict) -> Dict:
+        """JSON-ready copy of a translated query, with its SAS text materialized from the source span"""
+        exported = {key: value for key, value in query.items() if key != 'source'}
+        if 'source' in query:
+            exported['original_content'] = query['source']['content']
+        return exported
+    
+    def generate_pyspark(self, sas_code: str, notebook: bool = False, app_name: str = 'sas_conversion') -> Dict:
+        """Convert to a PySpark job: the process_sas_code result plus 'pyspark' (script text or notebook dict)"""
+        if self.dialect != 'spark':
+            raise ValueError("PySpark output needs a processor created with dialect='spark'")
+        result = self.process_sas_code(sas_code)
+        if result['success']:
+            generator = PySparkGenerator(app_name=app_name)
+            if notebook:
+                result['pyspark'] = generator.generate_notebook(result['components'], result['individual_queries'])
+            else:
+                result['pyspark'] = generator.generate_script(result['components'], result['individual_queries'])
+        return result
+    
+    def _translate_components(self, components: Dict) -> List[Dict]:
+        # Data steps first, then procedures, as the consolidator expects
+        items = [('DATA_STEP', data_step) for data_step in components['data_steps']]
+        items.extend(('PROC', procedure) for procedure in components['procedures'])
+        
+        if self.parallel_workers > 1 and len(items) >= 2 * self.parallel_batch_size:
+            queries = self._translate_items_parallel(items)
+        else:
+            queries = [self._translate_item(kind, item) for kind, item in items]
+        return [query for query in queries if query]
+    
+    def _translate_items_parallel(self, items: List[Tuple[str, Dict]]) -> List[Optional[Dict]]:
+        """Translate independent steps in worker processes, keeping the original order"""
+        size = self.parallel_batch_size
+        batches = [items[start:start + size] for start in range(0, len(items), size)]
+        workers = min(self.parallel_workers, len(batches))
+        with multiprocessing.Pool(processes=workers, initializer=_init_batch_worker,
+                                  initargs=(self.dialect, self.datalines_mode, self.datalines_dir,
+                                            self.insert_batch_size, self.translator.column_values,
+                                            self.translator.sort_orders)) as pool:
+            # map() returns batch results in submission order
+            results = pool.map(_translate_step_batch, batches)
+        queries = [query for batch in results for query in batch]
+        # Workers send back copies of the nodes; reference the ones parsed here instead
+        for query, (_, item) in zip(queries, items):
+            if query:
+                query['source'] = item
+        return queries
+    
+    def _translate_item(self, kind: str, item: Dict) -> Optional[Dict]:
+        if kind == 'DATA_STEP':
+            return self._translate_data_step(item)
+        return self._translate_procedure(item)
+    
+    def _translate_components_incremental(self, components: Dict) -> Tuple[List[Dict], Dict]:
+        """Reuse the previous run's translations for steps whose content and inputs are unchanged"""
+        entries = [('DATA_STEP', step, step['table_name'], step.get('source_tables', []))
+                   for step in components['data_steps']]
+        entries.extend(('PROC', procedure, self._procedure_output(procedure), procedure.get('data_sources', []))
+                       for procedure in components['procedures'])
+        keys = [self._step_key(kind, item) for kind, item, _, _ in entries]
+        
+        # Tables whose creating step is new or edited, plus tables that no longer exist
+        changed = {output for key, (_, _, output, _) in zip(keys, entries)
+                   if output and key not in self._step_cache}
+        outputs = {output for _, _, output, _ in entries if output}
+        changed.update(table for table in self._table_keys if table not in outputs)
+        dirty = DependencyGraph(components).downstream(changed)
+        
+        individual_queries = []
+        step_cache = {}
+        table_keys = {}
+        reused = 0
+        for key, (kind, item, output, sources) in zip(keys, entries):
+            cached = self._step_cache.get(key)
+            if cached is not None and not dirty.intersection(sources):
+                # Point at this run's node so the previous source buffer can be released
+                query = dict(cached, source=item)
+                reused += 1
+            else:
+                query = self._translate_item(kind, item)
+            if query is None:
+                continue
+            step_cache[key] = query
+            if output:
+                table_keys[output] = key
+            individual_queries.append(query)
+        
+        self._step_cache = step_cache
+        self._table_keys = table_keys
+        stats = {'reused_steps': reused, 'translated_steps': len(individual_queries) - reused,
+                 'dirty_tables': sorted(dirty)}
+        return individual_queries, stats
+    
+    def _step_key(self, kind: str, item: Dict) -> str:
+        if kind == 'DATA_STEP':
+            # Options on the DATA statement only show up in the parsed operations
+            payload = f"{item['table_name']}\0{item['content']}\0{json.dumps(item['operations'], sort_keys=True, default=str)}"
+        else:
+            payload = f"{item['type']}\0{item['content']}"
+        return hashlib.sha1(f"{kind}\0{payload}".encode('utf-8')).hexdigest()
+    
+    def _known_column_values(self, components: Dict) -> Dict[str, Dict[str, List]]:
+        # The catalog, plus the values of DATALINES tables in order of appearance, missing ones left out
+        known = dict(self.column_values)
+        missing_re = self.translator.type_inferrer._missing_re
+        for data_step in components['data_steps']:
+            frame = data_step.get('datalines')
+            if frame is not None:
+                known[data_step['table_name'].lower()] = {
+                    column.lower(): [value for value in pd.unique(frame[column]) if not missing_re.fullmatch(value)]
+                    for column in frame.columns}
+        return known
+    
+    def _known_sort_orders(self, components: Dict) -> Dict[str, List[Tuple[int, List[Tuple[str, bool]]]]]:
+        # BY keys of each PROC SORT, under the table it writes, so DATA steps can order their windows
+        orders = defaultdict(list)
+        for procedure in components['procedures']:
+            if procedure['type'] != 'SORT' or not procedure.get('creates_table'):
+                continue
+            by_match = re.search(r';\s*by\s+([^;]*)', procedure['content'], re.IGNORECASE)
+            if by_match:
+                orders[procedure['creates_table'].lower()].append(
+                    (procedure['start'], self.translator._by_keys(by_match.group(1))))
+        return dict(orders)
+    
+    def _procedure_output(self, procedure: Dict) -> Optional[str]:
+        return procedure.get('creates_table')
+    
+    def _translate_data_step(self, data_step: Dict) -> Dict:
+        if self.datalines_mode != 'insert' and data_step.get('datalines') is not None:
+            return self._translate_datalines_sidecar(data_step)
+        sql = self.translator.translate_data_step(data_step)
+        return {
+            'type': 'DATA_STEP',
+            'table_name': data_step['table_name'],
+            'sql': sql,
+            'source': data_step
+        }
+    
+    def _translate_datalines_sidecar(self, data_step: Dict) -> Dict:
+        table_name = data_step['table_name']
+        try:
+            kinds = self.translator.type_inferrer.infer(data_step['operations'], data_step['datalines'])
+            sidecar = self._write_datalines_sidecar(data_step, kinds)
+            sql = self.translator.translate_datalines_sidecar(data_step, sidecar['path'], sidecar['format'], kinds)
+        except OSError as e:
+            return {'type': 'DATA_STEP', 'table_name': table_name, 'source': data_step,
+                    'sql': f"-- Error writing datalines file for {table_name}: {str(e)}"}
+        return {
+            'type': 'DATA_STEP',
+            'table_name': table_name,
+            'sql': sql,
+            'sidecar': sidecar,
+            'source': data_step
+        }
+    
+    def _write_datalines_sidecar(self, data_step: Dict, kinds: Dict[str, Tuple]) -> Dict:
+        """Write a step's DATALINES rows next to the output and return {'path', 'format'[, 'note']}"""
+        inferrer = self.translator.type_inferrer
+        # Missing values are written as nulls and dates in ISO form
+        normalized = inferrer.normalize(data_step['datalines'], kinds)
+        # The step offset keeps files apart when a program rebuilds the same table
+        name = re.sub(r'\W', '_', data_step['table_name'])
+        stem = os.path.join(self.datalines_dir, f"{name}_{data_step['start']}")
+        os.makedirs(self.datalines_dir, exist_ok=True)
+        sidecar = {'format': self.datalines_mode}
+        if self.datalines_mode == 'parquet':
+            try:
+                # Parquet carries the inferred column types itself
+                inferrer.typed_frame(normalized, kinds).to_parquet(stem + '.parquet', index=False)
+                sidecar['path'] = stem + '.parquet'
+                return sidecar
+            except ImportError:
+                # No parquet engine (pyarrow/fastparquet) installed
+                sidecar.update({'format': 'csv', 'note': 'parquet engine not installed; wrote CSV instead'})
+        pd.DataFrame(normalized).to_csv(stem + '.csv', index=False)
+        sidecar['path'] = stem + '.csv'
+        return sidecar
+    
+    def _translate_procedure(self, procedure: Dict) -> Optional[Dict]:
+        if procedure['type'] == 'SQL':
+            sql = self.translator.translate_proc_sql(procedure['content'])
+            creates_table = self._procedure_output(procedure)
+            if creates_table:
+                return {
+                    'type': 'PROC_SQL',
+                    'creates_table': creates_table,
+                    'sql': sql,
+                    'source': procedure
+                }
+            return {
+                'type': 'PROC_SQL',
+                'sql': sql,
+                'source': procedure
+            }
+        elif procedure['type'] == 'PRINT':
+            sql = self.translator.translate_proc_print(procedure['content'])
+            return {
+                'type': 'PROC_PRINT',
+                'sql': sql,
+                'source': procedure
+            }
+        elif procedure['type'] in ('MEANS', 'SUMMARY'):
+            sql = self.translator.translate_proc_means(procedure['content'])
+            query = {
+                'type': f"PROC_{procedure['type']}",
+                'sql': sql,
+                'source': procedure
+            }
+            if procedure.get('creates_table'):
+                query['creates_table'] = procedure['creates_table']
+            return query
+        elif procedure['type'] == 'FREQ':
+            sql = self.translator.translate_proc_freq(procedure['content'])
+            query = {
+                'type': 'PROC_FREQ',
+                'sql': sql,
+                'source': procedure
+            }
+            if procedure.get('creates_table'):
+                query['creates_table'] = procedure['creates_table']
+            return query
+        elif procedure['type'] == 'SORT':
+            sql, order_by = self.translator.translate_proc_sort(procedure['content'])
+            query = {
+                'type': 'PROC_SORT',
+                'sql': sql,
+                'source': procedure
+            }
+            if order_by is not None:
+                query['creates_table'] = procedure['creates_table']
+                query['order_by'] = order_by
+            return query
+        elif procedure['type'] == 'TRANSPOSE':
+            sql = self.translator.translate_proc_transpose(procedure['content'])
+            query = {
+                'type': 'PROC_TRANSPOSE',
+                'sql': sql,
+                'source': procedure
+            }
+            if procedure.get('creates_table'):
+                query['creates_table'] = procedure['creates_table']
+            return query
+        return None
+    
+    def _eliminate_sorts(self, individual_queries: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+        """Drop the ORDER BY of PROC SORT steps whose output no reader needs in order.
+        
+        SQL tables carry no row order, so a sort only matters to the steps reading its output
+        before the table is rewritten: MERGE/SET with BY, aggregating procedures, other sorts and
+        PROC SQL queries that group or order themselves don't depend on it. A sorted table that
+        nothing reads, or that a PROC PRINT or a DATA step without BY reads, stays sorted.
+        Returns the queries, eliminated sorts replaced by copies, and one record per sort removed.
+        """
+        ordered = sorted(((query['source'].start if query.get('source') is not None else 0, position)
+                          for position, query in enumerate(individual_queries)))
+        queries = list(individual_queries)
+        eliminated = []
+        for rank, (_, position) in enumerate(ordered):
+            query = queries[position]
+            if query['type'] != 'PROC_SORT' or 'order_by' not in query:
+                continue
+            output = query['creates_table'].lower()
+            readers = []
+            for _, reader_position in ordered[rank + 1:]:
+                reader = individual_queries[reader_position]
+                node = reader.get('source')
+                if reader['type'] == 'DATA_STEP':
+                    reads = node.get('source_tables', []) if node is not None else []
+                    writes = reader.get('table_name')
+                else:
+                    reads = node.get('data_sources', []) if node is not None else []
+                    writes = reader.get('creates_table')
+                if output in (name.lower() for name in reads):
+                    readers.append(reader)
+                if writes and writes.lower() == output:
+                    break
+            if readers and all(self._order_insensitive(reader) for reader in readers):
+                sql, _, rest = query['sql'].rpartition(f"\nORDER BY {query['order_by']}")
+                queries[position] = dict(query, sql=sql + rest, sort_eliminated=True)
+                eliminated.append({'table': query['creates_table'], 'order_by': query['order_by'],
+                                   'readers': sorted({reader['type'] for reader in readers})})
+        return queries, eliminated
+    
+    def _order_insensitive(self, query: Dict) -> bool:
+        if query['type'] == 'DATA_STEP':
+            # Window functions carry their own ORDER BY
+            node = query.get('source')
+            return bool(node is not None and node.get('operations', {}).get('by')) or ' OVER (' in query['sql']
+        if query['type'] == 'PROC_SQL':
+            return bool(re.search(r'\b(?:group|order)\s+by\b', query['sql'], re.IGNORECASE))
+        return query['type'] in ('PROC_MEANS', 'PROC_SUMMARY', 'PROC_FREQ', 'PROC_SORT', 'PROC_TRANSPOSE')
+
+# Batch conversion
+_batch_processor = None
+
+def _init_batch_worker(dialect: str = 'default', datalines_mode: str = 'insert', datalines_dir: str = 'datalines',
+                       insert_batch_size: int = 1000, column_values: Dict[str, Dict[str, List]] = None,
+                       sort_orders: Dict[str, List] = None):
+    # One processor per worker process so its expression cache is shared by everything it converts
+    global _batch_processor
+    _batch_processor = SASProcessor(dialect=dialect, datalines_mode=datalines_mode, datalines_dir=datalines_dir,
+                                    insert_batch_size=insert_batch_size, column_values=column_values)
+    _batch_processor.translator.sort_orders = sort_orders or {}
+
+def _convert_batch_chunk(chunk: List[Tuple[str, str, str]]) -> List[Dict]:
+    """Convert (source_path, output_path, relative_name) triples and return their manifest entries"""
+    if _batch_processor is None:
+        _init_batch_worker()
+    entries = []
+    for source_path, output_path, relative_name in chunk:
+        started = time.perf_counter()
+        entry = {'source': relative_name, 'output': None, 'bytes': None}
+        try:
+            # A file that vanished or can't be read fails on its own, not the whole chunk
+            entry['bytes'] = os.path.getsize(source_path)
+            with open(source_path, 'r', encoding='utf-8', errors='replace') as source_file:
+                sas_code = source_file.read()
+            # The output extension picks the format: .sql, .py (PySpark script) or .ipynb
+            extension = os.path.splitext(output_path)[1]
+            _batch_processor.datalines_dir = os.path.abspath(os.path.splitext(output_path)[0] + '_datalines')
+            if extension in ('.py', '.ipynb'):
+                app_name = os.path.splitext(os.path.basename(relative_name))[0]
+                result = _batch_processor.generate_pyspark(sas_code, extension == '.ipynb', app_name)
+            else:
+                result = _batch_processor.process_sas_code(sas_code)
+            if result['success']:
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                with open(output_path, 'w', encoding='utf-8') as output_file:
+                    if extension == '.ipynb':
+                        json.dump(result['pyspark'], output_file, indent=1)
+                    elif extension == '.py':
+                        output_file.write(result['pyspark'])
+                    else:
+                        output_file.write(result['consolidated_sql'])
+                entry.update({'status': 'ok', 'output': os.path.splitext(relative_name)[0] + extension,
+                              'steps': len(result['individual_queries'])})
+            else:
+                entry.update({'status': 'error', 'error': result['error'], 'traceback': result['traceback']})
+        except Exception as e:
+            import traceback
+            entry.update({'status': 'error', 'error': str(e), 'traceback': traceback.format_exc()})
+        entry['seconds'] = round(time.perf_counter() - started, 4)
+        entries.append(entry)
+    return entries
+
+def _translate_step_batch(batch: List[Tuple[str, Dict]]) -> List[Optional[Dict]]:
+    if _batch_processor is None:
+        _init_batch_worker()
+    return [_batch_processor._translate_item(kind, item) for kind, item in batch]
+
+def _file_size(path: str) -> int:
+    # Unreadable files still get a chunk, where their conversion is recorded as failed
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def _plan_batch_chunks(files: List[Tuple[str, str, str]], workers: int) -> List[List[Tuple[str, str, str]]]:
+    """Largest files first, each big file on its own and small files grouped to a similar byte budget"""
+    sized = sorted(((_file_size(item[0]), item) for item in files), key=lambda pair: pair[0], reverse=True)
+    total = sum(size for size, _ in sized)
+    budget = max(total // max(workers * 4, 1), 1)
+    chunks, current, current_size = [], [], 0
+    for size, item in sized:
+        current.append(item)
+        current_size += size
+        if current_size >= budget:
+            chunks.append(current)
+            current, current_size = [], 0
+    if current:
+        chunks.append(current)
+    return chunks
+
+def convert_directory(source_dir: str, output_dir: str, workers: int = None, manifest_path: str = None,
+                      dialect: str = 'default', output_format: str = 'sql', datalines_mode: str = 'insert',
+                      insert_batch_size: int = 1000) -> Dict:
+    """Convert every .sas file under source_dir to a .sql, .py or .ipynb file under output_dir in a process pool.
+    
+    With a parquet or csv datalines_mode, each file's DATALINES data is written under
+    OUTPUT_DIR/<name>_datalines/.
+    """
+    if output_format not in ('sql', 'py', 'ipynb'):
+        raise ValueError(f"Unsupported output format: {output_format}")
+    if output_format != 'sql':
+        # PySpark jobs run the translated SQL through spark.sql()
+        dialect = 'spark'
+    workers = workers or os.cpu_count() or 1
+    worker_args = (dialect, datalines_mode, 'datalines', insert_batch_size)
+    _init_batch_worker(*worker_args)
+    files = []
+    for root, _, names in os.walk(source_dir):
+        for name in sorted(names):
+            if name.lower().endswith('.sas'):
+                source_path = os.path.join(root, name)
+                relative_name = os.path.relpath(source_path, source_dir)
+                output_path = os.path.join(output_dir, os.path.splitext(relative_name)[0] + '.' + output_format)
+                files.append((source_path, output_path, relative_name))
+    
+    started = time.perf_counter()
+    chunks = _plan_batch_chunks(files, workers)
+    entries = []
+    if workers == 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            entries.extend(_convert_batch_chunk(chunk))
+    else:
+        with multiprocessing.Pool(processes=workers, initializer=_init_batch_worker, initargs=worker_args) as pool:
+            for chunk_entries in pool.imap_unordered(_convert_batch_chunk, chunks):
+                entries.extend(chunk_entries)
+    entries.sort(key=lambda entry: entry['source'])
+    
+    manifest = {
+        'source_dir': os.path.abspath(source_dir), 'output_dir': os.path.abspath(output_dir),
+        'generated_at': datetime.now().isoformat(timespec='seconds'), 'workers': workers, 'dialect': dialect,
+        'format': output_format, 'datalines': datalines_mode,
+        'files': len(entries), 'succeeded': sum(1 for entry in entries if entry['status'] == 'ok'),
+        'failed': sum(1 for entry in entries if entry['status'] != 'ok'),
+        'seconds': round(time.perf_counter() - started, 4), 'results': entries
+    }
+    manifest_path = manifest_path or os.path.join(output_dir, 'manifest.json')
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+    with open(manifest_path, 'w', encoding='utf-8') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    return manifest
+
 # Flask Application
 app = Flask(__name__)
 
@@ -1522,9 +6207,10 @@ HTML_TEMPLATE = """
                 <div class="config-panel">
                     <div class="config-row">
                         <div class="config-label">SQL Dialect:</div>
-                        <select id="sqlDialect">
-                            <option value="spark">Spark SQL</option>
-                            <option value="oracle">Oracle</option>
+                        <select id="sqlDialect" name="sql_dialect" form="conversionForm">
+                            <option value="spark" {% if dialect == 'spark' %}selected{% endif %}>Spark SQL</option>
+                            <option value="default" {% if dialect == 'default' %}selected{% endif %}>Generic SQL</option>
+                            <option value="oracle" {% if dialect == 'oracle' %}selected{% endif %}>Oracle</option>
                         </select>
                     </div>
                     
@@ -1564,6 +6250,12 @@ run;" id="sasCodeTextarea">{{ sas_code if sas_code }}</textarea>
                         <button type="button" class="btn btn-secondary" onclick="resetForm()">
                             <span>🔄 Reset</span>
                         </button>
+                        <button type="submit" class="btn btn-secondary" formaction="/pyspark" name="format" value="py">
+                            <span>🐍 PySpark Script</span>
+                        </button>
+                        <button type="submit" class="btn btn-secondary" formaction="/pyspark" name="format" value="ipynb">
+                            <span>📓 PySpark Notebook</span>
+                        </button>
                     </div>
                 </form>
             </div>
@@ -1785,24 +6477,31 @@ def index():
             if file and file.filename.endswith('.sas'):
                 sas_code = file.read().decode('utf-8')
         
-        processor = SASProcessor()
+        # Dialects without a dedicated backend (Oracle) get the generic SQL output
+        dialect = request.form.get('sql_dialect', 'default')
+        if dialect not in SASFunctionTranslator.dialects:
+            dialect = 'default'
+        processor = SASProcessor(dialect=dialect)
         result = processor.process_sas_code(sas_code)
         
         if result['success']:
             return render_template_string(HTML_TEMPLATE, 
                                        sas_code=sas_code, 
                                        result=result,
-                                       error=None)
+                                       error=None,
+                                       dialect=dialect)
         else:
             return render_template_string(HTML_TEMPLATE,
                                        sas_code=sas_code,
                                        result=None,
-                                       error=result['error'])
+                                       error=result['error'],
+                                       dialect=dialect)
     
     return render_template_string(HTML_TEMPLATE, 
                                sas_code=None, 
                                result=None,
-                               error=None)
+                               error=None,
+                               dialect='spark')
 
 @app.route('/download')
 def download_sql():
@@ -1819,5 +6518,114 @@ def download_sql():
         mimetype='text/plain'
     )
 
+@app.route('/pyspark', methods=['POST'])
+def download_pyspark():
+    """Convert the submitted SAS code and download it as a PySpark script or notebook"""
+    sas_code = request.form.get('sas_code', '')
+    if 'sas_file' in request.files:
+        file = request.files['sas_file']
+        if file and file.filename.endswith('.sas'):
+            sas_code = file.read().decode('utf-8')
+    notebook = request.form.get('format', request.args.get('format', 'py')) == 'ipynb'
+    
+    result = SASProcessor(dialect='spark').generate_pyspark(sas_code, notebook)
+    if not result['success']:
+        return jsonify({'success': False, 'error': result['error']}), 400
+    if notebook:
+        file_like = io.BytesIO(json.dumps(result['pyspark'], indent=1).encode('utf-8'))
+        return send_file(file_like, as_attachment=True, download_name='converted_job.ipynb',
+                         mimetype='application/x-ipynb+json')
+    file_like = io.BytesIO(result['pyspark'].encode('utf-8'))
+    return send_file(file_like, as_attachment=True, download_name='converted_job.py', mimetype='text/x-python')
+
+@app.route('/stream', methods=['POST'])
+def stream_sql():
+    """Convert a SAS program sent as the raw request body, streaming one JSON line per translated step"""
+    dialect = request.args.get('dialect', 'default')
+    if dialect not in SASFunctionTranslator.dialects:
+        return jsonify({'success': False, 'error': f'Unsupported SQL dialect: {dialect}'}), 400
+    processor = SASProcessor(dialect=dialect)
+    
+    def generate():
+        for query in processor.iter_process(request.stream):
+            yield json.dumps(query) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+# Incremental conversion sessions, least recently used first
+MAX_SESSIONS = 64
+conversion_sessions = OrderedDict()
+# Request handlers run on several threads; lookups, LRU moves and evictions share this lock
+conversion_sessions_lock = threading.Lock()
+
+@app.route('/session', methods=['POST'])
+def create_session():
+    """Start an edit-and-reconvert session that reuses translations of unchanged steps"""
+    dialect = request.args.get('dialect', 'default')
+    if dialect not in SASFunctionTranslator.dialects:
+        return jsonify({'success': False, 'error': f'Unsupported SQL dialect: {dialect}'}), 400
+    session_id = uuid.uuid4().hex
+    processor = SASProcessor(incremental=True, dialect=dialect)
+    with conversion_sessions_lock:
+        conversion_sessions[session_id] = processor
+        while len(conversion_sessions) > MAX_SESSIONS:
+            conversion_sessions.popitem(last=False)
+    return jsonify({'session_id': session_id})
+
+@app.route('/session/<session_id>/convert', methods=['POST'])
+def convert_in_session(session_id):
+    with conversion_sessions_lock:
+        processor = conversion_sessions.get(session_id)
+        if processor is not None:
+            conversion_sessions.move_to_end(session_id)
+    if processor is None:
+        return jsonify({'success': False, 'error': f'Unknown session: {session_id}'}), 404
+    
+    sas_code = request.form.get('sas_code') or request.get_data(as_text=True)
+    result = processor.process_sas_code(sas_code)
+    result.pop('components', None)
+    result['individual_queries'] = [processor.export_query(query) for query in result['individual_queries']]
+    return jsonify(result)
+
+@app.route('/session/<session_id>', methods=['DELETE'])
+def delete_session(session_id):
+    with conversion_sessions_lock:
+        conversion_sessions.pop(session_id, None)
+    return jsonify({'success': True})
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description='SAS to SQL converter')
+    subparsers = parser.add_subparsers(dest='command')
+    
+    serve_parser = subparsers.add_parser('serve', help='run the web converter (default)')
+    serve_parser.add_argument('--host', default='0.0.0.0')
+    serve_parser.add_argument('--port', type=int, default=5000)
+    
+    batch_parser = subparsers.add_parser('batch', help='convert every .sas file under a directory')
+    batch_parser.add_argument('source_dir')
+    batch_parser.add_argument('output_dir')
+    batch_parser.add_argument('--workers', type=int, default=None, help='worker processes (default: all cores)')
+    batch_parser.add_argument('--manifest', default=None, help='manifest path (default: OUTPUT_DIR/manifest.json)')
+    batch_parser.add_argument('--dialect', choices=SASFunctionTranslator.dialects, default='default',
+                              help='target SQL dialect')
+    batch_parser.add_argument('--format', choices=('sql', 'py', 'ipynb'), default='sql',
+                              help='consolidated SQL, or a PySpark script/notebook (implies --dialect spark)')
+    batch_parser.add_argument('--datalines', choices=SASProcessor.datalines_modes, default='insert',
+                              help='load DATALINES data with INSERT batches or from parquet/csv files')
+    batch_parser.add_argument('--insert-batch-size', type=int, default=1000, help='rows per DATALINES INSERT')
+    
+    args = parser.parse_args(argv)
+    if args.command == 'batch':
+        manifest = convert_directory(args.source_dir, args.output_dir, args.workers, args.manifest,
+                                     args.dialect, args.format, args.datalines, args.insert_batch_size)
+        print(f"Converted {manifest['succeeded']}/{manifest['files']} files in {manifest['seconds']}s "
+              f"({manifest['failed']} failed)")
+        return 1 if manifest['failed'] else 0
+    
+    host = getattr(args, 'host', '0.0.0.0')
+    port = getattr(args, 'port', 5000)
+    app.run(debug=True, host=host, port=port)
+    return 0
+
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    sys.exit(main())
@@ -0,0 +1,19 @@
+import os
+
+import sas2sql_converter as converter
+
+
+def test_missing_file_fails_alone(tmp_path):
+    source = tmp_path / 'ok.sas'
+    source.write_text('data a; set b; run;\n')
+    chunk = [(str(tmp_path / 'gone.sas'), str(tmp_path / 'out' / 'gone.sql'), 'gone.sas'),
+             (str(source), str(tmp_path / 'out' / 'ok.sql'), 'ok.sas')]
+    missing, converted = converter._convert_batch_chunk(chunk)
+    assert missing['status'] == 'error' and missing['bytes'] is None
+    assert converted['status'] == 'ok'
+    assert os.path.exists(tmp_path / 'out' / 'ok.sql')
+
+
+def test_missing_file_still_planned(tmp_path):
+    chunks = converter._plan_batch_chunks([(str(tmp_path / 'gone.sas'), 'out.sql', 'gone.sas')], 1)
+    assert [item[2] for chunk in chunks for item in chunk] == ['gone.sas']
@@ -0,0 +1,26 @@
+import threading
+
+import sas2sql_converter as converter
+
+
+def test_sessions_survive_concurrent_requests(monkeypatch):
+    monkeypatch.setattr(converter, 'MAX_SESSIONS', 4)
+    client = converter.app.test_client()
+    failures = []
+
+    def worker():
+        for _ in range(20):
+            session_id = client.post('/session').get_json()['session_id']
+            response = client.post(f'/session/{session_id}/convert', data={'sas_code': 'data a; set b; run;'})
+            # Other threads may evict the session first, which must be a clean 404
+            if response.status_code not in (200, 404):
+                failures.append(response.status_code)
+            client.delete(f'/session/{session_id}')
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert failures == []
+    assert len(converter.conversion_sessions) <= 4
@@ -0,0 +1,242 @@
+"""Input -> output SQL for the rewrites applied to consolidated statements.
+
+Projection pruning (ColumnLineage), predicate pushdown (PredicatePushdown) and join planning
+(JoinPlanner) each rewrite generated SQL; these pin what they produce, and leave alone, for
+set operations, DISTINCT, GROUP BY, outer joins and * expansion. Whitespace is compared
+collapsed, and consolidated SQL without its leading -- comment lines.
+"""
+import pytest
+
+from sas2sql_converter import (JoinPlanner, PredicatePushdown, SASFunctionTranslator, SASProcessor,
+                               TranslationCache)
+
+
+def flat(sql):
+    return ' '.join(' '.join(line for line in sql.split('\n') if not line.startswith('--')).split())
+
+
+def consolidate(sas_code, dialect='default'):
+    result = SASProcessor(dialect=dialect).process_sas_code(sas_code)
+    assert result['success'], result.get('error')
+    return result
+
+
+# Projection pruning
+
+@pytest.mark.parametrize('sas_code, expected', [
+    pytest.param(
+        "data a; set raw.t; y = x + 1; run;\n"
+        "proc sql; select y from a; quit;",
+        "select y from ( SELECT x + 1 AS y FROM raw.t ) AS a",
+        id='star-of-open-table-cut-to-what-is-read'),
+    pytest.param(
+        "data ref; input k v w; datalines;\n1 2 3\n;\nrun;\n"
+        "data a; set ref; z = v * 2; run;\n"
+        "proc sql; select k, z from a; quit;",
+        "CREATE TABLE ref ( k SMALLINT, v SMALLINT, w SMALLINT ); INSERT INTO ref (k, v, w) VALUES (1, 2, 3); "
+        "select k, z from ( SELECT k, v * 2 AS z FROM ref ) AS a",
+        id='star-of-known-columns-expanded'),
+    pytest.param(
+        "proc sql; create table d as select distinct * from raw.t; quit;\n"
+        "proc sql; select x from d; quit;",
+        "select x from ( select distinct * from raw.t ) AS d",
+        id='distinct-keeps-its-star'),
+    pytest.param(
+        "data a; set raw.t; y = x * 2; run;\n"
+        "proc sql; select g, sum(y) as s from a group by g; quit;",
+        "select g, sum(y) as s from ( SELECT g, x * 2 AS y FROM raw.t ) AS a group by g",
+        id='group-by-keys-kept'),
+    pytest.param(
+        "proc sql; create table u as select a, b from raw.t union all select a, b from raw.u; quit;\n"
+        "proc sql; select a from u; quit;",
+        "select a from ( select a, b from raw.t union all select a, b from raw.u ) AS u",
+        id='set-operation-not-cut'),
+    pytest.param(
+        "data a; set raw.t; y = x + 1; run;\ndata b; set raw.u; z = w + 1; run;\n"
+        "proc sql; select a.k, b.z from a left join b on a.k = b.k; quit;",
+        "select a.k, b.z from ( SELECT k FROM raw.t ) AS a left join ( SELECT k, w + 1 AS z FROM raw.u ) AS b "
+        "on a.k = b.k",
+        id='left-join'),
+    pytest.param(
+        "data a; set raw.t; y = x + 1; run;\ndata b; set raw.u; z = w + 1; run;\n"
+        "proc sql; select a.k, b.z from a full join b on a.k = b.k; quit;",
+        "select a.k, b.z from ( SELECT k FROM raw.t ) AS a full join ( SELECT k, w + 1 AS z FROM raw.u ) AS b "
+        "on a.k = b.k",
+        id='full-join'),
+    pytest.param(
+        "data f; set raw.s; by g; if first.g; run;\n"
+        "proc sql; select x from f; quit;",
+        "select x from ( SELECT x FROM ( SELECT x, CASE WHEN ROW_NUMBER() OVER (PARTITION BY g ORDER BY g) = 1 "
+        "THEN 1 ELSE 0 END AS _first_g FROM raw.s ) s WHERE _first_g = 1 ) AS f",
+        id='star-exclude-expanded-without-flag'),
+    pytest.param(
+        "data w; set raw.s; by g; retain n 0; n + 1; if last.g; run;\n"
+        "proc sql; select g, n from w; quit;",
+        "select g, n from ( SELECT g, n FROM ( SELECT g, _last_g, COALESCE(SUM(1) OVER (ORDER BY g ROWS BETWEEN "
+        "UNBOUNDED PRECEDING AND CURRENT ROW), 0) AS n FROM ( SELECT g, CASE WHEN ROW_NUMBER() OVER (PARTITION BY g "
+        "ORDER BY g DESC) = 1 THEN 1 ELSE 0 END AS _last_g FROM raw.s ) s ) r WHERE _last_g = 1 ) AS w",
+        id='window-keywords-are-not-columns'),
+])
+def test_projection_pruning(sas_code, expected):
+    assert flat(consolidate(sas_code)['consolidated_sql']) == expected
+
+
+def test_spark_star_except_expanded_where_columns_are_known():
+    sql = flat(consolidate("proc sort data=raw.customers out=cust nodupkey; by cust_id; run;\n"
+                           "proc sql; select cust_id from cust; quit;", 'spark')['consolidated_sql'])
+    assert 'EXCEPT' not in sql
+    assert "SELECT cust_id FROM ( SELECT t.cust_id, ROW_NUMBER() OVER (PARTITION BY cust_id ORDER BY cust_id) " \
+           "AS _dup_rank FROM raw.customers t ) s WHERE _dup_rank = 1" in sql
+
+
+# Predicate pushdown
+
+@pytest.mark.parametrize('sql, expected, moved', [
+    pytest.param("SELECT * FROM (SELECT a, b FROM t) s WHERE a > 1",
+                 "SELECT * FROM (SELECT a, b FROM t WHERE a > 1) s", 1, id='into-subquery'),
+    pytest.param("SELECT * FROM (SELECT DISTINCT a, b FROM t) s WHERE a > 1",
+                 "SELECT * FROM (SELECT DISTINCT a, b FROM t WHERE a > 1) s", 1, id='distinct'),
+    pytest.param("SELECT * FROM (SELECT a, SUM(b) AS total FROM t GROUP BY a) s WHERE a > 1 AND total > 10",
+                 "SELECT * FROM (SELECT a, SUM(b) AS total FROM t WHERE a > 1 GROUP BY a) s WHERE total > 10", 1,
+                 id='group-by-key-only'),
+    pytest.param("SELECT * FROM (SELECT a FROM t UNION ALL SELECT a FROM u) s WHERE a > 1",
+                 "SELECT * FROM (SELECT a FROM t UNION ALL SELECT a FROM u) s WHERE a > 1", 0,
+                 id='set-operation'),
+    pytest.param("SELECT * FROM (SELECT a, b FROM t) x LEFT JOIN (SELECT a, c FROM u) y ON x.a = y.a "
+                 "WHERE x.b > 1 AND y.c > 2",
+                 "SELECT * FROM (SELECT a, b FROM t WHERE b > 1) x LEFT JOIN (SELECT a, c FROM u) y ON x.a = y.a "
+                 "WHERE y.c > 2", 1, id='left-join-preserved-side-only'),
+    pytest.param("SELECT * FROM (SELECT a, b FROM t) x FULL JOIN (SELECT a, c FROM u) y ON x.a = y.a WHERE x.b > 1",
+                 "SELECT * FROM (SELECT a, b FROM t) x FULL JOIN (SELECT a, c FROM u) y ON x.a = y.a WHERE x.b > 1", 0,
+                 id='full-join'),
+    pytest.param("SELECT * FROM (SELECT a, b * 2 AS b2 FROM t) s WHERE b2 > 4 AND a = 1",
+                 "SELECT * FROM (SELECT a, b * 2 AS b2 FROM t WHERE a = 1) s WHERE b2 > 4", 1,
+                 id='computed-column-stays'),
+    pytest.param("SELECT * FROM (SELECT a, ROW_NUMBER() OVER (ORDER BY a) AS rn FROM t) s WHERE a > 1",
+                 "SELECT * FROM (SELECT a, ROW_NUMBER() OVER (ORDER BY a) AS rn FROM t) s WHERE a > 1", 0,
+                 id='window-function'),
+    pytest.param("SELECT * FROM (SELECT a FROM t QUALIFY ROW_NUMBER() OVER (PARTITION BY a ORDER BY a) = 1) s "
+                 "WHERE a > 1",
+                 "SELECT * FROM (SELECT a FROM t QUALIFY ROW_NUMBER() OVER (PARTITION BY a ORDER BY a) = 1) s "
+                 "WHERE a > 1", 0, id='qualify'),
+    pytest.param("SELECT * FROM (SELECT * EXCEPT (r) FROM (SELECT a, 1 AS r FROM t) q) s WHERE a > 1",
+                 "SELECT * FROM (SELECT * EXCEPT (r) FROM (SELECT a, 1 AS r FROM t WHERE a > 1) q) s", 2,
+                 id='star-except-is-not-a-set-operation'),
+])
+def test_predicate_pushdown(sql, expected, moved):
+    optimized, pushed = PredicatePushdown().optimize(sql)
+    assert flat(optimized) == expected
+    assert len(pushed) == moved
+
+
+# Join planning
+
+@pytest.mark.parametrize('dialect, sizes, sql, expected', [
+    pytest.param('default', {}, "SELECT x.a, y.b FROM x, y WHERE x.k = y.k",
+                 "SELECT x.a, y.b FROM x INNER JOIN y ON x.k = y.k", id='comma-join'),
+    pytest.param('default', {}, "SELECT x.a, y.b FROM x CROSS JOIN y WHERE x.k = y.k AND x.a > 1",
+                 "SELECT x.a, y.b FROM x INNER JOIN y ON x.k = y.k WHERE x.a > 1", id='cross-join'),
+    pytest.param('default', {}, "SELECT x.a FROM x, y", "SELECT x.a FROM x, y", id='unrelated-inputs-kept'),
+    pytest.param('default', {'big': 1000000, 'small': 10, 'mid': 1000},
+                 "SELECT b.a, s.b, m.c FROM big b INNER JOIN mid m ON b.k = m.k INNER JOIN small s ON s.k = b.k",
+                 "SELECT b.a, s.b, m.c FROM small s INNER JOIN big b ON s.k = b.k INNER JOIN mid m ON b.k = m.k",
+                 id='small-inputs-first'),
+    pytest.param('default', {'big': 1000000, 'small': 10}, "SELECT * FROM big b INNER JOIN small s ON s.k = b.k",
+                 "SELECT * FROM big b INNER JOIN small s ON s.k = b.k", id='bare-star-keeps-order'),
+    pytest.param('spark', {'big': 1000000, 'small': 10}, "SELECT b.a, s.b FROM big b LEFT JOIN small s ON s.k = b.k",
+                 "SELECT /*+ BROADCAST(s) */ b.a, s.b FROM big b LEFT JOIN small s ON s.k = b.k",
+                 id='left-join-broadcasts-null-supplying-side'),
+    pytest.param('spark', {'big': 1000000, 'small': 10}, "SELECT b.a, s.b FROM small s LEFT JOIN big b ON s.k = b.k",
+                 "SELECT b.a, s.b FROM small s LEFT JOIN big b ON s.k = b.k", id='left-join-preserved-side'),
+    pytest.param('spark', {'big': 1000000, 'small': 10}, "SELECT b.a, s.b FROM big b FULL JOIN small s ON s.k = b.k",
+                 "SELECT b.a, s.b FROM big b FULL JOIN small s ON s.k = b.k", id='full-join'),
+])
+def test_join_planning(dialect, sizes, sql, expected):
+    planned, _ = JoinPlanner(dialect, sizes).plan(sql)
+    assert flat(planned) == expected
+
+
+# Regressions
+
+def test_self_join_counts_each_reference():
+    result = consolidate("data a; set src; x = y + 1; run;\n"
+                         "data b; set a; z = x * 2; run;\n"
+                         "proc sql;\n  create table d as select b1.z, b2.z as z2, b3.z as z3\n"
+                         "  from b b1, b b2, b b3 where b1.x = b2.x and b2.x = b3.x;\nquit;")
+    assert result['materialization_plan']['b']['strategy'] == 'materialize'
+    assert result['materialization_plan']['b']['consumers'] == 3
+    assert 'from cte_b b1, cte_b b2, cte_b b3' in flat(result['consolidated_sql'])
+
+
+def test_tables_read_before_the_with_clause_are_materialized_first():
+    sql = flat(consolidate("data a; set src; x = y + 1; run;\ndata b; set a; z = x * 2; run;\n"
+                           "data c; set b; w = z + 1; run;\ndata d; set b; v = z + 2; run;\n"
+                           "proc sql; select c.w, d.v, b.z, a.x from c inner join d on c.x = d.x\n"
+                           "  inner join b on b.x = c.x inner join a on a.x = b.x; quit;")['consolidated_sql'])
+    assert sql.startswith("CREATE TEMPORARY TABLE cte_a AS SELECT y + 1 AS x FROM src; "
+                          "CREATE TEMPORARY TABLE cte_b AS SELECT x, x * 2 AS z FROM cte_a;")
+    assert 'WITH' not in sql
+
+
+def test_unread_table_is_created_not_left_as_unused_cte():
+    result = consolidate("data a; set raw.t; y = x + 1; run;\ndata unread; set a; z = y * 2; run;\n"
+                         "data b; set a; w = y - 1; run;\nproc sql; select w from b; quit;")
+    assert flat(result['consolidated_sql']) == (
+        "CREATE TEMPORARY TABLE cte_a AS SELECT *, x + 1 AS y FROM raw.t; "
+        "CREATE TABLE unread AS SELECT *, y * 2 AS z FROM cte_a; "
+        "select w from ( SELECT y - 1 AS w FROM cte_a ) AS b")
+    assert result['materialization_plan']['unread']['strategy'] == 'table'
+
+
+def test_datalines_values_that_are_not_decimal_literals_are_null():
+    sql = flat(consolidate("data t; input id v; datalines;\n1 2.5\n2 inf\n3 nan\n4 1_000\n5 1e3\n;\nrun;")
+               ['consolidated_sql'])
+    assert sql.endswith("VALUES (1, 2.5), (2, NULL), (3, NULL), (4, NULL), (5, 1e3)")
+
+
+@pytest.mark.parametrize('expression, expected', [
+    ("put(dt, date9.)", "CAST(dt AS VARCHAR)"),
+    ("put(ts, datetime20.)", "CAST(ts AS VARCHAR)"),
+    ("put(x, 8.)", "CAST(x AS VARCHAR(8))"),
+    ("put(s, $10.)", "CAST(s AS VARCHAR(10))"),
+])
+def test_put_width_only_for_character_and_numeric_formats(expression, expected):
+    assert SASFunctionTranslator().translate(expression) == expected
+
+
+def test_lag_under_if_is_not_translated():
+    sql = flat(consolidate("data t; set raw.s; by g; if amt > 10 then prev = lag(amt); last = lag(amt); run;")
+               ['consolidated_sql'])
+    assert 'THEN LAG(' not in sql
+    assert "LAG(amt) OVER (ORDER BY g) AS last" in sql
+    assert "LAG/DIF under IF not translated" in sql
+
+
+def test_pyspark_script_has_no_star_except():
+    result = SASProcessor(dialect='spark').generate_pyspark(
+        "proc sort data=raw.customers out=cust nodupkey; by cust_id; run;\n"
+        "data f; set raw.s; by g; if first.g; run;")
+    assert 'EXCEPT' not in result['pyspark']
+    assert "df_cust = df_cust.drop('_dup_rank')" in result['pyspark']
+    assert "df_f = df_f.drop('_first_g')" in result['pyspark']
+
+
+def test_cache_key_ignores_case_and_blanks_outside_quotes():
+    translator = SASFunctionTranslator(TranslationCache())
+    first = translator.translate("put(x, date9.) = 'A  b'")
+    assert translator.translate("PUT(x,   DATE9.) = 'A  b'") == first
+    assert translator.cache.stats()['hits'] == 1
+    # Text inside quotes is data, so a different spelling there is a different expression
+    assert translator.translate("put(x, date9.) = 'a b'") != first
+    assert translator.cache.stats()['hits'] == 1
+
+
+@pytest.mark.parametrize('file_format, reader', [('parquet', "read_parquet('/data/ref.parquet')"),
+                                                 ('csv', "read_csv_auto('/data/ref.csv', header = true, "
+                                                         "all_varchar = true)")])
+def test_default_dialect_sidecars_load_with_duckdb(file_format, reader):
+    processor = SASProcessor()
+    step = {'table_name': 'ref', 'operations': {'input': ['code', 'qty']}, 'datalines': None}
+    sql = processor.translator.translate_datalines_sidecar(step, f'/data/ref.{file_format}', file_format)
+    assert sql.endswith(f"INSERT INTO ref SELECT * FROM {reader};")
+    assert 'COPY' not in sql